@@ -61,6 +61,21 @@
 		"         FROM (SELECT hstore(ARRAY[key::TEXT, value::TEXT]) AS a\n" \
 		"               FROM json_each_text('%s'::JSON)) AS z));"
 
+/*
+ * Tell the web user interface about each value list loaded so it can push
+ * the new points to the charts that are open.
+ */
+#define NOTIFY_STATEMENT "SELECT pg_notify('yams_value_list', %s);"
+
+/* pg_notify() refuses payloads of 8000 bytes or more. */
+#define NOTIFY_PAYLOAD_LEN 7999
+
+/*
+ * Room for the statement with the longest payload escaped, which at worst
+ * doubles every character and adds the quotes and an E.
+ */
+#define NOTIFY_SQL_LEN (sizeof(NOTIFY_STATEMENT) + 2 * NOTIFY_PAYLOAD_LEN + 3)
+
 #define SELECT_DAY0 "SELECT ((TIMESTAMP WITH TIME ZONE 'EPOCH' + %d * " \
 		"INTERVAL '1 SECOND') AT TIME ZONE 'UTC')::DATE;"
 #define SELECT_DAY1 "SELECT ('%s'::DATE + INTERVAL '1 DAY')::DATE;"
@@ -80,6 +95,7 @@ static int loop = 0;
 
 static int verbose_flag = 0;
 static int stats_flag = 0;
+static int notify_flag = 0;
 
 struct opts
 {
@@ -101,6 +117,7 @@ int create_partition_table(PGconn *, char *, const char *, const char *,
 static inline int do_command(PGconn *, char *);
 int do_insert(PGconn *, char *);
 int load(PGconn *, json_object *);
+static inline int notify(PGconn *, json_object *);
 void *thread_main(void *data);
 void usage();
 static inline int work(struct opts *);
@@ -347,6 +364,73 @@ int load(PGconn *conn, json_object *jsono)
 		}
 	}
 
+	if (notify_flag)
+		notify(conn, jsono);
+
+	return 0;
+}
+
+static inline int notify(PGconn *conn, json_object *jsono)
+{
+	PGresult *res;
+	char sql[NOTIFY_SQL_LEN + 1];
+	const char *payload;
+	char *literal;
+	json_object *identity = NULL;
+	json_object *jo_t;
+	int i, length;
+
+	/* What is sent in place of a value list too long to notify. */
+	const char *members[] = {"host", "plugin", "plugin_instance", "type",
+			"type_instance", "time", NULL};
+
+	payload = json_object_to_json_string(jsono);
+	if (strlen(payload) > NOTIFY_PAYLOAD_LEN) {
+		/*
+		 * Only tell which series has a new value list, the web user interface
+		 * reads it back from the database.
+		 */
+		identity = json_object_new_object();
+		for (i = 0; members[i] != NULL; i++) {
+			jo_t = json_object_object_get(jsono, members[i]);
+			if (jo_t != NULL)
+				json_object_object_add(identity, members[i],
+						json_object_get(jo_t));
+		}
+		json_object_object_add(identity, "truncated",
+				json_object_new_boolean(1));
+		payload = json_object_to_json_string(identity);
+		if (strlen(payload) > NOTIFY_PAYLOAD_LEN) {
+			syslog(LOG_WARNING, "value list too long to notify");
+			json_object_put(identity);
+			return 1;
+		}
+	}
+
+	literal = PQescapeLiteral(conn, payload, strlen(payload));
+	if (identity != NULL)
+		json_object_put(identity);
+	if (literal == NULL) {
+		syslog(LOG_WARNING, "escaping notification failed: %s",
+				PQerrorMessage(conn));
+		return 1;
+	}
+	length = snprintf(sql, sizeof(sql), NOTIFY_STATEMENT, literal);
+	PQfreemem(literal);
+	if (length < 0 || length >= (int) sizeof(sql)) {
+		syslog(LOG_WARNING, "notification too long, not sent");
+		return 1;
+	}
+
+	res = PQexec(conn, sql);
+	if (PQresultStatus(res) != PGRES_TUPLES_OK) {
+		syslog(LOG_WARNING, "NOTIFY command failed: %s %s",
+				PQresultErrorField(res, PG_DIAG_SQLSTATE),
+				PQerrorMessage(conn));
+		PQclear(res);
+		return 1;
+	}
+	PQclear(res);
 	return 0;
 }
 
@@ -374,6 +458,7 @@ void usage()
 	printf("                [--pghost <PGHOST>]\n");
 	printf("                [--pgport <PGPORT>]\n");
 	printf("                [--pgusername <PGUSER>]\n");
+	printf("                [--notify]\n");
 	printf("                [--redis-key <key>] (default: yamsetl)\n");
 	printf("                [--redis-port <port>] (default: 6379)\n");
 	printf("                [--redis-server <host>] (default: localhost)\n");
@@ -485,6 +570,7 @@ int main(int argc, char *argv[])
 		int option_index = 0;
 		static struct option long_options[] = {
 			{"help", no_argument, NULL, '?'},
+			{"notify", no_argument, &notify_flag, 1},
 			{"pgdatabase", required_argument, NULL, 'D'},
 			{"pghost", required_argument, NULL, 'H'},
 			{"pgport", required_argument, NULL, 'P'},
@@ -99,3 +99,75 @@ $$
 if [ $? -ne 0 ]; then
 	exit 1
 fi
+
+# Create the rollup tables used by the WUI.
+psql -v ON_ERROR_STOP=1 -U ${WUI_USER} -d ${COLLECTD_DB} << $$
+BEGIN;
+CREATE TABLE rollup_watermark (
+  tier VARCHAR(8) PRIMARY KEY,
+  time TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE TABLE rollup_1min (
+  time TIMESTAMP WITH TIME ZONE NOT NULL,
+  host VARCHAR(64) NOT NULL,
+  plugin VARCHAR(64) NOT NULL,
+  plugin_instance VARCHAR(64),
+  type VARCHAR(64) NOT NULL,
+  type_instance VARCHAR(64),
+  dsnames VARCHAR(512)[] NOT NULL,
+  dstypes VARCHAR(8)[] NOT NULL,
+  meta HSTORE NOT NULL DEFAULT '',
+  samples INTEGER NOT NULL,
+  min DOUBLE PRECISION[] NOT NULL,
+  max DOUBLE PRECISION[] NOT NULL,
+  avg DOUBLE PRECISION[] NOT NULL,
+  last DOUBLE PRECISION[] NOT NULL
+);
+CREATE TABLE rollup_15min (LIKE rollup_1min);
+CREATE TABLE rollup_1hour (LIKE rollup_1min);
+CREATE INDEX ON rollup_1min (plugin, host, time);
+CREATE INDEX ON rollup_1min (time);
+CREATE INDEX ON rollup_15min (plugin, host, time);
+CREATE INDEX ON rollup_15min (time);
+CREATE INDEX ON rollup_1hour (plugin, host, time);
+CREATE INDEX ON rollup_1hour (time);
+CREATE TABLE plugin_totals (
+  time TIMESTAMP WITH TIME ZONE NOT NULL,
+  plugin VARCHAR(64) NOT NULL,
+  plugin_instance VARCHAR(64),
+  type VARCHAR(64) NOT NULL,
+  values DOUBLE PRECISION[] NOT NULL
+);
+CREATE INDEX ON plugin_totals (plugin, type, time);
+CREATE INDEX ON plugin_totals (time);
+CREATE TABLE series (
+  series_id SERIAL PRIMARY KEY,
+  host VARCHAR(64) NOT NULL,
+  plugin VARCHAR(64) NOT NULL,
+  plugin_instance VARCHAR(64) NOT NULL DEFAULT '',
+  type VARCHAR(64) NOT NULL,
+  type_instance VARCHAR(64) NOT NULL DEFAULT '',
+  dsnames VARCHAR(512)[] NOT NULL,
+  dstypes VARCHAR(8)[] NOT NULL,
+  meta HSTORE NOT NULL DEFAULT '',
+  interval INTEGER NOT NULL,
+  first_seen TIMESTAMP WITH TIME ZONE NOT NULL,
+  last_seen TIMESTAMP WITH TIME ZONE NOT NULL,
+  UNIQUE (plugin, type, host, plugin_instance, type_instance, dsnames,
+          dstypes, meta)
+);
+CREATE INDEX ON series (plugin, type, last_seen);
+CREATE TABLE dashboard (
+  name VARCHAR(64) PRIMARY KEY,
+  url_list TEXT[] NOT NULL,
+  time_range INTEGER NOT NULL,
+  refresh INTEGER NOT NULL DEFAULT 60,
+  views INTEGER NOT NULL DEFAULT 0,
+  last_viewed TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX ON dashboard (last_viewed);
+COMMIT;
+$$
+if [ $? -ne 0 ]; then
+	exit 1
+fi
@@ -8,7 +8,7 @@ CHANGES = open(os.path.join(here, 'CHANGES.txt')).read()
 
 requires = [
     'pyramid<1.5a',
-    'SQLAlchemy',
+    'SQLAlchemy>=1.2',
     'transaction',
     'pyramid_tm',
     'pyramid_debugtoolbar',
@@ -16,6 +16,8 @@ requires = [
     'waitress',
     'sqlalchemy',
     'psycopg2',
+    'numpy',
+    'redis',
     ]
 
 setup(name='yams-wui',
@@ -42,5 +44,10 @@ setup(name='yams-wui',
       main = yamswui:main
       [console_scripts]
       initialize_yams-wui_db = yamswui.scripts.initializedb:main
+      rollup_yams-wui_db = yamswui.scripts.rollup:main
+      generate_yams-wui_data = yamswui.scripts.generate:main
+      benchmark_yams-wui = yamswui.scripts.benchmark:main
+      backfill_yams-wui_data = yamswui.scripts.backfill:main
+      expire_yams-wui_data = yamswui.scripts.expire:main
       """,
       )
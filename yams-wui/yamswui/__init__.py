@@ -1,33 +1,90 @@
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
 from pyramid.config import Configurator
+from pyramid.settings import asbool
+from pyramid.tweens import EXCVIEW
 from sqlalchemy import engine_from_config
 
+from .catalog import catalog
+from .dashboards import prewarmer
+from .fanout import fanout
+from .governor import (
+    governor,
+    timeouts,
+    )
+from .live import listener
+from .metrics import metrics
 from .models import (
     DBSession,
     Base,
     )
+from .sessions import (
+    ServerSessionFactory,
+    store,
+    )
+from .tiles import cache
 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    # SQLAlchemy does not turn pool_pre_ping into a boolean by itself.
+    engine = engine_from_config(settings, 'sqlalchemy.',
+            pool_pre_ping=asbool(settings.get('sqlalchemy.pool_pre_ping',
+                                              False)))
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
-    my_session_factory = UnencryptedCookieSessionFactoryConfig('yams')
+    catalog.configure(engine, ttl=int(settings.get('yams.catalog_ttl', 300)),
+            size=int(settings.get('yams.catalog_size', 256)))
+    governor.configure(DBSession,
+            slots=int(settings.get('yams.max_streams', 0)),
+            wait=float(settings.get('yams.stream_wait', 0)),
+            retry_after=int(settings.get('yams.retry_after', 5)),
+            timeouts=timeouts(settings))
+    fanout.configure(engine,
+            threads=int(settings.get('yams.fanout_threads', 0)),
+            slices=int(settings.get('yams.fanout_slices', 4)))
+    cache.configure(int(settings.get('yams.tile_cache_size', 64)) * 1048576,
+            ttl=int(settings.get('yams.tile_ttl', 86400)),
+            delay=int(settings.get('yams.rollup_delay', 300)),
+            url=settings.get('yams.tile_redis_url'))
+    if asbool(settings.get('yams.live', False)):
+        listener.configure(engine,
+                size=int(settings.get('yams.live_queue_size', 1000)))
+    if asbool(settings.get('yams.prewarm', False)):
+        prewarmer.configure(engine, settings,
+                size=int(settings.get('yams.prewarm_size', 10)),
+                workers=int(settings.get('yams.prewarm_workers', 2)),
+                interval=int(settings.get('yams.prewarm_interval', 10)))
+    metrics_enabled = asbool(settings.get('yams.metrics', False))
+    if metrics_enabled:
+        metrics.configure(engine, float(settings.get('yams.slow_request', 0)))
+    if settings.get('yams.session_store', 'cookie') == 'cookie':
+        my_session_factory = UnencryptedCookieSessionFactoryConfig('yams')
+    else:
+        my_session_factory = ServerSessionFactory(store(settings),
+                timeout=int(settings.get('yams.session_timeout', 1200)))
     config = Configurator(settings=settings, session_factory=my_session_factory)
+    if metrics_enabled:
+        config.add_tween('yamswui.metrics:tween_factory', over=EXCVIEW)
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('add_source', '/add_source')
     config.add_route('chart', '/chart')
     config.add_route('clear_sources', '/clear_sources')
+    config.add_route('dashboards', '/dashboards')
+    config.add_route('data_batch', '/data_batch.csv')
     config.add_route('data_csv', '/data.csv/{plugin}/{host}')
     config.add_route('dsnames', '/dsnames/{type}/{plugin}')
     config.add_route('home', '/')
+    config.add_route('live', '/live')
     config.add_route('hosts', '/hosts/{type}/{plugin}')
+    config.add_route('load_dashboard', '/load_dashboard/{name}')
     config.add_route('meta', '/meta/{type}/{plugin}')
+    config.add_route('metrics', '/metrics')
     config.add_route('plugins', '/plugins')
     config.add_route('plugin_instances', '/plugin_instances/{plugin}')
+    config.add_route('save_dashboard', '/save_dashboard/{name}')
     config.add_route('session', '/session')
+    config.add_route('toggle_aggregate', '/toggle_aggregate')
     config.add_route('toggle_dsname', '/toggle_dsname/{dsname}')
     config.add_route('toggle_host', '/toggle_host/{host}')
     config.add_route('toggle_meta', '/toggle_meta/{key}/{value}')
@@ -37,6 +94,7 @@ def main(global_config, **settings):
     config.add_route('toggle_time_range', '/toggle_time_range/{value}')
     config.add_route('toggle_type_instance',
             '/toggle_type_instance/{type_instance}')
+    config.add_route('top', '/top/{type}/{plugin}')
     config.add_route('types', '/types/{plugin}')
     config.add_route('type_instances', '/type_instances/{type}/{plugin}')
     config.scan()
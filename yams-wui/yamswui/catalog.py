@@ -0,0 +1,300 @@
+import json
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import md5
+
+from sqlalchemy import text
+
+from .partitions import (
+    name,
+    parse,
+    quote,
+    resolve,
+    utc,
+    )
+from .rollups import (
+    BACKFILL,
+    watermark,
+    )
+from .statements import execute
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait before rereading the list of partitions again when one is
+# missing.
+RECHECK = 10
+
+
+class Catalog(object):
+    """ Keep the plugins, types, instances, hosts and data source names that
+    there is data for in memory, so the pickers do not have to ask the
+    database on every click.
+
+    The list of partitions is reread every ttl seconds in the background.
+    The details of a plugin, or of a type of the postgresql plugin, are those
+    of the series seen since the start of the day of its newest partition.
+    They come from the series dictionary once the rollups have recorded that
+    day in it, and from the partition itself until then.  They are loaded
+    the first time they are asked for and reloaded when a newer partition
+    appears or after ttl seconds.  Only the details of the size most recently
+    used plugins are kept.  The version only moves on when the partitions or
+    the details of a plugin change, not when the same details are reloaded.
+
+    The watermarks of the rollups are kept as well, reread at most every
+    RECHECK seconds, and with them the last time value lists loaded after the
+    fact were rolled up again.
+    """
+    def __init__(self):
+        self.engine = None
+        self.ttl = 300
+        self.size = 256
+        self.lock = threading.Lock()
+        self.tables = set()
+        self.refreshed = 0
+        self.newest = {}
+        self.details = OrderedDict()
+        self.version = 0
+        # A digest of the details last loaded for each plugin, kept after
+        # they are let go to tell whether they changed when reloaded.
+        self.digests = {}
+        self.marks = None
+        self.marks_read = 0
+        self.backfill = None
+        self.thread = None
+
+    def configure(self, engine, ttl=300, size=256):
+        self.engine = engine
+        self.ttl = ttl
+        self.size = size
+        try:
+            self.refresh()
+        except Exception:
+            log.exception('loading the catalog failed')
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='catalog')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('refreshing the catalog failed')
+
+    def refresh(self):
+        """ Reread the list of partitions and reload the details that are out
+        of date.
+        """
+        connection = self.engine.connect()
+        try:
+            self.refresh_tables(connection)
+
+            now = time.time()
+            with self.lock:
+                stale = [key for key, (table, loaded, types) \
+                         in self.details.items() \
+                         if self.newest.get(key) != table or \
+                                 loaded + self.ttl <= now]
+
+            for key in stale:
+                self.load(connection, key)
+            self.refresh_watermarks(connection)
+        finally:
+            connection.close()
+
+    def refresh_tables(self, connection):
+        """ Reread the list of partitions. """
+        tables = set()
+        newest = {}
+        # Partitions detached from value_list are on their way out, see
+        # scripts/expire.py.
+        for row in execute(connection,
+                "SELECT c.relname AS tablename " \
+                "FROM pg_inherits AS i " \
+                "JOIN pg_class AS c ON c.oid = i.inhrelid " \
+                "WHERE i.inhparent = 'collectd.value_list'::REGCLASS " \
+                "  AND c.relname LIKE 'vl\\_%';"):
+            partition = parse(row['tablename'])
+            if partition is None:
+                continue
+            tables.add(row['tablename'])
+            plugin, day, type = partition
+            key = (plugin, type)
+            if key not in newest or newest[key] < row['tablename']:
+                newest[key] = row['tablename']
+
+        with self.lock:
+            self.tables = tables
+            self.refreshed = time.time()
+            if newest != self.newest:
+                self.newest = newest
+                self.version += 1
+
+    def load(self, connection, key):
+        """ Load the details of a plugin from the series dictionary or its
+        newest partition.
+        """
+        table = self.newest.get(key)
+        if table is None:
+            with self.lock:
+                self.details.pop(key, None)
+                if self.digests.pop(key, None) is not None:
+                    self.version += 1
+            return {}
+
+        plugin, type = key
+        day = datetime.strptime(parse(table)[1], '%Y%m%d').replace(tzinfo=utc)
+        recorded = watermark(connection, 'series')
+        if recorded is not None and recorded >= day:
+            source = "series " \
+                     "WHERE plugin = :plugin " \
+                     "  AND last_seen >= :day"
+            if type is not None:
+                source += " AND type = :type"
+        else:
+            source = quote(table)
+
+        types = {}
+        for row in connection.execute(text(
+                "SELECT type, " \
+                "       array_agg(DISTINCT plugin_instance) " \
+                "           AS plugin_instances, " \
+                "       array_agg(DISTINCT type_instance) " \
+                "           AS type_instances, " \
+                "       array_agg(DISTINCT host) AS hosts, " \
+                "       min(dsnames) AS dsnames, " \
+                "       min(akeys(meta)) AS meta_keys " \
+                "FROM %s " \
+                "GROUP BY type;" % source),
+                {'plugin': plugin, 'type': type, 'day': day}):
+            types[row['type']] = {
+                    'plugin_instances': sorted([plugin_instance \
+                            for plugin_instance in row['plugin_instances'] \
+                            if plugin_instance]),
+                    'type_instances': sorted([type_instance \
+                            for type_instance in row['type_instances'] \
+                            if type_instance]),
+                    'hosts': sorted([host for host in row['hosts'] if host]),
+                    'dsnames': row['dsnames'],
+                    'meta_keys': row['meta_keys'] or []}
+
+        digest = md5(json.dumps(types, sort_keys=True)).hexdigest()
+        with self.lock:
+            self.details.pop(key, None)
+            self.details[key] = (table, time.time(), types)
+            while len(self.details) > self.size:
+                self.details.popitem(last=False)
+            if self.digests.get(key) != digest:
+                self.digests[key] = digest
+                self.version += 1
+        return types
+
+    def refresh_watermarks(self, connection):
+        row = execute(connection,
+                "SELECT array_agg(tier ORDER BY tier) AS tiers, " \
+                "       array_agg(time ORDER BY tier) AS time " \
+                "FROM rollup_watermark;").first()
+        with self.lock:
+            self.marks = row['time']
+            self.marks_read = time.time()
+            self.backfill = dict(zip(row['tiers'] or [],
+                                     row['time'] or [])).get(BACKFILL)
+        return row['time']
+
+    def watermarks(self):
+        """ Return the watermarks of the rollup tiers, in the order of their
+        names, rereading them if they were read more than RECHECK seconds
+        ago.
+        """
+        with self.lock:
+            if self.marks_read + RECHECK > time.time():
+                return self.marks
+        connection = self.engine.connect()
+        try:
+            return self.refresh_watermarks(connection)
+        finally:
+            connection.close()
+
+    def backfilled(self):
+        """ Return the last time value lists loaded after the fact were
+        rolled up again, or None.
+        """
+        self.watermarks()
+        with self.lock:
+            return self.backfill
+
+    def get(self, plugin, type=None):
+        """ Return the details of each type of a plugin, loading them if they
+        are not already in memory.
+        """
+        if plugin != 'postgresql':
+            type = None
+        key = (plugin, type)
+
+        with self.lock:
+            if key in self.details:
+                # Move it to the end as the most recently used.
+                details = self.details.pop(key)
+                self.details[key] = details
+                return details[2]
+
+        connection = self.engine.connect()
+        try:
+            return self.load(connection, key)
+        finally:
+            connection.close()
+
+    def detail(self, plugin, type, name):
+        return self.get(plugin, type).get(type, {}).get(name, [])
+
+    def resolve(self, plugin, start, end, type=None):
+        """ Return the names of the partitions holding the data of a plugin
+        between start and end, oldest first.  The list of partitions is
+        reread first if the partition for the end of the time range is not
+        known yet, for example just after midnight.
+        """
+        if name(plugin, end.astimezone(utc), type) not in self.tables and \
+                self.refreshed + RECHECK <= time.time():
+            connection = self.engine.connect()
+            try:
+                self.refresh_tables(connection)
+            finally:
+                connection.close()
+        return resolve(plugin, start, end, type, self.tables)
+
+    def plugins(self):
+        return sorted(set([plugin for plugin, type in self.newest]))
+
+    def types(self, plugin):
+        if plugin == 'postgresql':
+            # The postgresql plugin is partitioned by type.
+            return sorted([type for p, type in self.newest if p == plugin])
+        return sorted(self.get(plugin).keys())
+
+    def plugin_instances(self, plugin):
+        plugin_instances = set()
+        for details in self.get(plugin).values():
+            plugin_instances.update(details['plugin_instances'])
+        return sorted(plugin_instances)
+
+    def type_instances(self, plugin, type):
+        return self.detail(plugin, type, 'type_instances')
+
+    def hosts(self, plugin, type):
+        return self.detail(plugin, type, 'hosts')
+
+    def dsnames(self, plugin, type):
+        return self.detail(plugin, type, 'dsnames')
+
+    def meta_keys(self, plugin, type):
+        return self.detail(plugin, type, 'meta_keys')
+
+
+catalog = Catalog()
@@ -0,0 +1,254 @@
+import json
+import struct
+import warnings
+
+from cStringIO import StringIO
+
+import numpy
+
+# collectd counters are either 32 or 64 bits wide, guess which one wrapped
+# around by looking at the last value seen before the wrap.
+COUNTER_WRAP_32 = 2.0 ** 32
+COUNTER_WRAP_64 = 2.0 ** 64
+
+# The aggregates of the hosts of a series that can be plotted in their place.
+AGGREGATES = ('sum', 'avg', 'min', 'max', 'p50', 'p95', 'p99')
+
+
+def matrix(rows, column):
+    """ Return the arrays in a column of the result rows as a 2-D float64
+    array with one row per result row.  NULL elements become NaN.
+    """
+    return numpy.array([row[column] for row in rows], dtype=numpy.float64)
+
+
+def differences(values, previous):
+    """ Return the difference of each row of values from the row before it,
+    using previous as the row before the first one.
+    """
+    return numpy.diff(numpy.vstack((previous, values)), axis=0)
+
+
+def percentage(x, y):
+    """ Return x as a percentage of y, with divisions by zero reported as 0
+    like the old array_percentage() database function did.
+    """
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        tmp = x / y * 100
+    tmp[numpy.isinf(tmp)] = 0
+    return tmp
+
+
+class Rates(object):
+    """ Turn batches of raw value lists into the numbers that are plotted.
+
+    Counters and derives are plotted as the change from the previous value
+    list, gauges and absolutes as they are.  The last row of each batch is
+    remembered so that consecutive batches can be fed in one after another.
+    """
+    def __init__(self, dstypes, indexes, percentage=False):
+        dstypes = numpy.array(dstypes)[indexes]
+        self.indexes = indexes
+        self.counters = dstypes == 'counter'
+        self.rates = (dstypes == 'counter') | (dstypes == 'derive')
+        self.percentage = percentage
+        self.previous = None
+        self.previous_totals = None
+
+    def compute(self, ctimes, values, totals=None, samples=None):
+        """ Return the timestamps and a 2-D array of the plotted values for a
+        batch of rows.  The very first row of a series is dropped since there
+        is nothing to calculate its rates from.
+
+        When the rows are rollups, samples is the number of value lists each
+        row stands for and the changes are spread evenly across them.
+        """
+        values = values[:, self.indexes]
+        if totals is not None:
+            totals = totals[:, self.indexes]
+
+        if self.previous is None:
+            self.previous = values[0]
+            if totals is not None:
+                self.previous_totals = totals[0]
+            ctimes = ctimes[1:]
+            values = values[1:]
+            if totals is not None:
+                totals = totals[1:]
+            if samples is not None:
+                samples = samples[1:]
+            if len(values) == 0:
+                return ctimes, values
+
+        deltas = differences(values, self.previous)
+        lasts = numpy.vstack((self.previous, values[:-1]))
+        wrapped = self.counters & (deltas < 0)
+        deltas[wrapped] += numpy.where(lasts[wrapped] < COUNTER_WRAP_32,
+                COUNTER_WRAP_32, COUNTER_WRAP_64)
+        self.previous = values[-1]
+
+        if samples is not None and not self.percentage:
+            deltas /= samples[:, None]
+
+        if totals is not None:
+            total_deltas = differences(totals, self.previous_totals)
+            self.previous_totals = totals[-1]
+            if self.percentage:
+                values = percentage(values, totals)
+                deltas = percentage(deltas, total_deltas)
+
+        return ctimes, numpy.where(self.rates, deltas, values)
+
+
+def format_csv(ctimes, values):
+    """ Serialize a batch of timestamps and plotted values as CSV lines. """
+    buf = StringIO()
+    numpy.savetxt(buf, numpy.column_stack((ctimes, values)),
+            fmt=['%d'] + ['%r'] * values.shape[1], delimiter=',')
+    return buf.getvalue()
+
+
+def format_binary_header(labels):
+    """ Serialize the labels of a series as a binary block.
+
+    Every binary block starts with two little-endian uint32s, the length of
+    the JSON header that follows and the number of rows after that.  The
+    header is padded with spaces so the float64 arrays stay 8-byte aligned and
+    can be used as they are by the browser.
+    """
+    header = json.dumps({'labels': labels})
+    header += ' ' * (-len(header) % 8)
+    return struct.pack('<II', len(header), 0) + header
+
+
+def format_binary(ctimes, values):
+    """ Serialize a batch of timestamps and plotted values as a binary block
+    of little-endian float64 columns, the timestamps first.
+    """
+    columns = numpy.vstack((ctimes, values.T)).astype('<f8')
+    return struct.pack('<II', 0, len(ctimes)) + columns.tobytes()
+
+
+class Buckets(object):
+    """ Reduce the plotted values to one point per fixed width time bucket.
+
+    Each bucket is plotted as the average of its values, optionally followed
+    by the minimum and maximum so spikes are not lost.  Rows of a bucket that
+    may continue in the next batch are held back until it is complete.
+    """
+    def __init__(self, width, envelope=False):
+        self.width = width
+        self.envelope = envelope
+        self.ctimes = None
+        self.values = None
+        self.lows = None
+        self.highs = None
+
+    def add(self, ctimes, values, lows=None, highs=None):
+        """ Return the buckets completed by a batch of rows.  Rows read from
+        rollups pass the lowest and highest values each row stands for in
+        lows and highs.
+        """
+        if lows is None:
+            lows = values
+        if highs is None:
+            highs = values
+        if self.ctimes is not None:
+            ctimes = numpy.concatenate((self.ctimes, ctimes))
+            values = numpy.vstack((self.values, values))
+            lows = numpy.vstack((self.lows, lows))
+            highs = numpy.vstack((self.highs, highs))
+        if len(ctimes) == 0:
+            return ctimes, values
+
+        buckets = ctimes // self.width
+        i = numpy.searchsorted(buckets, buckets[-1])
+        self.ctimes = ctimes[i:]
+        self.values = values[i:]
+        self.lows = lows[i:]
+        self.highs = highs[i:]
+        return self.reduce(ctimes[:i], values[:i], lows[:i], highs[:i])
+
+    def flush(self):
+        """ Return the last bucket. """
+        if self.ctimes is None:
+            return numpy.array([]), numpy.zeros((0, 0))
+        ctimes, values = self.reduce(self.ctimes, self.values, self.lows,
+                self.highs)
+        self.ctimes = None
+        return ctimes, values
+
+    def reduce(self, ctimes, values, lows, highs):
+        if len(ctimes) == 0:
+            columns = values.shape[1]
+            if self.envelope:
+                columns *= 3
+            return ctimes, numpy.zeros((0, columns))
+
+        buckets = ctimes // self.width
+        starts = numpy.flatnonzero(
+                numpy.concatenate(([True], buckets[1:] != buckets[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(ctimes)))
+        reduced = [numpy.add.reduceat(values, starts) / counts[:, None]]
+        if self.envelope:
+            reduced.append(numpy.minimum.reduceat(lows, starts))
+            reduced.append(numpy.maximum.reduceat(highs, starts))
+        return buckets[starts] * self.width, numpy.hstack(reduced)
+
+
+class Across(object):
+    """ Aggregate the bucketed values of the hosts of a series per bucket.
+
+    The buckets of every host start at the same multiples of their width, so
+    the values of the hosts for a bucket share its timestamp.  Hosts without
+    a value for a bucket are left out of its aggregates.
+    """
+    def __init__(self, functions):
+        self.functions = functions
+        self.hosts = 0
+        self.ctimes = []
+        self.values = []
+        self.indexes = []
+
+    def start(self):
+        """ Start adding the values of the next host. """
+        self.hosts += 1
+
+    def add(self, ctimes, values):
+        self.ctimes.append(ctimes)
+        self.values.append(values)
+        self.indexes.append(numpy.repeat(self.hosts - 1, len(ctimes)))
+
+    def reduce(self):
+        """ Return the timestamps and a 2-D array of the aggregates, each
+        function taking a column per value.
+        """
+        if not self.ctimes:
+            return numpy.array([]), numpy.zeros((0, 0))
+        values = numpy.vstack(self.values)
+        ctimes, rows = numpy.unique(numpy.concatenate(self.ctimes),
+                                    return_inverse=True)
+        grid = numpy.full((len(ctimes), self.hosts, values.shape[1]),
+                          numpy.nan)
+        grid[rows, numpy.concatenate(self.indexes)] = values
+
+        reduced = []
+        with warnings.catch_warnings():
+            # All the hosts missing a value aggregate to NaN, a gap, and
+            # not to the 0 nansum() gives them.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for function in self.functions:
+                if function == 'sum':
+                    reduced.append(numpy.where(
+                            numpy.isnan(grid).all(axis=1), numpy.nan,
+                            numpy.nansum(grid, axis=1)))
+                elif function == 'avg':
+                    reduced.append(numpy.nanmean(grid, axis=1))
+                elif function == 'min':
+                    reduced.append(numpy.nanmin(grid, axis=1))
+                elif function == 'max':
+                    reduced.append(numpy.nanmax(grid, axis=1))
+                else:
+                    reduced.append(numpy.nanpercentile(grid,
+                            int(function[1:]), axis=1))
+        return ctimes, numpy.hstack(reduced)
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .series import (
+    Batch,
+    key,
+    specs,
+    )
+
+log = logging.getLogger(__name__)
+
+
+class Prewarmer(object):
+    """ Keep the chart data of the most viewed dashboards ready ahead of time.
+
+    Every interval seconds the size most viewed dashboards of the last day are
+    looked up, and a pool of workers computes the data of the ones about to
+    go stale again.  Opening one of those dashboards, on a wall display for
+    example, is then served from memory instead of querying the database.
+    The data of a dashboard is served for its refresh seconds after it was
+    computed.
+    """
+    def __init__(self):
+        self.engine = None
+        self.settings = {}
+        self.size = 10
+        self.interval = 10
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = set()
+        self.pool = None
+        self.thread = None
+
+    def configure(self, engine, settings, size=10, workers=2, interval=10):
+        self.engine = engine
+        self.settings = settings
+        self.size = size
+        self.interval = interval
+        if self.thread is None:
+            self.pool = ThreadPool(workers)
+            self.thread = threading.Thread(target=self.run, name='prewarmer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.schedule()
+            except Exception:
+                log.exception('scheduling the dashboards failed')
+            time.sleep(self.interval)
+
+    def schedule(self):
+        connection = self.engine.connect()
+        try:
+            dashboards = connection.execute(text(
+                    "SELECT url_list, time_range, refresh " \
+                    "FROM dashboard " \
+                    "WHERE last_viewed > CURRENT_TIMESTAMP - " \
+                    "                    INTERVAL '1 DAY' " \
+                    "ORDER BY views DESC " \
+                    "LIMIT :size;"), {'size': self.size}).fetchall()
+        finally:
+            connection.close()
+
+        now = time.time()
+        keys = set()
+        for dashboard in dashboards:
+            # The chart reads its data in the binary format.
+            dashboard_key = key(specs(dashboard['url_list']),
+                                dashboard['time_range'], True)
+            keys.add(dashboard_key)
+            with self.lock:
+                entry = self.entries.get(dashboard_key)
+                if dashboard_key in self.pending or \
+                        (entry is not None and \
+                         entry[0] - self.interval > now):
+                    continue
+                self.pending.add(dashboard_key)
+            self.pool.apply_async(self.warm, (dashboard_key,
+                    dashboard['url_list'], dashboard['time_range'],
+                    dashboard['refresh']))
+
+        # Forget the data of the dashboards that are not popular any more.
+        with self.lock:
+            for dashboard_key in self.entries.keys():
+                if dashboard_key not in keys:
+                    del self.entries[dashboard_key]
+
+    def warm(self, dashboard_key, url_list, time_range, refresh):
+        session = Session(bind=self.engine)
+        connection = self.engine.connect()
+        try:
+            batch = Batch(session, specs(url_list), time_range, True,
+                          int(self.settings.get('yams.window_step', 60)))
+            body = ''.join(batch.stream(session, connection,
+                    self.settings.get('yams.max_points', 1000),
+                    int(self.settings.get('yams.batch_size', 1000))))
+            with self.lock:
+                self.entries[dashboard_key] = (time.time() + refresh,
+                        batch.etag, batch.newest,
+                        batch.stream_class.content_type, body)
+        except Exception:
+            log.exception('prewarming a dashboard failed')
+        finally:
+            # The stream only closes the connection once it read every row.
+            if not connection.closed:
+                connection.close()
+            session.close()
+            with self.lock:
+                self.pending.discard(dashboard_key)
+
+    def lookup(self, key):
+        """ Return the entity tag, last modification time, content type and
+        body of the data kept ready under key, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1:]
+
+
+prewarmer = Prewarmer()
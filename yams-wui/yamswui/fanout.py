@@ -0,0 +1,232 @@
+import Queue
+import logging
+import threading
+
+from collections import deque
+from datetime import datetime
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import text
+
+from .partitions import (
+    parse,
+    utc,
+    )
+
+log = logging.getLogger(__name__)
+
+# Batches of rows each slice reads ahead of the stream.
+DEPTH = 4
+
+# Seconds between checks of whether a stream was closed by a slice waiting
+# for it to take its rows.
+POLL = 1
+
+
+def split(tables, slices):
+    """ Return the partitions of a query split into at most slices runs of
+    consecutive days, as (start of the first day, partitions), or an empty
+    list if they only cover a single day.
+    """
+    days = {}
+    for table in tables:
+        days.setdefault(parse(table)[1], []).append(table)
+    days = sorted(days.items())
+    count = min(slices, len(days))
+    if count < 2:
+        return []
+    parts = []
+    for i in range(count):
+        run = days[len(days) * i // count:len(days) * (i + 1) // count]
+        parts.append((datetime.strptime(run[0][0], '%Y%m%d').replace(
+                              tzinfo=utc),
+                      [table for day, day_tables in run \
+                       for table in day_tables]))
+    return parts
+
+
+def bounded(parts, params):
+    """ Return the parameters of the query of each part, reading from the
+    start of its first day up to the start of the next part.  The first and
+    last parts keep the start and end of the query as a whole.
+    """
+    bounds = []
+    for i, (start, tables) in enumerate(parts):
+        part_params = dict(params)
+        if i > 0:
+            part_params['time_dt'] = start
+        if i + 1 < len(parts):
+            part_params['end_dt'] = parts[i + 1][0]
+        bounds.append(part_params)
+    return bounds
+
+
+class FanOut(object):
+    """ Read the queries of charts over several days a run of days at a
+    time, each slice on a pooled connection of its own, so that PostgreSQL
+    works on them with as many backends instead of one.
+
+    At most threads slices are read at a time in this process.  A query is
+    only split when every one of its slices can start right away, since its
+    rows are taken from all of them at once, and it is read as a whole as
+    usual otherwise.
+    """
+    def __init__(self):
+        self.engine = None
+        self.slices = 0
+        self.free = 0
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def configure(self, engine, threads=0, slices=4):
+        self.engine = engine
+        if threads < 2 or slices < 2:
+            return
+        self.slices = slices
+        self.free = threads
+        if self.pool is None:
+            self.pool = ThreadPool(threads)
+
+    def take(self, count):
+        with self.lock:
+            if self.pool is None or count > self.free:
+                return False
+            self.free -= count
+            return True
+
+    def release(self):
+        with self.lock:
+            self.free += 1
+
+    def read(self, slices, batch_size, timeout):
+        """ Start reading slices, a list of (sql, params), and return their
+        rows stitched together, or None if they cannot all start now.
+        """
+        if not self.take(len(slices)):
+            return None
+        return Stitched(self, slices, batch_size, timeout)
+
+
+class Stitched(object):
+    """ The rows of the slices of a query, read at the same time, in the
+    order of the query as a whole: by host, then time.  Each slice is
+    ordered the same way and only holds rows later than the slice before
+    it, so the rows of a host are its rows from each slice in turn, and its
+    rates carry on from one slice to the next as if it were read at once.
+
+    Like the result of a query, the rows are read with fetchmany() and the
+    reading is stopped with close(), which cancels the slices still running.
+    """
+    def __init__(self, fanout, slices, batch_size, timeout):
+        self.fanout = fanout
+        self.queues = [Queue.Queue(DEPTH) for part in slices]
+        # The runs of rows of each slice taken from its queue.
+        self.rows = [deque() for part in slices]
+        self.done = [False for part in slices]
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.reading = {}
+        self.host = None
+        self.index = 0
+        for i, (sql, params) in enumerate(slices):
+            fanout.pool.apply_async(self.read,
+                                    (i, sql, params, batch_size, timeout))
+
+    def read(self, i, sql, params, batch_size, timeout):
+        try:
+            connection = self.fanout.engine.connect()
+            try:
+                with self.lock:
+                    if self.stopped.is_set():
+                        return
+                    # The DBAPI connection underneath has the cancel handle.
+                    self.reading[i] = connection.connection.connection
+                # The statements of a slice time out with those of the
+                # stream it is read for.
+                connection.execute(text(
+                        "SELECT set_config('statement_timeout', :timeout, " \
+                        "                  true);"), {'timeout': timeout})
+                result = connection.execution_options(
+                        stream_results=True).execute(text(sql), params)
+                while True:
+                    rows = result.fetchmany(batch_size)
+                    # Hand the rows over as runs of the same host, so that
+                    # the stream takes them a run at a time.
+                    runs = [[host, list(host_rows)] for host, host_rows \
+                            in groupby(rows, lambda row: row['host'])]
+                    if not self.put(i, runs) or not runs:
+                        break
+            finally:
+                with self.lock:
+                    self.reading.pop(i, None)
+                connection.close()
+        except Exception as e:
+            self.put(i, e)
+        finally:
+            self.fanout.release()
+
+    def put(self, i, item):
+        """ Hand over the next runs of a slice, an empty list once it is done
+        or what stopped it, and return whether the stream still wants them.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queues[i].put(item, timeout=POLL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def head(self, i):
+        """ Return the host of the next run of rows of a slice, waiting for
+        it to be read, or None once the slice is done.
+        """
+        while not self.rows[i]:
+            if self.done[i]:
+                return None
+            item = self.queues[i].get()
+            if isinstance(item, Exception):
+                self.done[i] = True
+                raise item
+            if not item:
+                self.done[i] = True
+            self.rows[i].extend(item)
+        return self.rows[i][0][0]
+
+    def fetchmany(self, size):
+        rows = []
+        while len(rows) < size:
+            if self.host is None:
+                # Start on the first host of the slices that are left.
+                hosts = [host for host in [self.head(i) \
+                         for i in range(len(self.rows))] if host is not None]
+                if not hosts:
+                    break
+                self.host = min(hosts)
+                self.index = 0
+            if self.head(self.index) == self.host:
+                run = self.rows[self.index][0]
+                taken = run[1][:size - len(rows)]
+                rows.extend(taken)
+                if len(taken) < len(run[1]):
+                    run[1] = run[1][len(taken):]
+                else:
+                    self.rows[self.index].popleft()
+            elif self.index + 1 < len(self.rows):
+                self.index += 1
+            else:
+                self.host = None
+        return rows
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            for connection in self.reading.values():
+                try:
+                    connection.cancel()
+                except Exception:
+                    log.exception('cancelling a slice failed')
+
+
+fanout = FanOut()
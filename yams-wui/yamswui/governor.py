@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+
+from pyramid.threadlocal import get_current_request
+
+from sqlalchemy import event
+
+from .metrics import route
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks for browsers gone away from their streams.
+INTERVAL = 1
+
+
+def timeouts(settings):
+    """ Return the statement timeouts of each route in milliseconds, with the
+    timeout of the routes not named under None.
+    """
+    prefix = 'yams.statement_timeout.'
+    milliseconds = {None: int(settings.get('yams.statement_timeout', 0))}
+    for key, value in settings.items():
+        if key.startswith(prefix):
+            milliseconds[key[len(prefix):]] = int(value)
+    return milliseconds
+
+
+class Governor(object):
+    """ Bound what the charts can take from the database, so that a few of
+    them over long time ranges cannot hold up everyone else.
+
+    At most slots streams read their rows from the database at a time in
+    this process.  The others wait up to wait seconds for a slot and are
+    turned away after that, to be retried after retry_after seconds.  The
+    statements of each route are cancelled by PostgreSQL after its timeout,
+    and the query of a stream is cancelled once the server tells that the
+    browser has gone away.
+    """
+    def __init__(self):
+        self.slots = 0
+        self.busy = 0
+        self.wait = 0
+        self.retry_after = 5
+        self.timeouts = {None: 0}
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.thread = None
+
+    def configure(self, session, slots=0, wait=0, retry_after=5,
+            timeouts=None):
+        self.slots = slots
+        self.wait = wait
+        self.retry_after = retry_after
+        self.timeouts = timeouts or {None: 0}
+        if self.thread is None:
+            event.listen(session, 'after_begin', self.after_begin)
+            self.thread = threading.Thread(target=self.run, name='governor')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def timeout(self, route):
+        return self.timeouts.get(route, self.timeouts[None])
+
+    def limit(self, connection, route):
+        """ Have the statements of the current transaction on connection
+        cancelled after the timeout of route.
+        """
+        milliseconds = self.timeout(route)
+        if milliseconds > 0:
+            connection.execute('SET LOCAL statement_timeout = %d;' % \
+                               milliseconds)
+
+    def after_begin(self, session, transaction, connection):
+        request = get_current_request()
+        if request is not None:
+            self.limit(connection, route(request))
+
+    def admit(self):
+        """ Take a slot for a stream, waiting up to wait seconds for one, and
+        return whether one was taken.
+        """
+        if self.slots <= 0:
+            return True
+        deadline = time.time() + self.wait
+        with self.condition:
+            while self.busy >= self.slots:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                self.condition.wait(left)
+            self.busy += 1
+        return True
+
+    def release(self):
+        with self.condition:
+            if self.busy > 0:
+                self.busy -= 1
+                self.condition.notify()
+
+    def watch(self, connection, disconnected):
+        """ Cancel what the DBAPI connection is executing as soon as
+        disconnected() is true.
+        """
+        with self.lock:
+            self.watched[connection] = disconnected
+
+    def unwatch(self, connection):
+        with self.lock:
+            self.watched.pop(connection, None)
+
+    def run(self):
+        while True:
+            # Hold the lock while cancelling, so that a connection is never
+            # cancelled after it went back to the pool.
+            with self.lock:
+                for connection, disconnected in self.watched.items():
+                    try:
+                        if disconnected():
+                            log.info('the browser went away, cancelling '
+                                     'its query')
+                            del self.watched[connection]
+                            connection.cancel()
+                    except Exception:
+                        log.exception('cancelling a query failed')
+            time.sleep(INTERVAL)
+
+
+class Governed(object):
+    """ Iterate over the body of a streamed response read on connection,
+    cancelling its queries if the browser goes away, and give back the slot
+    of the stream, if it was given one, once the server is done with it.
+    """
+    def __init__(self, app_iter, governor, connection, disconnected=None,
+            admitted=False):
+        self.app_iter = app_iter
+        self.governor = governor
+        # The DBAPI connection underneath, which has the cancel handle.
+        self.connection = connection.connection.connection
+        self.disconnected = disconnected
+        self.admitted = admitted
+
+    def __iter__(self):
+        if self.disconnected is not None:
+            self.governor.watch(self.connection, self.disconnected)
+        try:
+            for chunk in self.app_iter:
+                yield chunk
+        finally:
+            self.governor.unwatch(self.connection)
+
+    def close(self):
+        self.governor.unwatch(self.connection)
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.admitted:
+                self.admitted = False
+                self.governor.release()
+
+
+governor = Governor()
@@ -0,0 +1,104 @@
+from datetime import (
+    datetime,
+    timedelta,
+    )
+
+from .partitions import (
+    quote,
+    utc,
+    )
+
+# The columns of value_list in the order they are copied.
+COLUMNS = '(time, interval, host, plugin, plugin_instance, type, ' \
+        'type_instance, dsnames, dstypes, values, meta)'
+
+# The indexes yams-etl creates on a new partition, by plugin.
+INDEXES = {
+    'cpu': ['(time, host, type_instance, plugin_instance)'],
+    'postgresql': ['(time, host)'] + \
+            ["((meta->'%s')) WHERE ((meta -> '%s') IS NOT NULL)" % (key, key) \
+             for key in ('database', 'schema', 'table', 'index')],
+    }
+
+
+def create(connection, table, plugin, type, day):
+    """ Create a partition the way yams-etl does, if it does not exist yet,
+    and return whether it was created.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 " \
+                   "FROM pg_tables " \
+                   "WHERE schemaname = 'collectd' " \
+                   "  AND tablename = %s;", (table,))
+    if cursor.fetchone() is not None:
+        return False
+
+    cursor.execute("CREATE TABLE collectd.%s (" \
+                   "    CHECK (time >= %%s::TIMESTAMP AT TIME ZONE 'UTC' " \
+                   "       AND time < %%s::TIMESTAMP AT TIME ZONE 'UTC'), " \
+                   "    CHECK (plugin = %%s)" \
+                   ") INHERITS (collectd.value_list);" % quote(table),
+                   (day.strftime('%Y-%m-%d'),
+                    (day + timedelta(days=1)).strftime('%Y-%m-%d'), plugin))
+    if plugin == 'postgresql':
+        cursor.execute("ALTER TABLE collectd.%s ADD CHECK (type = %%s);" % \
+                       quote(table), (type,))
+    return True
+
+
+def index(connection, table, plugin):
+    """ Create the indexes yams-etl creates on a new partition. """
+    cursor = connection.cursor()
+    for columns in INDEXES.get(plugin, ['(time, host)']) + ['(host)']:
+        cursor.execute('CREATE INDEX ON collectd.%s %s;' % (quote(table),
+                                                            columns))
+
+
+def ensure(connection, table, plugin, type, day):
+    """ Create a partition and its indexes in a transaction of their own,
+    unless it exists.  Processes loading at the same time wait for each other
+    on a lock of the partition, so only the first one creates it.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', (table,))
+    if create(connection, table, plugin, type, day):
+        index(connection, table, plugin)
+    connection.commit()
+
+
+def escape(value):
+    """ Return a string escaped for the text format of COPY. """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def text_array(values):
+    return '{%s}' % ','.join(['"%s"' % value.replace('\\', '\\\\') \
+                              .replace('"', '\\"') for value in values])
+
+
+def float_array(values):
+    return '{%s}' % ','.join(['NULL' if value is None else repr(float(value)) \
+                              for value in values])
+
+
+def hstore(meta):
+    """ Return a dict as the text of an hstore. """
+    return ', '.join(['"%s"=>"%s"' % tuple([unicode(item) \
+            .replace('\\', '\\\\').replace('"', '\\"') \
+            for item in pair]) for pair in sorted(meta.items())])
+
+
+def line(time, interval, host, plugin, plugin_instance, type, type_instance,
+         dsnames, dstypes, values, meta=None):
+    """ Return a value list as a line of COPY value_list COLUMNS FROM STDIN,
+    with the time truncated to the second like yams-etl does.
+    """
+    fields = [datetime.fromtimestamp(int(time), utc) \
+                      .strftime('%Y-%m-%d %H:%M:%S+00'),
+              str(int(interval)), host, plugin, plugin_instance, type,
+              type_instance, text_array(dsnames), text_array(dstypes),
+              float_array(values), hstore(meta or {})]
+    return '\t'.join([escape(field) for field in fields]) + '\n'
@@ -0,0 +1,215 @@
+import json
+import logging
+import select
+import threading
+import time
+
+from Queue import (
+    Empty,
+    Full,
+    Queue,
+    )
+
+import numpy
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from .compute import Rates
+
+log = logging.getLogger(__name__)
+
+# The channel yams-etl --notify sends each value list it loads on.
+CHANNEL = 'yams_value_list'
+
+
+class Listener(object):
+    """ Listen for the value lists loaded by yams-etl on one connection per
+    process and hand each of them to every subscriber that charts it.
+
+    Subscribers get the value lists through a queue of their own.  A
+    subscriber that falls more than size value lists behind is dropped and
+    has to reconnect.
+    """
+    def __init__(self):
+        self.engine = None
+        self.size = 1000
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+
+    def configure(self, engine, size=1000):
+        self.engine = engine
+        self.size = size
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='live')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                log.exception('listening for value lists failed')
+            time.sleep(5)
+
+    def listen(self):
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN %s;' % CHANNEL)
+            while True:
+                if select.select([dbapi_connection], [], [], 60) == \
+                        ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    try:
+                        value_list = json.loads(notify.payload)
+                    except ValueError:
+                        log.warning('ignoring value list %r', notify.payload)
+                        continue
+                    self.publish(value_list)
+        finally:
+            # Do not hand a connection in LISTEN mode back to the pool.
+            connection.invalidate()
+
+    def publish(self, value_list):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            if subscriber.wants(value_list):
+                try:
+                    subscriber.queue.put_nowait(value_list)
+                except Full:
+                    log.warning('dropping a subscriber that fell behind')
+                    self.unsubscribe(subscriber)
+                    subscriber.queue = None
+
+    def subscribe(self, specs):
+        subscriber = Subscriber(specs, Queue(self.size))
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+
+class Subscriber(object):
+    """ The series one browser charts live, as a list of (plugin, hosts,
+    params) like the urls of the chart.
+    """
+    def __init__(self, specs, queue):
+        # The percentages need the totals of all the hosts at the same time,
+        # those series are left to refresh with data.csv?since instead.
+        self.specs = [(plugin, set(hosts), params) \
+                      for plugin, hosts, params in specs \
+                      if params.get('percentage') != '1']
+        self.queue = queue
+        self.rates = {}
+
+    def match(self, value_list):
+        """ Return the params of the first series the value list belongs to,
+        or None.
+        """
+        for plugin, hosts, params in self.specs:
+            if value_list.get('plugin') != plugin or \
+                    value_list.get('host') not in hosts:
+                continue
+            if any([key in params and value_list.get(key) != params[key] \
+                    for key in ('plugin_instance', 'type', 'type_instance')]):
+                continue
+            # A value list too long to be sent whole comes without its meta
+            # data, and is taken for any of the series of its identity.
+            meta = value_list.get('meta') or {}
+            if not value_list.get('truncated') and \
+                    any([meta.get(key) != params.get(key) \
+                         for key in params.getall('meta')]):
+                continue
+            return params
+        return None
+
+    def wants(self, value_list):
+        return self.match(value_list) is not None
+
+    def points(self, value_list):
+        """ Return the labels and values plotted for a value list, or None if
+        it only seeds the rates of its series.  A value list too long to be
+        sent whole only tells the browser to read the chart again.
+        """
+        params = self.match(value_list)
+        if params is None:
+            return None
+        if value_list.get('truncated'):
+            return {'refresh': True}
+
+        dsnames = value_list['dsnames']
+        if 'dsnames' in params:
+            wanted_dsnames = params.getall('dsnames')
+        else:
+            wanted_dsnames = dsnames
+        indexes = [i for i in range(len(dsnames)) \
+                   if dsnames[i] in wanted_dsnames]
+        if not indexes:
+            return None
+
+        prefix = value_list['plugin']
+        if value_list.get('plugin_instance'):
+            prefix += '.' + value_list['plugin_instance']
+        prefix += '.' + value_list['type']
+        if value_list.get('type_instance'):
+            prefix += '.' + value_list['type_instance']
+        labels = ['%s.%s.%s' % (value_list['host'].replace('.', '_'), prefix,
+                                dsnames[i]) for i in indexes]
+
+        # Each series keeps its own rates, the very first value list of a
+        # series only seeds them like the first row of data.csv does.
+        key = tuple(labels)
+        if key not in self.rates:
+            self.rates[key] = Rates(value_list['dstypes'], indexes)
+        ctime_ms = int(float(value_list['time']) * 1000)
+        ctimes, values = self.rates[key].compute(numpy.array([ctime_ms]),
+                numpy.array([value_list['values']], dtype=numpy.float64))
+        if len(ctimes) == 0:
+            return None
+        return {'ctime_ms': ctime_ms, 'labels': labels,
+                'values': [None if numpy.isnan(value) else value \
+                           for value in values[0].tolist()]}
+
+
+class EventStream(object):
+    """ Iterate over the points of a subscriber as Server-Sent Events, with a
+    comment every keepalive seconds so a browser that went away is noticed.
+    """
+    def __init__(self, listener, subscriber, keepalive):
+        self.listener = listener
+        self.subscriber = subscriber
+        self.keepalive = keepalive
+
+    def __iter__(self):
+        yield 'retry: 5000\n\n'
+        while True:
+            queue = self.subscriber.queue
+            if queue is None:
+                # The listener dropped the subscriber for falling behind.
+                break
+            try:
+                value_list = queue.get(timeout=self.keepalive)
+            except Empty:
+                yield ': keepalive\n\n'
+                continue
+            points = self.subscriber.points(value_list)
+            if points is not None:
+                yield 'data: %s\n\n' % json.dumps(points)
+        self.close()
+
+    def close(self):
+        self.listener.unsubscribe(self.subscriber)
+
+
+listener = Listener()
@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__ + '.slow')
+
+# The histograms kept per route, as (name, help, upper bounds of the buckets).
+HISTOGRAMS = [
+    ('yams_request_duration_seconds',
+     'Time from the request until the last byte of the response.',
+     (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    ('yams_request_sql_statements',
+     'SQL statements executed per request.',
+     (0, 1, 2, 5, 10, 20, 50, 100)),
+    ('yams_request_sql_duration_seconds',
+     'Time spent executing SQL statements per request.',
+     (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    ('yams_request_rows',
+     'Rows fetched from the database per request.',
+     (0, 10, 100, 1000, 10000, 100000, 1000000)),
+    ('yams_response_bytes',
+     'Bytes of the response body.',
+     (100, 1000, 10000, 100000, 1000000, 10000000)),
+    ]
+
+
+class Request(object):
+    """ What one request has cost so far. """
+    def __init__(self, route, path, keep_statements):
+        self.route = route
+        self.path = path
+        self.start = time.time()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        # The SQL executed and how long each statement took, only kept for
+        # the slow request log.
+        self.sql = [] if keep_statements else None
+
+
+class Metrics(object):
+    """ Histograms of the time, SQL statements, rows and bytes of the
+    requests of each route of this process, in the Prometheus text format.
+
+    The SQL is counted through the events of the engine, for the requests
+    being served by the thread executing it.  With slow set, the SQL of the
+    requests taking longer than slow seconds is logged.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.histograms = {}
+        self.slow = 0
+        self.engine = None
+
+    def configure(self, engine, slow=0):
+        self.slow = slow
+        if self.engine is None:
+            self.engine = engine
+            event.listen(engine, 'before_cursor_execute', self.before_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def current(self):
+        return getattr(self.local, 'request', None)
+
+    def begin(self, route, path):
+        self.local.request = Request(route, path, self.slow > 0)
+        return self.local.request
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        if self.current() is not None:
+            conn.info.setdefault('yams_start', []).append(time.time())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        request = self.current()
+        if request is None or not conn.info.get('yams_start'):
+            return
+        seconds = time.time() - conn.info['yams_start'].pop()
+        request.statements += 1
+        request.sql_seconds += seconds
+        # The rows of a named server-side cursor are only known as they are
+        # fetched, the code reading them counts those with fetched().
+        if getattr(cursor, 'name', None) is None and \
+                cursor.description is not None and cursor.rowcount > 0:
+            request.rows += cursor.rowcount
+        if request.sql is not None:
+            request.sql.append((seconds, statement))
+
+    def fetched(self, rows, seconds):
+        """ Count rows fetched from a named cursor in seconds. """
+        request = self.current()
+        if request is not None:
+            request.rows += rows
+            request.sql_seconds += seconds
+
+    def finish(self, request):
+        """ Add a finished request to the histograms, and log it if it was
+        slow.
+        """
+        seconds = time.time() - request.start
+        if getattr(self.local, 'request', None) is request:
+            self.local.request = None
+
+        values = [seconds, request.statements, request.sql_seconds,
+                  request.rows, request.bytes]
+        with self.lock:
+            for (name, help, bounds), value in zip(HISTOGRAMS, values):
+                counts, total = self.histograms.get((name, request.route),
+                        ([0] * (len(bounds) + 1), 0))
+                for i, bound in enumerate(bounds):
+                    if value <= bound:
+                        counts[i] += 1
+                counts[-1] += 1
+                self.histograms[(name, request.route)] = (counts,
+                                                          total + value)
+
+        if self.slow > 0 and seconds >= self.slow:
+            log.warning('%s took %.3fs, %d SQL statements %.3fs, %d '
+                    'rows, %d bytes%s', request.path, seconds,
+                    request.statements, request.sql_seconds, request.rows,
+                    request.bytes, ''.join(['\n  %.3fs %s' % (sql_seconds,
+                            ' '.join(statement.split())) \
+                            for sql_seconds, statement in request.sql]))
+
+    def export(self):
+        """ Return the histograms in the Prometheus text format. """
+        lines = []
+        with self.lock:
+            for name, help, bounds in HISTOGRAMS:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s histogram' % name)
+                for (histogram, route), (counts, total) in \
+                        sorted(self.histograms.items()):
+                    if histogram != name:
+                        continue
+                    for bound, count in zip(list(bounds) + ['+Inf'], counts):
+                        lines.append('%s_bucket{route="%s",le="%s"} %d' % (
+                                name, route, bound, count))
+                    lines.append('%s_sum{route="%s"} %r' % (name, route,
+                                                            float(total)))
+                    lines.append('%s_count{route="%s"} %d' % (name, route,
+                                                              counts[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class Measured(object):
+    """ Iterate over the body of a response, counting its bytes, and finish
+    the measurement of the request once the server is done with it.
+    """
+    def __init__(self, app_iter, metrics, request):
+        self.app_iter = app_iter
+        self.metrics = metrics
+        self.request = request
+
+    def __iter__(self):
+        # The body of a streamed response is read from the database while the
+        # server iterates over it, count that as part of the request.
+        self.metrics.local.request = self.request
+        for chunk in self.app_iter:
+            self.request.bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.metrics.finish(self.request)
+
+
+def tween_factory(handler, registry):
+    """ Measure every request but the ones for the metrics themselves. """
+    def tween(request):
+        if request.path == '/metrics':
+            return handler(request)
+
+        measured = metrics.begin(None, request.path_qs)
+        try:
+            response = handler(request)
+        except:
+            measured.route = route(request)
+            metrics.finish(measured)
+            raise
+        measured.route = route(request)
+
+        # Replacing the body would drop the length it was given.
+        length = response.content_length
+        response.app_iter = Measured(response.app_iter, metrics, measured)
+        response.content_length = length
+        return response
+
+    return tween
+
+
+def route(request):
+    if getattr(request, 'matched_route', None) is not None:
+        return request.matched_route.name
+    return 'none'
+
+
+metrics = Metrics()
@@ -0,0 +1,62 @@
+import re
+
+from datetime import timedelta
+
+from psycopg2.tz import FixedOffsetTimezone
+
+# The ETL partitions value_list by day into tables named
+# vl_<plugin>_<YYYYMMDD>, and the postgresql plugin further by type into
+# tables named vl_postgresql_<YYYYMMDD>_<type>.
+PARTITION = re.compile(r'^vl_(.+?)_(\d{8})(?:_(.+))?$')
+
+# The days of the partitions start and end at midnight UTC.
+utc = FixedOffsetTimezone(offset=0, name='UTC')
+
+
+def parse(tablename):
+    """ Return the plugin, day and type a partition holds data for, or None
+    if the table is not a partition.  The type is None for all but the
+    postgresql plugin.
+    """
+    match = PARTITION.match(tablename)
+    if match is None:
+        return None
+    return match.groups()
+
+
+def name(plugin, day, type=None):
+    """ Return the name of the partition of a plugin for a day. """
+    if plugin == 'postgresql':
+        return 'vl_%s_%s_%s' % (plugin, day.strftime('%Y%m%d'), type)
+    return 'vl_%s_%s' % (plugin, day.strftime('%Y%m%d'))
+
+
+def resolve(plugin, start, end, type=None, existing=()):
+    """ Return the names of the existing partitions that hold the data of a
+    plugin between start and end, oldest first.  Without a type all the
+    types of the postgresql plugin are included.
+    """
+    tables = []
+    day = start.astimezone(utc).date()
+    while day <= end.astimezone(utc).date():
+        if plugin == 'postgresql' and type is None:
+            prefix = 'vl_postgresql_%s_' % day.strftime('%Y%m%d')
+            tables.extend(sorted([table for table in existing \
+                                  if table.startswith(prefix)]))
+        elif name(plugin, day, type) in existing:
+            tables.append(name(plugin, day, type))
+        day += timedelta(days=1)
+    return tables
+
+
+def quote(table):
+    """ Return the name of a table quoted for use in SQL. """
+    return '"%s"' % table.replace('"', '""')
+
+
+def union(tables):
+    """ Return a subquery that reads the given partitions in place of
+    value_list, in the order given.
+    """
+    return '(%s)' % ' UNION ALL '.join(['SELECT * FROM %s' % quote(table) \
+                                        for table in tables])
@@ -0,0 +1,143 @@
+from .partitions import union
+from .rollups import (
+    IDENTITY,
+    choose_tier,
+    epoch,
+    source as rollup_source,
+    watermark,
+    )
+from .statements import execute
+
+# What the series can be ranked by.
+MEASURES = ('avg', 'max', 'rate')
+
+# What the series can be grouped by, in the order of their columns.
+GROUPS = ('host', 'plugin_instance', 'type_instance')
+
+# Rows wanted per series in the window, the rollup tier read is the coarsest
+# one still giving this many.
+POINTS = 100
+
+# The value of a group for each measure.  The average is weighted by the
+# value lists behind each row, and the rate is the increase of every series
+# of the group per second, leaving out the drops of counters wrapping or
+# being reset.
+MEASURE = {
+        'avg': 'sum(value * samples) / sum(samples)',
+        'max': 'max(high)',
+        'rate': 'sum(GREATEST(change, 0)) / :seconds'}
+
+RANK = \
+        "SELECT %(columns)s, %(measure)s AS value " \
+        "FROM (SELECT %(columns)s, " \
+        "             values[:index] AS value, " \
+        "             %(high)s AS high, " \
+        "             %(samples)s AS samples, " \
+        "             %(change)s AS change " \
+        "      FROM %(source)s AS value_list " \
+        "      WHERE plugin = :plugin " \
+        "        AND type = :type " \
+        "        AND time >= :time_dt " \
+        "        AND time < :end_dt " \
+        "        %(where)s) AS a " \
+        "GROUP BY %(columns)s " \
+        "HAVING %(measure)s IS NOT NULL " \
+        "ORDER BY value DESC, %(columns)s " \
+        "LIMIT :n;"
+
+
+def groups(params):
+    """ Return the columns to group the series by, asked for like
+    group=host,plugin_instance, by host if none are.
+    """
+    wanted = [column for value in params.getall('group') \
+              for column in value.split(',')]
+    return [column for column in GROUPS if column in wanted] or ['host']
+
+
+def rank(session, plugin, type, params, tables, time_dt, end_dt, n=10,
+        by='avg'):
+    """ Return the n groups of series of a type with the highest average,
+    maximum or rate of one of their data sources between time_dt and
+    end_dt, highest first, as dicts of the grouped columns and the value.
+    The series are grouped and filtered as params, the query string of a top
+    url, ask, and read in a single scan of the given partitions, or of the
+    coarsest rollup tier holding enough rows for the window.
+    """
+    columns = groups(params)
+    sql_params = {'plugin': plugin, 'type': type, 'time_dt': time_dt,
+                  'end_dt': end_dt, 'n': n,
+                  'seconds': max(epoch(end_dt) - epoch(time_dt), 1)}
+    if not tables:
+        return []
+
+    where_condition = ''
+    hosts = params.getall('host')
+    if hosts:
+        where_condition += ' AND host LIKE ANY(:host_patterns)'
+        sql_params['host_patterns'] = [host.replace('\\', '\\\\') \
+                .replace('%', '\\%').replace('_', '\\_').replace('*', '%') \
+                for host in hosts]
+
+    for column in ('plugin_instance', 'type_instance'):
+        if column in params:
+            where_condition += ' AND %s = :%s' % (column, column)
+            sql_params[column] = params[column]
+
+    if 'meta' in params:
+        for i, key in enumerate(params.getall('meta')):
+            where_condition += ' AND meta -> CAST(:meta_key_%d AS TEXT) = ' \
+                    ':meta_value_%d' % (i, i)
+            sql_params['meta_key_%d' % i] = key
+            sql_params['meta_value_%d' % i] = params.get(key)
+
+    # The data sources are the same for every series of a type.
+    connection = session.connection()
+    result = execute(connection,
+            "SELECT dsnames, dstypes " \
+            "FROM series " \
+            "WHERE plugin = :plugin " \
+            "  AND type = :type " \
+            "  AND last_seen >= :time_dt " \
+            "LIMIT 1;", sql_params).first()
+    if not result:
+        result = execute(connection,
+                "SELECT dsnames, dstypes " \
+                "FROM %s AS value_list " \
+                "WHERE plugin = :plugin " \
+                "  AND type = :type " \
+                "LIMIT 1;" % union(reversed(tables)), sql_params).first()
+    if not result:
+        return []
+    dsname = params.get('dsname', result['dsnames'][0])
+    if dsname not in result['dsnames']:
+        return []
+    sql_params['index'] = result['dsnames'].index(dsname) + 1
+
+    tier = choose_tier(sql_params['seconds'] / POINTS)
+    if tier is not None:
+        sql_params['watermark'] = watermark(connection, tier[0])
+        if sql_params['watermark'] is None or \
+                sql_params['watermark'] <= time_dt:
+            tier = None
+
+    source = union(tables)
+    high = 'values[:index]'
+    samples = '1'
+    if tier is not None:
+        source = rollup_source(tier[0], result['dstypes'], source)
+        high = 'max[:index]'
+        samples = 'samples'
+
+    # Only rates need the rows before, taken per series.
+    change = 'NULL::FLOAT8'
+    if by == 'rate':
+        change = 'values[:index] - lag(values[:index]) ' \
+                 'OVER (PARTITION BY %s ORDER BY time)' % IDENTITY
+
+    sql = RANK % {'columns': ', '.join(columns), 'measure': MEASURE[by],
+                  'high': high, 'samples': samples, 'change': change,
+                  'source': source, 'where': where_condition}
+    return [dict([(column, row[column]) for column in columns] + \
+                 [('value', row['value'])]) \
+            for row in execute(connection, sql, sql_params)]
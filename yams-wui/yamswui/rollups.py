@@ -0,0 +1,399 @@
+import calendar
+import logging
+import time
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from .partitions import utc
+from .statements import execute
+
+log = logging.getLogger(__name__)
+
+# The rollup tiers from finest to coarsest as (tier, width in seconds, the
+# table the tier is aggregated from).  The 1 minute tier is aggregated from
+# the raw value lists, each of the other tiers from the tier before it.
+TIERS = [
+    ('1min', 60, 'value_list'),
+    ('15min', 900, 'rollup_1min'),
+    ('1hour', 3600, 'rollup_15min'),
+    ]
+
+# Roll up at most this many seconds of data per transaction.
+STEP = 86400
+
+# The "tier" whose watermark is the last time value lists loaded after the
+# fact were rolled up again, for the caches of the WUI to start over.
+BACKFILL = 'backfill'
+
+# Columns that identify a series.
+IDENTITY = 'host, plugin, plugin_instance, type, type_instance, dsnames, ' \
+        'dstypes, meta'
+
+# Aggregate each element of the values arrays separately by unnesting them
+# with generate_subscripts() and putting the arrays back together again.
+ROLLUP_RAW = \
+        "INSERT INTO rollup_%(tier)s " \
+        "            (time, %(identity)s, samples, min, max, avg, last) " \
+        "SELECT time, %(identity)s, max(samples), " \
+        "       array_agg(min ORDER BY i), array_agg(max ORDER BY i), " \
+        "       array_agg(avg ORDER BY i), array_agg(last ORDER BY i) " \
+        "FROM (" \
+        "    SELECT to_timestamp(floor(extract(EPOCH FROM time) / " \
+        "                              %(width)d) * %(width)d) AS time, " \
+        "           %(identity)s, i, count(*) AS samples, " \
+        "           min(values[i]) AS min, max(values[i]) AS max, " \
+        "           avg(values[i]) AS avg, " \
+        "           (array_agg(values[i] ORDER BY time DESC))[1] AS last " \
+        "    FROM value_list, generate_subscripts(values, 1) AS i " \
+        "    WHERE time >= :start " \
+        "      AND time < :end " \
+        "    GROUP BY 1, %(identity)s, i" \
+        ") AS a " \
+        "GROUP BY time, %(identity)s;"
+
+ROLLUP_TIER = \
+        "INSERT INTO rollup_%(tier)s " \
+        "            (time, %(identity)s, samples, min, max, avg, last) " \
+        "SELECT time, %(identity)s, max(samples), " \
+        "       array_agg(min ORDER BY i), array_agg(max ORDER BY i), " \
+        "       array_agg(avg ORDER BY i), array_agg(last ORDER BY i) " \
+        "FROM (" \
+        "    SELECT to_timestamp(floor(extract(EPOCH FROM time) / " \
+        "                              %(width)d) * %(width)d) AS time, " \
+        "           %(identity)s, i, sum(samples) AS samples, " \
+        "           min(min[i]) AS min, max(max[i]) AS max, " \
+        "           sum(avg[i] * samples) / sum(samples) AS avg, " \
+        "           (array_agg(last[i] ORDER BY time DESC))[1] AS last " \
+        "    FROM %(source)s, generate_subscripts(avg, 1) AS i " \
+        "    WHERE time >= :start " \
+        "      AND time < :end " \
+        "    GROUP BY 1, %(identity)s, i" \
+        ") AS a " \
+        "GROUP BY time, %(identity)s;"
+
+# Only the rows of the series with value lists between start and end are
+# replaced.  Once the partitions of a day are expired its rollups and totals
+# are the only copy left of its value lists, and rolling the day up again
+# must not delete them.
+SEEN = \
+        "AND (%(columns)s) IN (SELECT DISTINCT %(columns)s " \
+        "                      FROM value_list " \
+        "                      WHERE time >= :start " \
+        "                        AND time < :end)"
+
+# The columns of value_list the rollups and the totals are grouped by.
+SERIES_COLUMNS = "host, plugin, coalesce(plugin_instance, ''), type, " \
+        "coalesce(type_instance, ''), dsnames, dstypes, meta"
+TOTALS_COLUMNS = "plugin, coalesce(plugin_instance, ''), type"
+
+# Sum each element of the values arrays across the hosts and type instances of
+# each plugin instance and type at each time, for the percentage charts.
+TOTALS = \
+        "INSERT INTO plugin_totals " \
+        "            (time, plugin, plugin_instance, type, values) " \
+        "SELECT time, plugin, plugin_instance, type, " \
+        "       array_agg(sum ORDER BY i) " \
+        "FROM (" \
+        "    SELECT time, plugin, plugin_instance, type, i, " \
+        "           sum(values[i]) AS sum " \
+        "    FROM value_list, generate_subscripts(values, 1) AS i " \
+        "    WHERE time >= :start " \
+        "      AND time < :end " \
+        "    GROUP BY time, plugin, plugin_instance, type, i" \
+        ") AS a " \
+        "GROUP BY time, plugin, plugin_instance, type;"
+
+# Add the series seen in the value lists between start and end to the series
+# dictionary, and widen the times the ones already in it were seen between.
+# Only the rollups write to the dictionary, one run at a time, so the series
+# missing from it can simply be inserted.
+SERIES = \
+        "WITH seen AS (" \
+        "    SELECT %(identity)s, max(interval) AS interval, " \
+        "           min(time) AS first_seen, max(time) AS last_seen " \
+        "    FROM (SELECT time, interval, host, plugin, type, dsnames, " \
+        "                 dstypes, meta, " \
+        "                 coalesce(plugin_instance, '') AS plugin_instance, " \
+        "                 coalesce(type_instance, '') AS type_instance " \
+        "          FROM value_list " \
+        "          WHERE time >= :start " \
+        "            AND time < :end) AS value_list " \
+        "    GROUP BY %(identity)s" \
+        "), updated AS (" \
+        "    UPDATE series " \
+        "    SET interval = seen.interval, " \
+        "        first_seen = least(series.first_seen, seen.first_seen), " \
+        "        last_seen = greatest(series.last_seen, seen.last_seen) " \
+        "    FROM seen " \
+        "    WHERE (%(series)s) = (%(seen)s)" \
+        ") " \
+        "INSERT INTO series " \
+        "            (%(identity)s, interval, first_seen, last_seen) " \
+        "SELECT * " \
+        "FROM seen " \
+        "WHERE NOT EXISTS (SELECT 1 " \
+        "                  FROM series " \
+        "                  WHERE (%(series)s) = (%(seen)s));" % {
+                'identity': IDENTITY,
+                'series': ', '.join(['series.' + column.strip() \
+                                     for column in IDENTITY.split(',')]),
+                'seen': ', '.join(['seen.' + column.strip() \
+                                   for column in IDENTITY.split(',')])}
+
+# Read a tier as if it were value_list, with the rows that have not been
+# rolled up yet taken from value_list itself.  Gauges are represented by
+# their average and counters by their last value, with samples used to turn
+# the change in the last value into a change per value list again.
+SOURCE = \
+        "(SELECT time, %(identity)s, ARRAY[%(values)s] AS values, " \
+        "        min, max, samples " \
+        " FROM rollup_%(tier)s " \
+        " WHERE time < :watermark " \
+        " UNION ALL " \
+        " SELECT time, %(identity)s, values, values AS min, values AS max, " \
+        "        1 AS samples " \
+        " FROM %(raw)s AS value_list " \
+        " WHERE time >= :watermark)"
+
+# Read the totals as if they were value_list, with the times that have not
+# been summed up yet taken from value_list itself.
+TOTALS_SOURCE = \
+        "(SELECT time, plugin, plugin_instance, type, values " \
+        " FROM plugin_totals " \
+        " WHERE time < :totals_watermark " \
+        " UNION ALL " \
+        " SELECT time, plugin, plugin_instance, type, values " \
+        " FROM %(raw)s AS value_list " \
+        " WHERE time >= :totals_watermark)"
+
+
+def choose_tier(width):
+    """ Return the coarsest tier, as (tier, width in seconds), whose buckets
+    are no wider than width seconds, or None if the raw data is needed.
+    """
+    chosen = None
+    for tier, seconds, source in TIERS:
+        if seconds <= width:
+            chosen = (tier, seconds)
+    return chosen
+
+
+def source(tier, dstypes, raw='value_list'):
+    """ Return a subquery that reads a tier in place of value_list, with raw
+    read in place of value_list for the rows that are not rolled up yet.
+    """
+    values = []
+    for i, dstype in enumerate(dstypes):
+        if dstype in ('counter', 'derive'):
+            values.append('last[%d]' % (i + 1))
+        else:
+            values.append('avg[%d]' % (i + 1))
+    return SOURCE % {'tier': tier, 'identity': IDENTITY,
+                     'values': ', '.join(values), 'raw': raw}
+
+
+def totals_source(raw='value_list'):
+    """ Return a subquery that reads the totals in place of value_list, with
+    raw read in place of value_list for the times not summed up yet.
+    """
+    return TOTALS_SOURCE % {'raw': raw}
+
+
+def watermark(connection, tier):
+    """ Return the time up to which a tier has been rolled up. """
+    result = execute(connection,
+            "SELECT time " \
+            "FROM rollup_watermark " \
+            "WHERE tier = :tier;", {'tier': tier}).first()
+    if result:
+        return result['time']
+    return None
+
+
+def rollup(connection, tier, width, source, start, end, move=True):
+    """ Aggregate the source table into a tier between start and end, and
+    move the watermark of the tier up to end unless move is false.  Anything
+    already in that range of the tier is replaced, so a failed run can simply
+    be repeated.
+    """
+    columns = None
+    if source == 'value_list':
+        sql = ROLLUP_RAW
+        columns = SERIES_COLUMNS
+    else:
+        sql = ROLLUP_TIER
+
+    return replace(connection, tier, 'rollup_%s' % tier, sql % {'tier': tier,
+            'width': width, 'identity': IDENTITY, 'source': source}, start,
+            end, move, columns)
+
+
+def total(connection, start, end, move=True):
+    """ Sum the value lists between start and end into plugin_totals, and
+    move the watermark of the totals up to end unless move is false.
+    """
+    return replace(connection, 'totals', 'plugin_totals', TOTALS, start, end,
+            move, TOTALS_COLUMNS)
+
+
+def record(connection, start, end, move=True):
+    """ Add the series seen between start and end to the series dictionary,
+    and move the watermark of the dictionary up to end unless move is false.
+    """
+    params = {'start': start, 'end': end, 'tier': 'series'}
+    trans = connection.begin()
+    try:
+        count = connection.execute(text(SERIES), params).rowcount
+        if move:
+            advance(connection, params)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+    log.info('added %d series to the dictionary from %s to %s', count, start,
+            end)
+    return count
+
+
+def replace(connection, tier, table, sql, start, end, move=True,
+        columns=None):
+    """ Replace the rows of table between start and end with the ones sql
+    inserts, and move the watermark of tier up to end unless move is false,
+    in one transaction.  With the columns of value_list table is grouped by,
+    only the rows of the groups still having value lists between start and
+    end are replaced, the others are kept as they are.
+    """
+    params = {'start': start, 'end': end, 'tier': tier}
+    seen = ''
+    if columns is not None:
+        seen = SEEN % {'columns': columns}
+    trans = connection.begin()
+    try:
+        connection.execute(text(
+                "DELETE FROM %s " \
+                "WHERE time >= :start " \
+                "  AND time < :end " \
+                "  %s;" % (table, seen)), params)
+        count = connection.execute(text(sql), params).rowcount
+        if move:
+            advance(connection, params)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+    log.info('rolled up %d rows into %s from %s to %s', count, table, start,
+            end)
+    return count
+
+
+def advance(connection, params):
+    """ Move the watermark of params['tier'] up to params['end']. """
+    if connection.execute(text(
+            "UPDATE rollup_watermark " \
+            "SET time = :end " \
+            "WHERE tier = :tier;"), params).rowcount == 0:
+        connection.execute(text(
+                "INSERT INTO rollup_watermark (tier, time) " \
+                "VALUES (:tier, :end);"), params)
+
+
+def redo(connection, start, end):
+    """ Roll up the value lists between start and end, loaded after the fact,
+    again into each tier, the totals and the series dictionary, as far as
+    their watermarks.  The watermarks stay where they are, catch_up() rolls
+    up whatever is past them as usual, and the watermark of BACKFILL is
+    moved up to now.
+    """
+    for tier, width, source in TIERS:
+        mark = watermark(connection, tier)
+        if mark is not None and mark > start:
+            rollup(connection, tier, width, source, start, min(mark, end),
+                    False)
+
+    for tier, step in (('totals', total), ('series', record)):
+        mark = watermark(connection, tier)
+        if mark is not None and mark > start:
+            step(connection, start, min(mark, end), False)
+
+    trans = connection.begin()
+    try:
+        advance(connection, {'tier': BACKFILL, 'end': datetime.now(utc)})
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+
+def epoch(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def first(connection, source):
+    """ Return the time of the oldest data in the source of a tier. """
+    if source == 'value_list':
+        # The oldest daily partition is where the oldest data is.
+        day = connection.execute(text(
+                "SELECT min(substring(tablename, " \
+                "           'vl_.*?_(\d\d\d\d\d\d\d\d)')) AS day " \
+                "FROM pg_tables " \
+                "WHERE schemaname = 'collectd' " \
+                "  AND tablename LIKE 'vl\\_%';")).first()['day']
+        if day is None:
+            return None
+        return datetime.strptime(day, '%Y%m%d').replace(tzinfo=utc)
+
+    return connection.execute(text(
+            "SELECT min(time) AS time " \
+            "FROM %s;" % source)).first()['time']
+
+
+def catch_up(connection, delay):
+    """ Roll up everything that arrived since the last run into each tier in
+    turn, and into the totals.  Value lists are given delay seconds to arrive
+    before they are rolled up, anything arriving later than that is left out
+    of the rollups.
+    """
+    for tier, width, source in TIERS:
+        if source == 'value_list':
+            end = int(time.time()) - delay
+        else:
+            end = watermark(connection, source[len('rollup_'):])
+            if end is None:
+                break
+            end = epoch(end)
+        end = end // width * width
+
+        start = watermark(connection, tier)
+        if start is None:
+            start = first(connection, source)
+            if start is None:
+                continue
+        start = epoch(start) // width * width
+
+        while start < end:
+            stop = min(start + STEP, end)
+            rollup(connection, tier, width, source,
+                    datetime.fromtimestamp(start, utc),
+                    datetime.fromtimestamp(stop, utc))
+            start = stop
+
+    # The totals and the series dictionary are both taken from the raw value
+    # lists, with watermarks of their own.
+    end = int(time.time()) - delay
+    for tier, step in (('totals', total), ('series', record)):
+        start = watermark(connection, tier)
+        if start is None:
+            start = first(connection, 'value_list')
+            if start is None:
+                return
+        start = epoch(start)
+
+        while start < end:
+            stop = min(start + STEP, end)
+            step(connection, datetime.fromtimestamp(start, utc),
+                    datetime.fromtimestamp(stop, utc))
+            start = stop
@@ -0,0 +1,420 @@
+import argparse
+import csv
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+
+from cStringIO import StringIO
+from datetime import (
+    datetime,
+    timedelta,
+    )
+from xml.etree import cElementTree as ElementTree
+
+import numpy
+
+from sqlalchemy import (
+    create_engine,
+    engine_from_config,
+    )
+from sqlalchemy.pool import NullPool
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..ingest import (
+    COLUMNS,
+    ensure,
+    line,
+    )
+from ..partitions import (
+    name,
+    parse,
+    quote,
+    utc,
+    )
+from ..rollups import redo
+
+log = logging.getLogger(__name__)
+
+# Lines of COPY held in memory by each process before they are loaded.
+BATCH = 50000
+
+# The date the csv plugin of collectd ends its file names with.
+DATE = re.compile(r'-\d{4}-\d{2}-\d{2}$')
+
+# The end of the names of the partitions archived by expire_yams-wui_data.
+ARCHIVE = '.copy.gz'
+
+# The database connection of each process of the pool.
+connection = None
+
+
+def usage(argv):
+    cmd = argv[0]
+    print('usage: %s <config_uri> [--jobs N] [--format F] <file or '
+          'directory> ...\n'
+          '(example: "%s development.ini /var/lib/collectd/csv")' % (cmd,
+                                                                     cmd))
+    sys.exit(1)
+
+
+def identify(path, host=None):
+    """ Return the host, plugin, plugin instance, type and type instance of
+    the series in a file laid out like the csv and rrdtool plugins of
+    collectd lay them out, host/plugin[-instance]/type[-instance][-date].
+    """
+    directory, filename = os.path.split(os.path.abspath(path))
+    directory, plugin = os.path.split(directory)
+    if host is None:
+        host = os.path.basename(directory)
+    base, extension = os.path.splitext(filename)
+    if extension in ('.csv', '.rrd', '.xml'):
+        filename = base
+    filename = DATE.sub('', filename)
+    plugin, _, plugin_instance = plugin.partition('-')
+    type, _, type_instance = filename.partition('-')
+    return host, plugin, plugin_instance, type, type_instance
+
+
+def read_types(path):
+    """ Return the dsnames and dstypes of each type in a collectd types.db. """
+    types = {}
+    for entry in open(path):
+        fields = entry.split('#')[0].split(None, 1)
+        if len(fields) != 2:
+            continue
+        sources = [source.strip().split(':') \
+                   for source in fields[1].split(',')]
+        types[fields[0]] = ([source[0] for source in sources],
+                            [source[1].lower() for source in sources])
+    return types
+
+
+def read_json(stream, interval=10):
+    """ Return the value lists of a file of collectd JSON, as written by the
+    write_http plugin, either one array of value lists or one array per
+    line.
+    """
+    text = stream.read()
+    try:
+        documents = [json.loads(text)]
+    except ValueError:
+        documents = [json.loads(entry) for entry in text.splitlines() \
+                     if entry.strip()]
+
+    value_lists = []
+    for document in documents:
+        if isinstance(document, dict):
+            document = [document]
+        for vl in document:
+            value_lists.append((vl['time'], vl.get('interval') or interval,
+                    vl['host'], vl['plugin'], vl.get('plugin_instance', ''),
+                    vl['type'], vl.get('type_instance', ''), vl['dsnames'],
+                    vl['dstypes'], vl['values'], vl.get('meta')))
+    return value_lists
+
+
+def read_csv(stream, series, types, interval=10):
+    """ Return the value lists of a file of the csv plugin of collectd, with
+    an epoch and a column per data source, of the series identify() returned
+    for it.  The files do not say what the data sources are, those are taken
+    from the types.db of collectd.
+    """
+    host, plugin, plugin_instance, type, type_instance = series
+    if type not in types:
+        raise ValueError('type %s is not in types.db' % type)
+    dsnames, dstypes = types[type]
+
+    value_lists = []
+    for row in csv.reader(stream):
+        if not row or row[0] == 'epoch':
+            continue
+        value_lists.append((float(row[0]), interval, host, plugin,
+                plugin_instance, type, type_instance, dsnames, dstypes,
+                [float(value) for value in row[1:]], None))
+    return value_lists
+
+
+def read_rrd(stream, series):
+    """ Return the value lists of the output of rrdtool dump for a file of
+    the rrdtool plugin of collectd, of the series identify() returned for it.
+
+    Each time is taken from the finest archive of averages that goes back
+    to it, the coarser archives only fill in the times before that.  An RRD
+    keeps counters, derives and absolutes as rates per second, which are
+    turned back into value lists that change by the rate times the seconds
+    since the value list before, or the width of its row for the first one,
+    like the value lists collectd reports.
+    """
+    host, plugin, plugin_instance, type, type_instance = series
+    root = ElementTree.parse(stream).getroot()
+    step = int(root.findtext('step'))
+    last = int(root.findtext('lastupdate'))
+    dsnames = [ds.findtext('name').strip() for ds in root.findall('ds')]
+    dstypes = [ds.findtext('type').strip().lower() \
+               for ds in root.findall('ds')]
+
+    archives = sorted([(int(rra.findtext('pdp_per_row')), rra) \
+                       for rra in root.findall('rra') \
+                       if rra.findtext('cf').strip() == 'AVERAGE'])
+    times = []
+    intervals = []
+    rows = []
+    oldest = None
+    for pdp_per_row, rra in archives:
+        width = step * pdp_per_row
+        database = rra.find('database').findall('row')
+        end = last - last % width
+        for i, row in enumerate(database):
+            time = end - width * (len(database) - 1 - i)
+            if oldest is not None and time >= oldest:
+                break
+            values = [float(value.text) for value in row.findall('v')]
+            if all([numpy.isnan(value) for value in values]):
+                continue
+            times.append(time)
+            intervals.append(width)
+            rows.append(values)
+        if times:
+            oldest = min(times)
+    if not rows:
+        return []
+
+    order = numpy.argsort(times, kind='mergesort')
+    values = numpy.array(rows)[order]
+    # The rows of the coarser archives each cover more seconds.
+    seconds = numpy.diff(numpy.array(times)[order],
+                         prepend=times[order[0]] - intervals[order[0]])
+    for i, dstype in enumerate(dstypes):
+        if dstype in ('counter', 'derive'):
+            values[:, i] = numpy.cumsum(numpy.nan_to_num(values[:, i]) * \
+                                        seconds)
+        elif dstype == 'absolute':
+            values[:, i] *= seconds
+    return [(times[j], intervals[j], host, plugin, plugin_instance, type,
+             type_instance, dsnames, dstypes, list(values[k]), None) \
+            for k, j in enumerate(order)]
+
+
+def detect(path, format):
+    """ Return the format of a file, the one given unless that is auto. """
+    if format != 'auto':
+        return format
+    if path.endswith(ARCHIVE):
+        return 'archive'
+    return {'.json': 'json', '.xml': 'rrd'}.get(os.path.splitext(path)[1],
+                                                'csv')
+
+
+def read(path, options):
+    """ Return the value lists of a file in the format of the options, or
+    the format its name suggests.
+    """
+    format = detect(path, options['format'])
+    with open(path) as stream:
+        if format == 'json':
+            return read_json(stream, options['interval'])
+        series = identify(path, options['host'])
+        if format == 'rrd':
+            return read_rrd(stream, series)
+        return read_csv(stream, series, options['types'],
+                        options['interval'])
+
+
+def connect(url):
+    global connection
+    connection = create_engine(url, poolclass=NullPool).raw_connection()
+
+
+def load(partitions, known):
+    """ Copy the lines of each partition into it, creating the partitions
+    missing, commit and return the days loaded.
+    """
+    cursor = connection.cursor()
+    for table in sorted(partitions):
+        if table not in known:
+            plugin, day, type = parse(table)
+            ensure(connection, table, plugin, type,
+                   datetime.strptime(day, '%Y%m%d'))
+            known.add(table)
+    for table, lines in sorted(partitions.iteritems()):
+        cursor.copy_expert('COPY collectd.%s %s FROM STDIN;' % (quote(table),
+                COLUMNS), StringIO(''.join(lines)))
+    connection.commit()
+    return set([parse(table)[1] for table in partitions])
+
+
+def restore(path, known):
+    """ Copy a partition archived by expire_yams-wui_data back into it, and
+    return the number of value lists and its day.
+    """
+    table = os.path.basename(path)[:-len(ARCHIVE)]
+    if parse(table) is None:
+        raise ValueError('%s is not named after a partition' % path)
+    plugin, day, type = parse(table)
+    ensure(connection, table, plugin, type, datetime.strptime(day, '%Y%m%d'))
+    known.add(table)
+
+    cursor = connection.cursor()
+    stream = gzip.open(path)
+    try:
+        cursor.copy_expert('COPY collectd.%s %s FROM STDIN;' % (quote(table),
+                COLUMNS), stream)
+    finally:
+        stream.close()
+    connection.commit()
+    return cursor.rowcount, day
+
+
+def backfill(task):
+    """ Load the value lists of a file in a process of the pool, and return
+    the file, the number of value lists loaded, the days they were loaded
+    into, the partitions loaded into and the error that stopped it if any.
+    """
+    path, options = task
+    count = 0
+    days = set()
+    known = set()
+    try:
+        if detect(path, options['format']) == 'archive':
+            count, day = restore(path, known)
+            if count:
+                days.add(day)
+            return path, count, days, known, None
+
+        partitions = {}
+        pending = 0
+        for vl in read(path, options):
+            table = name(vl[3], datetime.fromtimestamp(int(vl[0]), utc),
+                         vl[5])
+            partitions.setdefault(table, []).append(line(*vl))
+            pending += 1
+            if pending >= BATCH:
+                days.update(load(partitions, known))
+                count += pending
+                partitions = {}
+                pending = 0
+        days.update(load(partitions, known))
+        count += pending
+    except Exception as e:
+        connection.rollback()
+        return path, count, days, known, '%s: %s' % (type(e).__name__, e)
+    return path, count, days, known, None
+
+
+def walk(paths):
+    """ Return the files named, and the files in the directories named. """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, directories, filenames in os.walk(path):
+            directories.sort()
+            files.extend([os.path.join(directory, filename) \
+                          for filename in sorted(filenames)])
+    return files
+
+
+def analyze(url, tables):
+    """ Analyze the partitions loaded into, for the planner to know them. """
+    raw = create_engine(url, poolclass=NullPool).raw_connection()
+    try:
+        cursor = raw.cursor()
+        for table in sorted(tables):
+            cursor.execute('ANALYZE collectd.%s;' % quote(table))
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def main(argv=sys.argv):
+    if len(argv) < 3:
+        usage(argv)
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='Load collectd value lists from write_http JSON, '
+                        'csv plugin or rrdtool dump files into the '
+                        'partitions of value_list, in parallel.')
+    parser.add_argument('config_uri')
+    parser.add_argument('paths', nargs='+', metavar='path',
+            help='file, or directory of files, to load')
+    parser.add_argument('--format', default='auto',
+            choices=['auto', 'json', 'csv', 'rrd', 'archive'],
+            help='format of the files (default by extension, .json for '
+                 'JSON, .xml for rrdtool dump, .copy.gz for archived '
+                 'partitions and csv otherwise)')
+    parser.add_argument('--jobs', type=int,
+            default=multiprocessing.cpu_count(),
+            help='files loaded at the same time (default one per CPU)')
+    parser.add_argument('--types-db', default='/usr/share/collectd/types.db',
+            help='types.db naming the data sources of csv files (default '
+                 '/usr/share/collectd/types.db)')
+    parser.add_argument('--interval', type=int, default=10,
+            help='interval of csv files, and JSON without one (default 10)')
+    parser.add_argument('--host',
+            help='host of csv and rrdtool files (default the name of the '
+                 'directory above the plugin directory)')
+    parser.add_argument('--url',
+            help='database url of the owner of value_list, which the WUI '
+                 'user normally is not (default sqlalchemy.url)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    url = args.url or settings['sqlalchemy.url']
+
+    options = {'format': args.format, 'interval': args.interval,
+               'host': args.host, 'types': {}}
+    files = walk(args.paths)
+    if [path for path in files if detect(path, args.format) == 'csv']:
+        options['types'] = read_types(args.types_db)
+
+    total = 0
+    failed = 0
+    days = set()
+    tables = set()
+    pool = multiprocessing.Pool(args.jobs, connect, (url,))
+    try:
+        for path, count, loaded, known, error in pool.imap_unordered(
+                backfill, [(path, options) for path in files]):
+            total += count
+            days.update(loaded)
+            tables.update(known)
+            if error is not None:
+                failed += 1
+                log.error('%s: %s after %d value lists', path, error, count)
+            else:
+                log.info('%s: %d value lists', path, count)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    analyze(url, tables)
+
+    # The rollups belong to the WUI user rather than the owner of value_list.
+    # Only the days loaded into are rolled up again, the days in between may
+    # have no value lists left to roll up.
+    if days:
+        wui = engine_from_config(settings, 'sqlalchemy.').connect()
+        try:
+            for day in sorted(days):
+                start = datetime.strptime(day, '%Y%m%d').replace(tzinfo=utc)
+                redo(wui, start, start + timedelta(days=1))
+        finally:
+            wui.close()
+        log.info('rolled up %d days again', len(days))
+
+    log.info('loaded %d value lists from %d files, %d failed', total,
+             len(files), failed)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,149 @@
+import argparse
+import resource
+import sys
+import time
+
+import numpy
+
+from pyramid.paster import (
+    get_app,
+    setup_logging,
+    )
+
+from webob import Request
+
+from ..catalog import catalog
+
+# The requests timed for each time range, as (name, url), with {plugin},
+# {type} and {host} filled in with a series there is data for.
+CASES = [
+    ('plugins', '/plugins'),
+    ('types', '/types/{plugin}'),
+    ('hosts', '/hosts/{type}/{plugin}'),
+    ('dsnames', '/dsnames/{type}/{plugin}'),
+    ('data_csv', '/data.csv/{plugin}/{host}?type={type}&max_points=0'),
+    ('data_csv max_points', '/data.csv/{plugin}/{host}?type={type}'),
+    ('data_csv envelope', '/data.csv/{plugin}/{host}?type={type}&envelope=1'),
+    ('data_csv percentage',
+     '/data.csv/{plugin}/{host}?type={type}&percentage=1&max_points=0'),
+    ('data_csv since', '/data.csv/{plugin}/{host}?type={type}&since={since}'),
+    ('data_batch', '/data_batch.csv?{urls}'),
+    ('data_batch binary', '/data_batch.csv?{urls}&format=binary'),
+    ]
+
+
+def usage(argv):
+    cmd = argv[0]
+    print('usage: %s <config_uri> [--requests N] [--time-ranges 1,24] ...\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+class Client(object):
+    """ Send requests straight to the application, keeping the session
+    cookie between them like a browser.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.cookie = None
+
+    def get(self, url):
+        request = Request.blank(url)
+        if self.cookie is not None:
+            request.headers['Cookie'] = self.cookie
+        response = request.get_response(self.app)
+        cookies = response.headers.getall('Set-Cookie')
+        if cookies:
+            self.cookie = cookies[0].split(';')[0]
+        if response.status_int != 200:
+            raise RuntimeError('%s returned %s' % (url, response.status))
+        return response.body
+
+
+def points(url, body):
+    """ Return the number of rows of chart data in the CSV response to url,
+    or None if it is not one.
+    """
+    if not url.startswith('/data') or 'format=binary' in url:
+        return None
+    return len([line for line in body.split('\n') \
+                if line and not line.startswith('timestamp')])
+
+
+def peak_rss():
+    """ Return the most memory the process has used so far in megabytes. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(client, url, requests, warmup=1):
+    """ Return the latencies of requests requests for url in seconds, and
+    the rows of chart data of the last response.
+    """
+    for i in range(warmup):
+        client.get(url)
+    latencies = []
+    for i in range(requests):
+        start = time.time()
+        body = client.get(url)
+        latencies.append(time.time() - start)
+    return latencies, points(url, body)
+
+
+def report(name, time_range, hosts, latencies, rows):
+    p50, p99 = numpy.percentile(latencies, [50, 99])
+    if rows is None:
+        rate = '-'
+    else:
+        rate = '%d' % (rows / numpy.median(latencies))
+    print('%-22s %5d %5d %9.1f %9.1f %11s %9.1f' % (name, time_range, hosts,
+            p50 * 1000, p99 * 1000, rate, peak_rss()))
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='Time the views of the WUI against the database of '
+                        'the given configuration.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--requests', type=int, default=20,
+            help='timed requests per view (default 20)')
+    parser.add_argument('--time-ranges', default='1,24,168',
+            help='hours plotted, comma separated (default 1,24,168)')
+    parser.add_argument('--hosts', default='1,10',
+            help='hosts charted by data_batch, comma separated '
+                 '(default 1,10)')
+    parser.add_argument('--plugin', default='cpu',
+            help='plugin of the series charted (default cpu)')
+    parser.add_argument('--type', default='cpu',
+            help='type of the series charted (default cpu)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    app = get_app(args.config_uri)
+    client = Client(app)
+
+    hosts = catalog.hosts(args.plugin, args.type)
+    if not hosts:
+        print('no data for plugin %s type %s' % (args.plugin, args.type))
+        sys.exit(1)
+
+    print('%-22s %5s %5s %9s %9s %11s %9s' % ('view', 'hours', 'hosts',
+            'p50 ms', 'p99 ms', 'rows/s', 'RSS MB'))
+    for time_range in [int(value) for value in args.time_ranges.split(',')]:
+        client.get('/toggle_time_range/%d' % time_range)
+        for count in [int(value) for value in args.hosts.split(',')]:
+            count = min(count, len(hosts))
+            params = {'plugin': args.plugin, 'type': args.type,
+                      'host': hosts[0],
+                      'since': int(time.time() - 60) * 1000,
+                      'urls': '&'.join(['url=data.csv/%s/%s%%3Ftype%%3D%s' % (
+                              args.plugin, host, args.type) \
+                              for host in hosts[:count]])}
+            for name, url in CASES:
+                # Only the batches chart more than one host.
+                if count != 1 and not name.startswith('data_batch'):
+                    continue
+                latencies, rows = measure(client, url.format(**params),
+                                          args.requests)
+                report(name, time_range, count, latencies, rows)
@@ -0,0 +1,260 @@
+import argparse
+import gzip
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from datetime import (
+    datetime,
+    timedelta,
+    )
+
+from sqlalchemy import (
+    create_engine,
+    engine_from_config,
+    )
+from sqlalchemy.pool import NullPool
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..ingest import COLUMNS
+from ..partitions import (
+    parse,
+    quote,
+    utc,
+    )
+from ..rollups import (
+    TIERS,
+    watermark,
+    )
+
+log = logging.getLogger(__name__)
+
+# The database connection of each process of the pool.
+connection = None
+
+
+def usage(argv):
+    cmd = argv[0]
+    print('usage: %s <config_uri> [--jobs N] [--dry-run] [--every S]\n'
+          '(example: "%s development.ini --dry-run")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def policy(settings):
+    """ Return the days the partitions of each plugin are kept for, with the
+    days of the plugins not named under None.
+    """
+    prefix = 'yams.retention_days.'
+    days = {None: int(settings.get('yams.retention_days', 0))}
+    for key, value in settings.items():
+        if key.startswith(prefix):
+            days[key[len(prefix):]] = int(value)
+    return days
+
+
+def expired(tables, days, today, rolled_up):
+    """ Return the partitions among tables whose day ended more than the days
+    of their plugin before today, and before rolled_up, oldest first.
+    """
+    old = []
+    for table in tables:
+        partition = parse(table)
+        if partition is None:
+            continue
+        plugin, day, type = partition
+        keep = days.get(plugin, days[None])
+        day = datetime.strptime(day, '%Y%m%d').date()
+        if keep > 0 and day < today - timedelta(days=keep) and \
+                day + timedelta(days=1) <= rolled_up:
+            old.append((day, table))
+    return [table for day, table in sorted(old)]
+
+
+def partitions(connection):
+    """ Return the partitions of value_list, and the ones detached from it
+    but not dropped yet, as (table, whether it is attached).
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT c.relname, " \
+                   "       EXISTS (SELECT 1 " \
+                   "               FROM pg_inherits AS i " \
+                   "               WHERE i.inhrelid = c.oid) " \
+                   "FROM pg_class AS c " \
+                   "JOIN pg_namespace AS n ON n.oid = c.relnamespace " \
+                   "WHERE n.nspname = 'collectd' " \
+                   "  AND c.relkind = 'r' " \
+                   "  AND c.relname LIKE 'vl\\_%';")
+    return cursor.fetchall()
+
+
+def rolled_up(settings):
+    """ Return the day up to which the value lists have been rolled up into
+    every tier aggregated from them and into the totals, or None.
+    """
+    wui = engine_from_config(settings, 'sqlalchemy.').connect()
+    try:
+        marks = [watermark(wui, tier) for tier, width, source in TIERS \
+                 if source == 'value_list'] + [watermark(wui, 'totals')]
+    finally:
+        wui.close()
+    if None in marks:
+        return None
+    return min(marks).astimezone(utc).date()
+
+
+def connect(url, lock_timeout):
+    global connection
+    connection = create_engine(url, poolclass=NullPool).raw_connection()
+    # Give up on a partition rather than queue for its lock for long, the
+    # queries of the WUI would be queued behind us.
+    connection.cursor().execute('SET lock_timeout = %d;' % lock_timeout)
+    connection.commit()
+
+
+def archive(table, directory):
+    """ Save the rows of a partition in directory, as a gzipped file of lines
+    of COPY value_list COLUMNS FROM STDIN named after it.
+    """
+    path = os.path.join(directory, table + '.copy.gz')
+    stream = gzip.open(path + '.tmp', 'wb')
+    try:
+        connection.cursor().copy_expert('COPY collectd.%s %s TO STDOUT;' % (
+                quote(table), COLUMNS), stream)
+    finally:
+        stream.close()
+    os.rename(path + '.tmp', path)
+
+
+def run(task):
+    """ Detach, archive or drop a partition in a process of the pool, and
+    return the partition and the error that stopped it if any.
+    """
+    step, table, directory = task
+    try:
+        if step == 'detach':
+            connection.cursor().execute('ALTER TABLE collectd.%s ' \
+                    'NO INHERIT collectd.value_list;' % quote(table))
+        elif step == 'archive':
+            archive(table, directory)
+        else:
+            connection.cursor().execute('DROP TABLE collectd.%s;' % \
+                                        quote(table))
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        return table, '%s: %s' % (type(e).__name__, str(e).strip())
+    return table, None
+
+
+def take(pool, step, tables, directory=None):
+    """ Take a step for each of tables in the pool, and return the tables it
+    was taken for.  The others are left for the next run.
+    """
+    done = []
+    for table, error in pool.imap_unordered(run, [(step, table, directory) \
+                                                  for table in tables]):
+        if error is None:
+            done.append(table)
+        else:
+            log.warning('could not %s %s, left for the next run: %s', step,
+                        table, error)
+    return sorted(done)
+
+
+def expire(settings, url, jobs, lock_timeout, dry_run=False):
+    """ Detach the partitions past their retention from value_list, archive
+    them if yams.archive_dir is set and drop them, and return how many were
+    dropped.  The WUI keeps reading a partition until it rereads its catalog,
+    so they are only dropped yams.catalog_ttl seconds after being detached.
+    """
+    days = policy(settings)
+    if not [keep for keep in days.values() if keep > 0]:
+        return 0
+    until = rolled_up(settings)
+    if until is None:
+        log.warning('nothing is rolled up yet, every partition is kept')
+        return 0
+
+    owner = create_engine(url, poolclass=NullPool).raw_connection()
+    try:
+        tables = partitions(owner)
+    finally:
+        owner.close()
+    today = datetime.now(utc).date()
+    attached = expired([table for table, inherits in tables if inherits],
+                       days, today, until)
+    detached = expired([table for table, inherits in tables \
+                        if not inherits], days, today, until)
+    if dry_run:
+        for table in detached + attached:
+            log.info('would expire %s', table)
+        return 0
+    if not detached + attached:
+        return 0
+
+    directory = settings.get('yams.archive_dir') or None
+    ttl = int(settings.get('yams.catalog_ttl', 300))
+    pool = multiprocessing.Pool(jobs, connect, (url, lock_timeout))
+    try:
+        newly = take(pool, 'detach', attached)
+        detached_at = time.time()
+        tables = sorted(detached + newly)
+        if directory is not None:
+            tables = take(pool, 'archive', tables, directory)
+        if newly:
+            time.sleep(max(0, detached_at + ttl - time.time()))
+        dropped = take(pool, 'drop', tables)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    log.info('dropped %d of %d expired partitions', len(dropped),
+             len(detached + attached))
+    return len(dropped)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='Drop the partitions of value_list past their '
+                        'retention, archiving them first if '
+                        'yams.archive_dir is set.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--jobs', type=int, default=4,
+            help='partitions worked on at the same time (default 4)')
+    parser.add_argument('--lock-timeout', type=int, default=2000,
+            help='milliseconds to wait for the lock of a partition before '
+                 'leaving it for the next run (default 2000)')
+    parser.add_argument('--dry-run', action='store_true',
+            help='only list the partitions that would be expired')
+    parser.add_argument('--every', type=int,
+            help='keep running, expiring partitions every so many seconds')
+    parser.add_argument('--url',
+            help='database url of the owner of value_list, which the WUI '
+                 'user normally is not (default sqlalchemy.url)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    url = args.url or settings['sqlalchemy.url']
+
+    while True:
+        try:
+            expire(settings, url, args.jobs, args.lock_timeout, args.dry_run)
+        except Exception:
+            if not args.every:
+                raise
+            log.exception('expiring partitions failed')
+        if not args.every:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,199 @@
+import argparse
+import logging
+import sys
+import time
+
+from cStringIO import StringIO
+from datetime import datetime
+
+import numpy
+
+from sqlalchemy import (
+    create_engine,
+    engine_from_config,
+    )
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..ingest import (
+    COLUMNS,
+    create,
+    index,
+    )
+from ..partitions import (
+    name,
+    quote,
+    utc,
+    )
+
+log = logging.getLogger(__name__)
+
+# The series collectd reports for every host, as (plugin, plugin_instances,
+# type, type_instances, dsnames, dstypes, typical change per second), modeled
+# on the cpu, interface, disk, memory and postgresql plugins.  The postgresql
+# plugin reports one series per database, with the database as meta data.
+SERIES = [
+    ('cpu', ['0', '1', '2', '3'], 'cpu', ['user', 'system', 'wait', 'idle'],
+     ['value'], ['derive'], 25.0),
+    ('interface', ['eth0', 'lo'], 'if_octets', [''], ['rx', 'tx'],
+     ['derive', 'derive'], 50000.0),
+    ('interface', ['eth0', 'lo'], 'if_packets', [''], ['rx', 'tx'],
+     ['derive', 'derive'], 100.0),
+    ('disk', ['sda', 'sdb'], 'disk_octets', [''], ['read', 'write'],
+     ['derive', 'derive'], 200000.0),
+    ('disk', ['sda', 'sdb'], 'disk_ops', [''], ['read', 'write'],
+     ['derive', 'derive'], 40.0),
+    ('memory', [''], 'memory', ['used', 'buffered', 'cached', 'free'],
+     ['value'], ['gauge'], 1e9),
+    ('postgresql', ['postgres', 'app'], 'pg_numbackends', [''], ['value'],
+     ['gauge'], 20.0),
+    ('postgresql', ['postgres', 'app'], 'pg_xact', ['num_commits',
+     'num_rollbacks'], ['value'], ['derive'], 30.0),
+    ]
+
+
+def usage(argv):
+    cmd = argv[0]
+    print('usage: %s <config_uri> [--hosts N] [--days D] ...\n'
+          '(example: "%s development.ini --hosts 10 --days 2")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def array(values):
+    return '{%s}' % ','.join(values)
+
+
+def value_lists(host, start, count, interval, random):
+    """ Return the COPY lines of every series of a host for count value lists
+    interval seconds apart from start, by partition.
+    """
+    times = ['%s+00' % datetime.fromtimestamp(start + i * interval, utc) \
+             .strftime('%Y-%m-%d %H:%M:%S') for i in range(count)]
+    partitions = {}
+    for plugin, plugin_instances, type, type_instances, dsnames, dstypes, \
+            scale in SERIES:
+        table = name(plugin, datetime.fromtimestamp(start, utc), type)
+        lines = partitions.setdefault(table, [])
+        for plugin_instance in plugin_instances:
+            if plugin == 'postgresql':
+                meta = '"database"=>"%s"' % plugin_instance
+            else:
+                meta = ''
+            for type_instance in type_instances:
+                columns = []
+                for dstype in dstypes:
+                    if dstype == 'gauge':
+                        # Wander around a level of its own.
+                        level = random.uniform(0.2, 1.0) * scale
+                        column = level * (1 + 0.2 * numpy.sin(
+                                numpy.arange(count) / 360.0 + \
+                                random.uniform(0, 6)) + \
+                                0.05 * random.standard_normal(count))
+                        column = numpy.maximum(column.round(), 0)
+                    else:
+                        # Counters only ever go up.
+                        rate = random.uniform(0.1, 1.0) * scale
+                        column = random.uniform(0, 1e6) + numpy.cumsum(
+                                random.poisson(rate * interval, count))
+                    columns.append(column)
+                values = numpy.column_stack(columns)
+                prefix = '\t'.join([str(interval), host, plugin,
+                        plugin_instance, type, type_instance, array(dsnames),
+                        array(dstypes)])
+                for i in range(count):
+                    lines.append('%s\t%s\t%s\t%s\n' % (times[i], prefix,
+                            array([repr(value) for value in values[i]]),
+                            meta))
+    return partitions
+
+
+def generate(connection, hosts, days, interval, seed, end=None):
+    """ Load days of value lists of hosts synthetic hosts, up to end, into
+    the partitions of value_list.  The data of the synthetic hosts already
+    there is replaced, so the same arguments always produce the same data.
+    """
+    random = numpy.random.RandomState(seed)
+    if end is None:
+        end = int(time.time())
+    end -= end % interval
+    start = end - days * 86400
+    host_names = ['bench-%04d.example.com' % i for i in range(hosts)]
+    cursor = connection.cursor()
+
+    day_start = start
+    while day_start < end:
+        day = datetime.fromtimestamp(day_start, utc).replace(hour=0,
+                minute=0, second=0)
+        day_end = min(end, (day_start // 86400 + 1) * 86400)
+        count = (day_end - day_start + interval - 1) // interval
+
+        created = []
+        for plugin, type in sorted(set([(series[0], series[2]) \
+                                        for series in SERIES])):
+            table = name(plugin, day, type)
+            if create(connection, table, plugin, type, day):
+                created.append((table, plugin))
+            elif (table, plugin) not in created:
+                cursor.execute("DELETE FROM collectd.%s " \
+                               "WHERE host = ANY(%%s);" % quote(table),
+                               (host_names,))
+
+        # Load one host at a time to keep the memory used in check, and
+        # index the new partitions afterwards, which is quicker.
+        for host in host_names:
+            for table, lines in sorted(value_lists(host, day_start, count,
+                    interval, random).iteritems()):
+                cursor.copy_expert('COPY collectd.%s %s FROM STDIN;' % (
+                        quote(table), COLUMNS), StringIO(''.join(lines)))
+        for table, plugin in created:
+            index(connection, table, plugin)
+        connection.commit()
+
+        for table in sorted(set([name(series[0], day, series[2]) \
+                                 for series in SERIES])):
+            cursor.execute('ANALYZE collectd.%s;' % quote(table))
+        connection.commit()
+        log.info('loaded %d value lists of %d hosts for %s', count,
+                 len(host_names), day.strftime('%Y-%m-%d'))
+
+        day_start = day_end
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='Load synthetic collectd value lists into the '
+                        'partitions of value_list, for benchmarking.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--hosts', type=int, default=10,
+            help='number of hosts (default 10)')
+    parser.add_argument('--days', type=int, default=1,
+            help='days of data up to now (default 1)')
+    parser.add_argument('--interval', type=int, default=10,
+            help='seconds between value lists (default 10)')
+    parser.add_argument('--seed', type=int, default=0,
+            help='seed of the random values (default 0)')
+    parser.add_argument('--end', type=int,
+            help='epoch of the end of the data (default now)')
+    parser.add_argument('--url',
+            help='database url of the owner of value_list, which the WUI '
+                 'user normally is not (default sqlalchemy.url)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        engine = engine_from_config(settings, 'sqlalchemy.')
+
+    connection = engine.raw_connection()
+    try:
+        generate(connection, args.hosts, args.days, args.interval, args.seed,
+                 args.end)
+    finally:
+        connection.close()
@@ -0,0 +1,668 @@
+import json
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import md5
+from itertools import groupby
+from urllib import unquote
+from urlparse import parse_qsl
+
+import numpy
+
+from sqlalchemy import text
+
+from webob.multidict import MultiDict
+
+from .catalog import catalog
+from .compute import (
+    AGGREGATES,
+    Across,
+    Buckets,
+    Rates,
+    format_binary,
+    format_binary_header,
+    format_csv,
+    matrix,
+    )
+from .fanout import (
+    bounded,
+    fanout,
+    split,
+    )
+from .metrics import metrics
+from .partitions import (
+    parse,
+    quote,
+    union,
+    utc,
+    )
+from .rollups import (
+    choose_tier,
+    epoch,
+    source as rollup_source,
+    totals_source,
+    watermark,
+    )
+from .statements import execute
+
+# The name of a series without its host, like cpu.0.cpu.user.
+PREFIX = "plugin || " \
+        "    CASE WHEN plugin_instance <> '' " \
+        "         THEN '.' || plugin_instance ELSE '' END || " \
+        "    '.' || type || " \
+        "    CASE WHEN type_instance <> '' " \
+        "         THEN '.' || type_instance ELSE '' END"
+
+
+class Query(object):
+    """ The query for a series of one or more hosts, and what is needed to
+    turn the rows of each host into the plotted values, or into the
+    aggregates of the hosts named group.  The slices, a list of (sql,
+    params), read the same rows a run of days each.
+    """
+    def __init__(self, sql, params, prefix, plot_dsnames, dstypes, indexes,
+            percentage, width, envelope, rollups, since=None, aggregate=None,
+            group=None, slices=None):
+        self.sql = sql
+        self.params = params
+        self.prefix = prefix
+        self.plot_dsnames = plot_dsnames
+        self.dstypes = dstypes
+        self.indexes = indexes
+        self.percentage = percentage
+        self.width = width
+        self.envelope = envelope
+        self.rollups = rollups
+        self.since = since
+        self.aggregate = aggregate
+        self.group = group
+        self.slices = slices or []
+
+    def labels(self, host):
+        if self.aggregate:
+            return ['%s(%s).%s.%s' % (function, self.group, self.prefix,
+                                      dsname) \
+                    for function in self.aggregate \
+                    for dsname in self.plot_dsnames]
+        labels = ['%s.%s.%s' % (host.replace('.', '_'), self.prefix, dsname) \
+                  for dsname in self.plot_dsnames]
+        if self.width and self.envelope:
+            labels += ['%s.min' % label for label in labels] + \
+                    ['%s.max' % label for label in labels]
+        return labels
+
+    def rates(self):
+        return Rates(self.dstypes, self.indexes, self.percentage)
+
+    def buckets(self):
+        if self.width:
+            return Buckets(self.width, self.envelope)
+        return None
+
+
+def specs(url_list):
+    """ Return the series of a list of data.csv urls as (plugin, hosts,
+    params), with the urls that only differ by host grouped together.
+    """
+    groups = OrderedDict()
+    for url in url_list:
+        path, _, query_string = url.partition('?')
+        parts = path.split('/')
+        if len(parts) != 3 or parts[0] != 'data.csv':
+            continue
+        key = (unquote(parts[1]), query_string)
+        groups.setdefault(key, []).append(unquote(parts[2]))
+
+    return [(plugin, hosts,
+             MultiDict(parse_qsl(query_string, keep_blank_values=True))) \
+            for (plugin, query_string), hosts in groups.iteritems()]
+
+
+def key(specs, time_range, binary):
+    """ Return what identifies the response for the series described by specs,
+    a list of (plugin, hosts, params), over the last time_range hours.
+    """
+    return json.dumps(([(plugin, list(hosts), sorted(params.items())) \
+                        for plugin, hosts, params in specs], time_range,
+                       binary))
+
+
+class Batch(object):
+    """ The series described by specs over the last time_range hours, or
+    between the start and end of bounds in milliseconds, the partitions they
+    are read from, and an entity tag that changes whenever anything read from
+    those could have changed.
+    """
+    def __init__(self, session, specs, time_range, binary, window_step,
+            bounds=None):
+        self.specs = specs
+        self.time_range = time_range
+        self.bounds = bounds
+        if binary:
+            self.stream_class = BinaryStream
+        else:
+            self.stream_class = CSVStream
+
+        if bounds is None:
+            self.time_dt, end_dt = window(time_range, window_step)
+        else:
+            self.time_dt, end_dt = [datetime.fromtimestamp(bound / 1000.0,
+                                                           utc) \
+                                    for bound in bounds]
+        self.tables = [catalog.resolve(plugin, self.time_dt, end_dt,
+                                       params.get('type')) \
+                       for plugin, hosts, params in specs]
+
+        # The series can only have changed if newer rows arrived in their
+        # partitions, the rollups moved on or the time range moved on.
+        self.newest, watermarks = freshness(session,
+                [table for tables in self.tables for table in tables])
+        self.etag = md5(repr((key(specs, time_range, binary), self.time_dt,
+                bounds, self.newest, watermarks))).hexdigest()
+
+    def stream(self, session, connection, max_points, batch_size):
+        """ Return the iterator over the response, reading the rows on
+        connection.
+        """
+        queries = []
+        for (plugin, hosts, params), tables in zip(self.specs, self.tables):
+            series = query(session, plugin, hosts, params, tables,
+                           self.time_dt, self.time_range, max_points)
+            if series is not None:
+                queries.append(series)
+        return self.stream_class(connection, queries, batch_size)
+
+
+def window(time_range, step):
+    """ Return the start and end of the last time_range hours.  The start is
+    rounded down to step seconds, so that the same rows are read again until
+    newer data arrives.
+    """
+    end_dt = datetime.now(utc)
+    start = epoch(end_dt) - int(time_range * 3600)
+    return datetime.fromtimestamp(start - start % step, utc), end_dt
+
+
+def freshness(session, tables):
+    """ Return the time of the newest row in the newest day of the given
+    partitions, and the watermarks of the rollup tiers kept by the catalog.
+    Together they tell whether anything read from the partitions could have
+    changed.
+    """
+    newest = None
+    days = {}
+    for table in tables:
+        plugin, day, type = parse(table)
+        days.setdefault(plugin, []).append((day, table))
+    tables = [table for plugin_tables in days.values() \
+              for day, table in plugin_tables \
+              if day == max(plugin_tables)[0]]
+    connection = session.connection()
+    if tables:
+        newest = execute(connection,
+                "SELECT max(time) AS time " \
+                "FROM (%s) AS a;" % ' UNION ALL '.join(
+                        ['SELECT max(time) AS time FROM %s' % quote(table) \
+                         for table in sorted(tables)])).first()['time']
+
+    return newest, catalog.watermarks()
+
+
+def query(session, plugin, hosts, params, tables, time_dt, time_range,
+        max_points, end_dt=None, width=None):
+    """ Return the query for a series of the given hosts described by params,
+    the query string of a data.csv url, read from the given partitions from
+    time_dt on, and until end_dt if given.  The points are averaged over
+    buckets of width milliseconds if given, or wide enough for time_range
+    hours to fit in max_points.  Hosts with a * stand for the hosts matching
+    them.  Return None if there is nothing to plot.
+    """
+    sql_params = {'plugin': plugin,
+                  'hosts': [host for host in hosts if '*' not in host]}
+    host_condition = 'host = ANY(:hosts)'
+    patterns = [host for host in hosts if '*' in host]
+    if patterns:
+        host_condition = '(%s OR host LIKE ANY(:host_patterns))' % \
+                host_condition
+        sql_params['host_patterns'] = [pattern.replace('\\', '\\\\') \
+                .replace('%', '\\%').replace('_', '\\_').replace('*', '%') \
+                for pattern in patterns]
+
+    # Not sure if there is a faster way, but always get the entire dataset from
+    # the database, and filter out the values we don't want specified by the
+    # query string.
+    wanted_dsnames = None
+    if 'dsnames' in params:
+        wanted_dsnames = params.getall('dsnames')
+
+    if 'percentage' in params and params['percentage'] == '1':
+        percentage = True
+    else:
+        percentage = False
+
+    try:
+        max_points = int(params.get('max_points', max_points))
+    except ValueError:
+        max_points = 0
+
+    if 'envelope' in params and params['envelope'] == '1':
+        envelope = True
+    else:
+        envelope = False
+
+    aggregate = aggregates(params)
+    if aggregate:
+        envelope = False
+
+    # Only return the points from since, the time of the last point the
+    # browser already has, on.
+    try:
+        since = int(params['since'])
+    except (KeyError, ValueError):
+        since = None
+
+    where_condition = ''
+    per_condition = ''
+
+    if 'plugin_instance' in params:
+        where_condition += ' AND plugin_instance = :plugin_instance'
+        per_condition += ' AND plugin_instance = :plugin_instance'
+        sql_params['plugin_instance'] = params['plugin_instance']
+
+    if 'type' in params:
+        where_condition += ' AND type = :type'
+        per_condition += ' AND type = :type'
+        sql_params['type'] = params['type']
+
+    if 'type_instance' in params:
+        where_condition += ' AND type_instance = :type_instance'
+        sql_params['type_instance'] = params['type_instance']
+
+    if 'meta' in params:
+        keys = params.getall('meta')
+
+        # Bind the keys as well as the values, the keys come from the url too.
+        for i, key in enumerate(keys):
+            where_condition += ' AND meta -> CAST(:meta_key_%d AS TEXT) = ' \
+                    ':meta_value_%d' % (i, i)
+            sql_params['meta_key_%d' % i] = key
+            sql_params['meta_value_%d' % i] = params.get(key)
+
+    # Read only the partitions that cover the time range.
+    sql_params['time_dt'] = time_dt
+    if not tables:
+        # There is no data in the time range.
+        return None
+
+    # The data source name and type should be the consistent within a plugin.
+    # Look them up in the series dictionary, or grab the first row of the
+    # newest partition for a series the rollups have not recorded yet.
+    connection = session.connection()
+    result = execute(connection,
+            "SELECT dsnames, dstypes, interval, %s AS prefix " \
+            "FROM series " \
+            "WHERE plugin = :plugin " \
+            "  AND last_seen >= :time_dt " \
+            "%s " \
+            "ORDER BY plugin_instance, type_instance, host " \
+            "LIMIT 1;" % (PREFIX, where_condition), sql_params).first()
+    if not result:
+        result = execute(connection,
+                "SELECT dsnames, dstypes, interval, %s AS prefix " \
+                "FROM %s AS value_list " \
+                "WHERE plugin = :plugin " \
+                "%s " \
+                "LIMIT 1;" % (PREFIX, union(reversed(tables)),
+                              where_condition), sql_params).first()
+    if not result:
+        # These query parameters do not return any data.
+        return None
+
+    dsnames = result['dsnames']
+    dstypes = result['dstypes']
+    length = len(dsnames)
+
+    if wanted_dsnames:
+        plot_dsnames = []
+        for dsname in dsnames:
+            if dsname in wanted_dsnames:
+                plot_dsnames.append(dsname)
+    else:
+        plot_dsnames = dsnames
+
+    if len(plot_dsnames) == 0:
+        # No need to continue if there is nothing to plot.
+        return None
+
+    # Only bother with buckets when they are wider than the interval the data
+    # was collected at.
+    if width is None and max_points > 0:
+        width = time_range * 3600000 / max_points
+    if width is not None and width <= result['interval'] * 1000:
+        width = None
+    # The values of the hosts are aggregated per bucket, at least as wide as
+    # the interval so that every host has a value in each.
+    if aggregate and width is None:
+        width = result['interval'] * 1000
+
+    # Read the coarsest rollup tier that still has at least one row per
+    # bucket, as long as it has been rolled up into the time range at all.
+    tier = None
+    if width is not None:
+        tier = choose_tier(width / 1000)
+    if tier is not None:
+        sql_params['watermark'] = watermark(connection, tier[0])
+        if sql_params['watermark'] is None or \
+                sql_params['watermark'] <= time_dt:
+            tier = None
+
+    if since is not None:
+        # Start a couple of rows before since, so that the rates of the first
+        # new rows can be calculated from the rows before them.
+        if tier is not None:
+            step = tier[1]
+        else:
+            # The hosts of a series may send their value lists at different
+            # intervals, the longest one gives every host its rows before.
+            longest = execute(connection,
+                    "SELECT max(interval) AS interval " \
+                    "FROM series " \
+                    "WHERE plugin = :plugin " \
+                    "  AND last_seen >= :time_dt " \
+                    "%s;" % where_condition, sql_params).first()['interval']
+            step = max(longest, result['interval'])
+        seed_dt = datetime.fromtimestamp(since / 1000 - 2 * step, utc)
+        if seed_dt > time_dt:
+            sql_params['time_dt'] = seed_dt
+            day = seed_dt.strftime('%Y%m%d')
+            # Keep the rows after the watermark of the rollups readable even
+            # when there is no partition from that day on.
+            tables = [table for table in tables \
+                      if parse(table)[1] >= day] or tables
+
+    # Take the totals of the raw value lists from plugin_totals as far as they
+    # have been summed up already, and only sum up the rest here.
+    summed = False
+    if percentage and tier is None:
+        sql_params['totals_watermark'] = watermark(connection, 'totals')
+        summed = sql_params['totals_watermark'] is not None and \
+                sql_params['totals_watermark'] > time_dt
+
+    # The rows of the totals stop at end_dt, and the joined rows with them.
+    until = ''
+    if end_dt is not None:
+        until = 'AND time < :end_dt'
+        sql_params['end_dt'] = end_dt
+
+    if percentage:
+        # Sum the arrays element by element across all the hosts.
+        sql = "WITH totals AS (" \
+                "    SELECT time, ARRAY[%(sums)s] AS values " \
+                "    FROM %(totals)s AS value_list " \
+                "    WHERE plugin = :plugin " \
+                "      AND time >= :time_dt " \
+                "      %(until)s " \
+                "      %(per_where)s " \
+                "    GROUP BY time " \
+                ") " \
+                "SELECT host, " \
+                "       extract(EPOCH FROM a.time)::BIGINT * 1000 " \
+                "           AS ctime_ms," \
+                "       a.values, b.values AS totals %(columns)s " \
+                "FROM %(source)s AS a, totals b " \
+                "WHERE a.time = b.time " \
+                "  AND plugin = :plugin " \
+                "  AND %(hosts)s " \
+                "  AND a.time >= :time_dt " \
+                "  %(where)s " \
+                "ORDER BY host COLLATE \"C\", a.time;"
+    else:
+        sql = "SELECT host, " \
+                "       extract(EPOCH FROM time)::BIGINT * 1000 " \
+                "           AS ctime_ms, " \
+                "       values %(columns)s " \
+                "FROM %(source)s AS value_list " \
+                "WHERE plugin = :plugin " \
+                "  AND %(hosts)s " \
+                "  AND time >= :time_dt " \
+                "  %(until)s " \
+                "  %(where)s " \
+                "ORDER BY host COLLATE \"C\", time;"
+
+    sums = ', '.join(['sum(values[%d])' % (i + 1) for i in range(length)])
+    if tier is not None:
+        columns = ', min, max, samples'
+    else:
+        columns = ''
+
+    def compose(tables, until):
+        partitions = union(tables)
+        source = partitions
+        if tier is not None:
+            source = rollup_source(tier[0], dstypes, partitions)
+        totals = source
+        if summed:
+            totals = totals_source(partitions)
+        return sql % {'where': where_condition, 'per_where': per_condition,
+                      'sums': sums, 'source': source, 'totals': totals,
+                      'columns': columns, 'until': until,
+                      'hosts': host_condition}
+
+    # Split the longer queries into runs of days read at the same time, when
+    # they are read in full.  The hosts are ordered by their bytes, the order
+    # the slices are stitched back together in, so that they come in the same
+    # order whether the query is split or not.
+    slices = []
+    if since is None:
+        parts = split(tables, fanout.slices)
+        for (start, part_tables), part_params in zip(parts,
+                bounded(parts, sql_params)):
+            part_until = ''
+            if 'end_dt' in part_params:
+                part_until = 'AND time < :end_dt'
+            slices.append((compose(part_tables, part_until), part_params))
+
+    indexes = [i for i in range(length) if dsnames[i] in plot_dsnames]
+
+    return Query(compose(tables, until), sql_params, result['prefix'],
+                 plot_dsnames, dstypes, indexes, percentage, width, envelope,
+                 tier is not None, since, aggregate, group(hosts), slices)
+
+
+def aggregates(params):
+    """ Return the aggregates of the hosts to plot in their place, asked for
+    like aggregate=avg,p95.
+    """
+    return [function for value in params.getall('aggregate') \
+            for function in value.split(',') if function in AGGREGATES]
+
+
+def group(hosts):
+    """ Return the name of a group of hosts in the labels of its aggregates.
+    """
+    if len(hosts) == 1 or [host for host in hosts if '*' in host]:
+        return ','.join(hosts)
+    return '%d hosts' % len(hosts)
+
+
+class CSVStream(object):
+    """ Iterate over the CSV document of one or more queries in chunks of
+    batch_size rows at a time, releasing the connection once the last row has
+    been read or the server closes the response early.
+
+    Each host of each query gets a section of its own, starting with its
+    header, and the sections are separated by blank lines.  A query
+    aggregating its hosts gets a single section instead.
+    """
+    content_type = 'text/csv'
+
+    def __init__(self, connection, queries, batch_size):
+        self.connection = connection
+        self.queries = queries
+        self.batch_size = batch_size
+        self.data = None
+        self.sections = 0
+
+    def __iter__(self):
+        for query in self.queries:
+            self.data = None
+            if query.slices:
+                # Read the days of a long query at the same time, on
+                # connections of their own, if there are threads free for
+                # them.
+                self.data = fanout.read(query.slices, self.batch_size,
+                        self.connection.execute(
+                                'SHOW statement_timeout;').scalar())
+            if self.data is None and query.since is None:
+                # Stream the rows through a named server-side cursor.
+                self.data = self.connection.execution_options(
+                        stream_results=True).execute(text(query.sql),
+                        query.params)
+            elif self.data is None:
+                # Only the newest few rows are read, and the same query is
+                # repeated every time the chart refreshes.  A cursor cannot
+                # be declared for a prepared statement, so only these use
+                # one.
+                self.data = execute(self.connection, query.sql, query.params)
+            if query.aggregate:
+                chunks = self.aggregate(query)
+            else:
+                chunks = self.per_host(query)
+            for chunk in chunks:
+                yield chunk
+            self.data.close()
+        self.close()
+
+    def points(self, query):
+        """ Iterate over the plotted points of each host in the result of
+        query as (host, timestamps, values), with None for the timestamps
+        and values as each host starts.
+        """
+        host = rates = buckets = None
+        rows = self.fetch(query)
+        while len(rows) > 0:
+            # The rows are ordered by host, so a batch may hold the end of
+            # one host and the start of the next.
+            for row_host, host_rows in groupby(rows,
+                                               lambda row: row['host']):
+                if row_host != host:
+                    for ctimes, values in self.flush(buckets):
+                        yield host, ctimes, values
+                    host = row_host
+                    rates = query.rates()
+                    buckets = query.buckets()
+                    yield host, None, None
+                for ctimes, values in self.process(list(host_rows), query,
+                                                   rates, buckets):
+                    yield host, ctimes, values
+            rows = self.fetch(query)
+        for ctimes, values in self.flush(buckets):
+            yield host, ctimes, values
+
+    def per_host(self, query):
+        for host, ctimes, values in self.points(query):
+            if ctimes is None:
+                yield self.start(query.labels(host))
+            else:
+                yield self.format(ctimes, values)
+
+    def aggregate(self, query):
+        """ Iterate over a single section of the aggregates of the hosts of
+        query per bucket.
+        """
+        across = Across(query.aggregate)
+        for host, ctimes, values in self.points(query):
+            if ctimes is None:
+                across.start()
+            else:
+                across.add(ctimes, values)
+        if across.hosts > 0:
+            yield self.start(query.labels(None))
+            ctimes, values = across.reduce()
+            if len(ctimes) > 0:
+                yield self.format(ctimes, values)
+
+    def fetch(self, query):
+        start = time.time()
+        rows = self.data.fetchmany(self.batch_size)
+        if query.since is None:
+            # The rows of a named cursor are read from the server batch by
+            # batch, which the metrics do not see on their own.
+            metrics.fetched(len(rows), time.time() - start)
+        return rows
+
+    def start(self, labels):
+        header = 'timestamp,%s\n' % ','.join(labels)
+        if self.sections > 0:
+            header = '\n' + header
+        self.sections += 1
+        return header.encode('utf-8')
+
+    def format(self, ctimes, values):
+        return format_csv(ctimes, values)
+
+    def flush(self, buckets):
+        if buckets is not None:
+            ctimes, values = buckets.flush()
+            if len(ctimes) > 0:
+                yield ctimes, values
+
+    def process(self, rows, query, rates, buckets):
+        ctimes = numpy.array([row['ctime_ms'] for row in rows])
+        if rates.percentage:
+            totals = matrix(rows, 'totals')
+        else:
+            totals = None
+
+        if query.rollups:
+            samples = numpy.array([row['samples'] for row in rows])
+        else:
+            samples = None
+        ctimes, values = rates.compute(ctimes, matrix(rows, 'values'),
+                totals, samples)
+
+        # The lowest and highest values of the rollups only mean something
+        # for the values that are plotted as they are.
+        lows = highs = None
+        if query.rollups and not rates.percentage:
+            n = len(ctimes)
+            lows = numpy.where(rates.rates, values,
+                    matrix(rows, 'min')[len(rows) - n:, rates.indexes])
+            highs = numpy.where(rates.rates, values,
+                    matrix(rows, 'max')[len(rows) - n:, rates.indexes])
+
+        # Leave out the rows that were only read to seed the rates.
+        if query.since is not None:
+            new = ctimes >= query.since
+            ctimes = ctimes[new]
+            values = values[new]
+            if lows is not None:
+                lows = lows[new]
+                highs = highs[new]
+
+        if buckets is not None:
+            ctimes, values = buckets.add(ctimes, values, lows, highs)
+        if len(ctimes) > 0:
+            yield ctimes, values
+
+    def close(self):
+        if not self.connection.closed:
+            if self.data is not None:
+                self.data.close()
+            self.connection.close()
+
+
+class BinaryStream(CSVStream):
+    """ Iterate over the same series as CSVStream as binary blocks, a header
+    block with the labels of each host followed by blocks of its rows, which
+    the browser can read into typed arrays without parsing any text.
+    """
+    content_type = 'application/octet-stream'
+
+    def start(self, labels):
+        self.sections += 1
+        return format_binary_header(labels)
+
+    def format(self, ctimes, values):
+        return format_binary(ctimes, values)
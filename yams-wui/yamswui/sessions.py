@@ -0,0 +1,246 @@
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+
+from pyramid.interfaces import ISession
+
+from zope.interface import implementer
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger(__name__)
+
+
+def group(url_list):
+    """ Return a list of data.csv urls as [plugin, query string, hosts], with
+    the urls that only differ by host grouped together in the order they
+    first appear.  Any other url is returned as [url].
+    """
+    groups = []
+    index = {}
+    for url in url_list:
+        path, _, query_string = url.partition('?')
+        parts = path.split('/')
+        if len(parts) != 3 or parts[0] != 'data.csv':
+            groups.append([url])
+            continue
+        key = (parts[1], query_string)
+        if key not in index:
+            index[key] = len(groups)
+            groups.append([parts[1], query_string, []])
+        groups[index[key]][2].append(parts[2])
+    return groups
+
+
+def ungroup(groups):
+    """ Return the data.csv urls of the groups made by group(). """
+    url_list = []
+    for entry in groups:
+        if len(entry) == 1:
+            url_list.append(entry[0])
+            continue
+        plugin, query_string, hosts = entry
+        for host in hosts:
+            url = 'data.csv/%s/%s' % (plugin, host)
+            if query_string:
+                url += '?' + query_string
+            url_list.append(url)
+    return url_list
+
+
+def pack(session):
+    """ Serialize the values of a session, keeping a chart of many hosts
+    small by naming each series of the chart only once.
+    """
+    values = dict(session)
+    if 'url_list' in values:
+        values['url_list'] = group(values['url_list'])
+    return json.dumps(values, sort_keys=True, separators=(',', ':'))
+
+
+def unpack(data):
+    values = json.loads(data)
+    if 'url_list' in values:
+        values['url_list'] = ungroup(values['url_list'])
+    return values
+
+
+class MemoryStore(object):
+    """ Keep the sessions in the memory of the process.  Only for a single
+    process, and the sessions are lost when it restarts.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.purged = time.time()
+
+    def load(self, id):
+        with self.lock:
+            entry = self.sessions.get(id)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def save(self, id, data, timeout):
+        now = time.time()
+        with self.lock:
+            self.sessions[id] = (now + timeout, data)
+            if self.purged + 60 <= now:
+                for key, (expires, value) in self.sessions.items():
+                    if expires <= now:
+                        del self.sessions[key]
+                self.purged = now
+        return True
+
+    def touch(self, id, timeout):
+        with self.lock:
+            entry = self.sessions.get(id)
+            if entry is not None:
+                self.sessions[id] = (time.time() + timeout, entry[1])
+
+    def delete(self, id):
+        with self.lock:
+            self.sessions.pop(id, None)
+
+
+class RedisStore(object):
+    """ Keep the sessions in Redis, shared by every process of the WUI, with
+    Redis expiring them.  While Redis cannot be reached the sessions are
+    empty and their changes are not saved.
+    """
+    def __init__(self, url, prefix='yams:session:'):
+        if redis is None:
+            raise ValueError('the redis session store needs the redis '
+                             'package')
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, id):
+        try:
+            data = self.redis.get(self.prefix + id)
+        except redis.RedisError:
+            log.exception('reading a session from Redis failed')
+            return None
+        if data is None:
+            return None
+        return data.decode('utf-8')
+
+    def save(self, id, data, timeout):
+        try:
+            self.redis.setex(self.prefix + id, timeout, data)
+        except redis.RedisError:
+            log.exception('writing a session to Redis failed')
+            return False
+        return True
+
+    def touch(self, id, timeout):
+        try:
+            self.redis.expire(self.prefix + id, timeout)
+        except redis.RedisError:
+            log.exception('renewing a session in Redis failed')
+
+    def delete(self, id):
+        try:
+            self.redis.delete(self.prefix + id)
+        except redis.RedisError:
+            log.exception('deleting a session from Redis failed')
+
+
+def store(settings):
+    """ Return the session store named by the yams.session_store setting. """
+    name = settings.get('yams.session_store', 'cookie')
+    if name == 'memory':
+        return MemoryStore()
+    if name == 'redis':
+        return RedisStore(settings.get('yams.session_redis_url',
+                                       'redis://localhost:6379/0'))
+    raise ValueError('unknown session store %r' % name)
+
+
+def ServerSessionFactory(store, cookie_name='session', timeout=1200):
+    """ Return a session factory keeping the values of each session in store,
+    with only an opaque random id in the cookie.  A session is written back
+    whenever its values changed, including lists and dicts changed in place,
+    and otherwise only has its timeout renewed.  A new session only gets its
+    cookie once the store saved it, so that the cookie of a session the store
+    could not read is kept for when it can again.
+    """
+    @implementer(ISession)
+    class ServerSession(dict):
+        def __init__(self, request):
+            self.request = request
+            self.id = request.cookies.get(cookie_name)
+            self.saved = None
+            if self.id is not None:
+                self.saved = store.load(self.id)
+            if self.saved is None:
+                self.id = None
+                self.new = True
+                self.created = time.time()
+            else:
+                values = unpack(self.saved)
+                self.new = False
+                self.created = values.pop('_created', time.time())
+                self.update(values)
+            request.add_response_callback(self.save)
+
+        def save(self, request, response):
+            if self.id is None and not self:
+                return
+            values = dict(self)
+            values['_created'] = self.created
+            data = pack(values)
+            if self.id is None:
+                id = binascii.hexlify(os.urandom(16))
+                if store.save(id, data, timeout):
+                    self.id = id
+                    self.saved = data
+                    response.set_cookie(cookie_name, self.id, path='/',
+                                        httponly=True)
+            elif data != self.saved:
+                if store.save(self.id, data, timeout):
+                    self.saved = data
+            else:
+                store.touch(self.id, timeout)
+
+        def changed(self):
+            """ The values are compared with what was loaded instead. """
+
+        def invalidate(self):
+            if self.id is not None:
+                store.delete(self.id)
+            self.clear()
+            self.id = None
+            self.saved = None
+            self.new = True
+            self.created = time.time()
+
+        def flash(self, msg, queue='', allow_duplicate=True):
+            storage = self.setdefault('_f_' + queue, [])
+            if allow_duplicate or (msg not in storage):
+                storage.append(msg)
+
+        def pop_flash(self, queue=''):
+            return self.pop('_f_' + queue, [])
+
+        def peek_flash(self, queue=''):
+            return self.get('_f_' + queue, [])
+
+        def new_csrf_token(self):
+            token = binascii.hexlify(os.urandom(20))
+            self['_csrft_'] = token
+            return token
+
+        def get_csrf_token(self):
+            token = self.get('_csrft_', None)
+            if token is None:
+                token = self.new_csrf_token()
+            return token
+
+    return ServerSession
@@ -0,0 +1,60 @@
+import re
+
+from collections import OrderedDict
+
+# The :name parameters of a query, leaving out casts like ::BIGINT.
+PARAMETER = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+
+# Most prepared statements kept on each pooled connection.  The queries of the
+# charts name the partitions they read, so their text changes from one day to
+# the next and the least recently used statements are let go.
+SIZE = 100
+
+
+def prepare(sql):
+    """ Return the text of sql with its :name parameters numbered as $1, $2,
+    ..., in the order they first appear, and the names of the parameters.
+    """
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '$%d' % (names.index(match.group(1)) + 1)
+
+    return PARAMETER.sub(number, sql), names
+
+
+def execute(connection, sql, params=None):
+    """ Execute sql, with :name parameters like text(), as a prepared statement
+    of the database connection underneath connection.  The statement is
+    parsed once per connection, the first time the connection runs it, and
+    PostgreSQL switches to a single generic plan for it once that plans as
+    well as planning each execution on its own.
+    """
+    # The info of the DBAPI connection is cleared whenever the connection is
+    # closed or invalidated, and the statements go away with it.
+    info = connection.connection.info
+    statements = info.setdefault('yams_statements', OrderedDict())
+    # Send the statements without parameters as they are, rather than have
+    # psycopg2 look for parameters in them.
+    verbatim = connection.execution_options(no_parameters=True)
+
+    if sql in statements:
+        # Move it to the end as the most recently used.
+        name, names = statements.pop(sql)
+    else:
+        while len(statements) >= SIZE:
+            old_name, old_names = statements.popitem(last=False)[1]
+            verbatim.execute('DEALLOCATE %s;' % old_name)
+        info['yams_statement'] = info.get('yams_statement', 0) + 1
+        name = 'yams_%d' % info['yams_statement']
+        prepared, names = prepare(sql)
+        verbatim.execute('PREPARE %s AS %s' % (name, prepared.rstrip(';')))
+    statements[sql] = (name, names)
+
+    if not names:
+        return verbatim.execute('EXECUTE %s;' % name)
+    return connection.execute('EXECUTE %s(%s);' % (name,
+            ', '.join(['%%(%s)s' % key for key in names])),
+            dict([(key, params[key]) for key in names]))
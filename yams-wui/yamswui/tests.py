@@ -27,3 +27,818 @@ class TestMyView(unittest.TestCase):
         info = my_view(request)
         self.assertEqual(info['one'].name, 'one')
         self.assertEqual(info['project'], 'yams-wui')
+
+
+class TestRates(unittest.TestCase):
+    def _makeOne(self, dstypes, indexes=None, percentage=False):
+        from .compute import Rates
+        if indexes is None:
+            indexes = range(len(dstypes))
+        return Rates(dstypes, indexes, percentage)
+
+    def test_first_row_dropped(self):
+        import numpy
+        rates = self._makeOne(['derive', 'gauge'])
+        ctimes, values = rates.compute(numpy.array([1000, 2000, 3000]),
+                numpy.array([[1.0, 5.0], [3.0, 6.0], [6.0, 7.0]]))
+        self.assertEqual(list(ctimes), [2000, 3000])
+        self.assertEqual(values.tolist(), [[2.0, 6.0], [3.0, 7.0]])
+
+    def test_batches_continue(self):
+        import numpy
+        rates = self._makeOne(['derive'])
+        rates.compute(numpy.array([1000, 2000]), numpy.array([[1.0], [3.0]]))
+        ctimes, values = rates.compute(numpy.array([3000]),
+                numpy.array([[7.0]]))
+        self.assertEqual(list(ctimes), [3000])
+        self.assertEqual(values.tolist(), [[4.0]])
+
+    def test_counter_wrap_around(self):
+        import numpy
+        rates = self._makeOne(['counter', 'derive'])
+        ctimes, values = rates.compute(numpy.array([1000, 2000]),
+                numpy.array([[2.0 ** 32 - 10, 10.0], [5.0, 4.0]]))
+        self.assertEqual(values.tolist(), [[15.0, -6.0]])
+
+    def test_percentage(self):
+        import numpy
+        rates = self._makeOne(['derive', 'gauge'], percentage=True)
+        ctimes, values = rates.compute(numpy.array([1000, 2000]),
+                numpy.array([[1.0, 1.0], [2.0, 3.0]]),
+                numpy.array([[2.0, 0.0], [6.0, 0.0]]))
+        self.assertEqual(values.tolist(), [[25.0, 0.0]])
+
+    def test_format_csv(self):
+        import numpy
+        from .compute import format_csv
+        self.assertEqual(format_csv(numpy.array([1000, 2000]),
+                numpy.array([[1.5], [0.25]])), '1000,1.5\n2000,0.25\n')
+
+
+class TestBuckets(unittest.TestCase):
+    def test_average_across_batches(self):
+        import numpy
+        from .compute import Buckets
+        buckets = Buckets(10)
+        ctimes, values = buckets.add(numpy.array([0, 5, 10]),
+                numpy.array([[1.0], [3.0], [4.0]]))
+        self.assertEqual(list(ctimes), [0])
+        self.assertEqual(values.tolist(), [[2.0]])
+        ctimes, values = buckets.add(numpy.array([15, 20]),
+                numpy.array([[6.0], [1.0]]))
+        self.assertEqual(list(ctimes), [10])
+        self.assertEqual(values.tolist(), [[5.0]])
+        ctimes, values = buckets.flush()
+        self.assertEqual(list(ctimes), [20])
+        self.assertEqual(values.tolist(), [[1.0]])
+
+    def test_envelope(self):
+        import numpy
+        from .compute import Buckets
+        buckets = Buckets(10, envelope=True)
+        buckets.add(numpy.array([0, 5]), numpy.array([[1.0], [3.0]]))
+        ctimes, values = buckets.flush()
+        self.assertEqual(values.tolist(), [[2.0, 1.0, 3.0]])
+
+
+class TestAcross(unittest.TestCase):
+    def test_aggregates(self):
+        import numpy
+        from .compute import Across
+        across = Across(['sum', 'avg', 'min', 'max', 'p50'])
+        across.start()
+        across.add(numpy.array([0, 1000]), numpy.array([[1.0], [2.0]]))
+        across.start()
+        across.add(numpy.array([1000]), numpy.array([[4.0]]))
+        across.add(numpy.array([2000]), numpy.array([[6.0]]))
+        ctimes, values = across.reduce()
+        self.assertEqual(ctimes.tolist(), [0, 1000, 2000])
+        self.assertEqual(values.tolist(), [[1.0, 1.0, 1.0, 1.0, 1.0],
+                                           [6.0, 3.0, 2.0, 4.0, 3.0],
+                                           [6.0, 6.0, 6.0, 6.0, 6.0]])
+
+    def test_gap(self):
+        import numpy
+        from .compute import Across
+        across = Across(['sum', 'avg', 'p50'])
+        across.start()
+        across.add(numpy.array([0, 1000]), numpy.array([[1.0], [numpy.nan]]))
+        across.start()
+        across.add(numpy.array([0, 1000]), numpy.array([[2.0], [numpy.nan]]))
+        ctimes, values = across.reduce()
+        self.assertEqual(values[0].tolist(), [3.0, 1.5, 1.5])
+        # A bucket without a value from any host stays a gap.
+        self.assertTrue(numpy.isnan(values[1]).all())
+
+    def test_labels(self):
+        from .series import (
+            Query,
+            group,
+            )
+        self.assertEqual(group(['web*']), 'web*')
+        self.assertEqual(group(['a', 'b', 'c']), '3 hosts')
+        query = Query('', {}, 'cpu.cpu.user', ['value'], ['derive'], [0],
+                      False, 60000, False, False, aggregate=['avg', 'p95'],
+                      group='3 hosts')
+        self.assertEqual(query.labels(None),
+                         ['avg(3 hosts).cpu.cpu.user.value',
+                          'p95(3 hosts).cpu.cpu.user.value'])
+
+
+class TestRollups(unittest.TestCase):
+    def test_choose_tier(self):
+        from .rollups import choose_tier
+        self.assertEqual(choose_tier(30), None)
+        self.assertEqual(choose_tier(60), ('1min', 60))
+        self.assertEqual(choose_tier(1000), ('15min', 900))
+        self.assertEqual(choose_tier(86400), ('1hour', 3600))
+
+    def test_source_uses_last_for_counters(self):
+        from .rollups import source
+        sql = source('1min', ['counter', 'gauge'])
+        self.assertTrue('ARRAY[last[1], avg[2]]' in sql)
+        self.assertTrue('rollup_1min' in sql)
+
+    def test_totals_source(self):
+        from .rollups import totals_source
+        sql = totals_source('(SELECT * FROM vl_cpu_20140102)')
+        self.assertTrue('FROM plugin_totals' in sql)
+        self.assertTrue('FROM (SELECT * FROM vl_cpu_20140102) AS value_list'
+                        in sql)
+
+    def test_backfill_after_expiry_keeps_rollups(self):
+        from datetime import datetime, timedelta
+        from .rollups import redo, utc
+        start = datetime(2013, 5, 8, tzinfo=utc)
+        mark = [{'time': start + timedelta(days=3)}]
+        # The watermark, DELETE and INSERT of each tier and of the totals,
+        # the watermark and the upsert of the series dictionary, then the
+        # update of the watermark of the backfills.
+        connection = DummyConnection([mark, [], []] * 4 + [mark, [], [{}]])
+        redo(connection, start, start + timedelta(days=1))
+        deletes = [sql for sql in connection.queries \
+                   if sql.startswith('DELETE')]
+        self.assertEqual(len(deletes), 4)
+        # Only the rows of the series still having value lists that day are
+        # replaced, the ones of the series of expired partitions are kept.
+        self.assertTrue('FROM value_list' in deletes[0])
+        self.assertTrue('FROM value_list' in deletes[3])
+        self.assertFalse('FROM value_list' in deletes[1])
+        # The watermarks stay where they are, only the time of the last
+        # backfill moves on.
+        self.assertEqual(len([sql for sql in connection.queries \
+                              if sql.startswith('UPDATE rollup_watermark')]),
+                         1)
+
+
+class TestPartitions(unittest.TestCase):
+    def test_parse(self):
+        from .partitions import parse
+        self.assertEqual(parse('vl_cpu_20140102'), ('cpu', '20140102', None))
+        self.assertEqual(parse('vl_postgresql_20140102_pg_blks'),
+                ('postgresql', '20140102', 'pg_blks'))
+        self.assertEqual(parse('value_list'), None)
+
+    def test_resolve(self):
+        from datetime import datetime
+        from .partitions import resolve, utc
+        existing = ['vl_cpu_20140101', 'vl_cpu_20140102',
+                    'vl_postgresql_20140102_pg_blks',
+                    'vl_postgresql_20140102_pg_xact']
+        start = datetime(2014, 1, 1, 23, tzinfo=utc)
+        end = datetime(2014, 1, 3, 1, tzinfo=utc)
+        self.assertEqual(resolve('cpu', start, end, existing=existing),
+                ['vl_cpu_20140101', 'vl_cpu_20140102'])
+        self.assertEqual(resolve('postgresql', start, end, 'pg_blks',
+                existing), ['vl_postgresql_20140102_pg_blks'])
+        self.assertEqual(resolve('postgresql', start, end, existing=existing),
+                ['vl_postgresql_20140102_pg_blks',
+                 'vl_postgresql_20140102_pg_xact'])
+        self.assertEqual(resolve('memory', start, end, existing=existing), [])
+
+
+class DummyResult(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.rowcount = len(rows)
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def first(self):
+        if self.rows:
+            return self.rows[0]
+        return None
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class DummyConnection(object):
+    closed = False
+
+    def __init__(self, results):
+        self.results = results
+        self.statements = []
+        self.queries = []
+        # Stands in for the DBAPI connection as well.
+        self.connection = self
+        self.info = {}
+
+    def execution_options(self, **kwargs):
+        return self
+
+    def begin(self):
+        return self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def execute(self, sql, params=None):
+        self.statements.append(str(sql).split(' ')[0])
+        self.queries.append(str(sql))
+        if self.statements[-1] in ('PREPARE', 'DEALLOCATE'):
+            return None
+        return DummyResult(self.results.pop(0))
+
+    def close(self):
+        self.closed = True
+
+
+class TestCSVStream(unittest.TestCase):
+    def test_section_per_host(self):
+        from .series import CSVStream, Query
+        rows = [{'host': host, 'ctime_ms': ctime_ms, 'values': [value]} \
+                for host, ctime_ms, value in [('a', 1000, 1.0),
+                                              ('a', 2000, 3.0),
+                                              ('b', 1000, 5.0),
+                                              ('b', 2000, 6.0)]]
+        query = Query('', {}, 'cpu.cpu.user', ['value'], ['derive'], [0],
+                False, None, False, False)
+        connection = DummyConnection([rows])
+        body = ''.join(CSVStream(connection, [query], 3))
+        self.assertEqual(body, 'timestamp,a.cpu.cpu.user.value\n'
+                               '2000,2.0\n'
+                               '\n'
+                               'timestamp,b.cpu.cpu.user.value\n'
+                               '2000,1.0\n')
+        self.assertTrue(connection.closed)
+
+    def test_since(self):
+        from .series import CSVStream, Query
+        rows = [{'host': 'a', 'ctime_ms': ctime_ms, 'values': [value]} \
+                for ctime_ms, value in [(1000, 1.0), (2000, 3.0),
+                                        (3000, 6.0), (4000, 10.0)]]
+        query = Query('', {}, 'cpu.cpu.user', ['value'], ['derive'], [0],
+                False, None, False, False, since=3000)
+        body = ''.join(CSVStream(DummyConnection([rows]), [query], 10))
+        self.assertEqual(body, 'timestamp,a.cpu.cpu.user.value\n'
+                               '3000,3.0\n'
+                               '4000,4.0\n')
+
+    def test_batch_since(self):
+        from pyramid.testing import DummyRequest
+        from .series import CSVStream, Query
+        from .views import chart_specs
+        request = DummyRequest(params={'since': '3000'})
+        request.session['url_list'] = ['data.csv/cpu/a?type=cpu',
+                                       'data.csv/memory/a?type=memory']
+        batch = chart_specs(request)
+        self.assertEqual([params['since'] for plugin, hosts, params in batch],
+                         ['3000', '3000'])
+        self.assertFalse('since' in request.session['url_list'][0])
+
+        rows = [{'host': 'a', 'ctime_ms': ctime_ms, 'values': [value]} \
+                for ctime_ms, value in [(2000, 1.0), (3000, 3.0),
+                                        (4000, 6.0)]]
+        query = Query('', {}, 'cpu.cpu.user', ['value'], ['gauge'], [0],
+                False, None, False, False, since=int(batch[0][2]['since']))
+        body = ''.join(CSVStream(DummyConnection([rows]), [query], 10))
+        self.assertEqual(body, 'timestamp,a.cpu.cpu.user.value\n'
+                               '3000,3.0\n'
+                               '4000,6.0\n')
+
+    def test_binary(self):
+        import struct
+        import numpy
+        from .series import BinaryStream, Query
+        rows = [{'host': 'a', 'ctime_ms': 1000, 'values': [1.0, 2.0]},
+                {'host': 'a', 'ctime_ms': 2000, 'values': [3.0, 4.0]}]
+        query = Query('', {}, 'memory.memory', ['x', 'y'], ['gauge', 'gauge'],
+                [0, 1], False, None, False, False)
+        body = ''.join(BinaryStream(DummyConnection([rows]), [query], 10))
+        length, count = struct.unpack_from('<II', body)
+        self.assertEqual(count, 0)
+        self.assertEqual(length % 8, 0)
+        offset = 8 + length
+        self.assertEqual(struct.unpack_from('<II', body, offset), (0, 1))
+        self.assertEqual(numpy.frombuffer(body, '<f8', offset=offset + 8)
+                .tolist(), [2000.0, 3.0, 4.0])
+
+
+class TestCatalog(unittest.TestCase):
+    def _load(self, recorded):
+        from .catalog import Catalog
+        catalog = Catalog()
+        catalog.newest = {('cpu', None): 'vl_cpu_20140102'}
+        connection = DummyConnection([
+                [{'time': recorded}] if recorded else [],
+                [{'type': 'cpu', 'plugin_instances': ['1', '0'],
+                  'type_instances': ['user', ''], 'hosts': ['a'],
+                  'dsnames': ['value'], 'meta_keys': None}]])
+        types = catalog.load(connection, ('cpu', None))
+        return connection.queries[-1], types
+
+    def test_from_dictionary(self):
+        from datetime import datetime
+        from .partitions import utc
+        sql, types = self._load(datetime(2014, 1, 2, 0, 5, tzinfo=utc))
+        self.assertTrue('FROM series' in sql)
+        self.assertEqual(types['cpu']['plugin_instances'], ['0', '1'])
+        self.assertEqual(types['cpu']['type_instances'], ['user'])
+        self.assertEqual(types['cpu']['meta_keys'], [])
+
+    def test_from_partition_until_recorded(self):
+        from datetime import datetime
+        from .partitions import utc
+        sql, types = self._load(datetime(2014, 1, 1, 23, 55, tzinfo=utc))
+        self.assertTrue('FROM "vl_cpu_20140102"' in sql)
+        sql, types = self._load(None)
+        self.assertTrue('FROM "vl_cpu_20140102"' in sql)
+
+    def test_version_only_moves_on_change(self):
+        from .catalog import Catalog
+        catalog = Catalog()
+        catalog.newest = {('cpu', None): 'vl_cpu_20140102'}
+
+        def load(hosts):
+            catalog.load(DummyConnection([[],
+                    [{'type': 'cpu', 'plugin_instances': ['0'],
+                      'type_instances': ['user'], 'hosts': hosts,
+                      'dsnames': ['value'], 'meta_keys': None}]]),
+                    ('cpu', None))
+            return catalog.version
+
+        self.assertEqual(load(['a']), 1)
+        self.assertEqual(load(['a']), 1)
+        self.assertEqual(load(['a', 'b']), 2)
+
+
+class TestStatements(unittest.TestCase):
+    def test_prepare(self):
+        from .statements import prepare
+        self.assertEqual(prepare(
+                "SELECT time::DATE FROM a WHERE b = :b AND c < :c "
+                "AND d = :b;"),
+                ("SELECT time::DATE FROM a WHERE b = $1 AND c < $2 "
+                 "AND d = $1;", ['b', 'c']))
+
+    def test_prepared_once_per_connection(self):
+        from . import statements
+        connection = DummyConnection([[], [], [], []])
+        statements.execute(connection, 'SELECT :a;', {'a': 1})
+        statements.execute(connection, 'SELECT :a;', {'a': 2})
+        self.assertEqual(connection.statements,
+                         ['PREPARE', 'EXECUTE', 'EXECUTE'])
+
+        # The least recently used statement is let go.
+        size = statements.SIZE
+        statements.SIZE = 1
+        try:
+            statements.execute(connection, 'SELECT 1;')
+        finally:
+            statements.SIZE = size
+        self.assertEqual(connection.statements[3:],
+                         ['DEALLOCATE', 'PREPARE', 'EXECUTE'])
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_points(self):
+        from .scripts.benchmark import points
+        body = 'timestamp,a\n1000,1.0\n2000,2.0\n\ntimestamp,b\n1000,3.0\n'
+        self.assertEqual(points('/data.csv/cpu/a?type=cpu', body), 3)
+        self.assertEqual(points('/data_batch.csv?format=binary', body), None)
+        self.assertEqual(points('/plugins', body), None)
+
+    def test_value_lists(self):
+        import numpy
+        from .scripts.generate import value_lists
+        partitions = value_lists('h', 86400, 2, 10,
+                                 numpy.random.RandomState(0))
+        self.assertEqual(len(partitions['vl_cpu_19700102']), 32)
+        line = partitions['vl_postgresql_19700102_pg_numbackends'][0]
+        self.assertEqual(line.split('\t')[:3],
+                         ['1970-01-02 00:00:00+00', '10', 'h'])
+        self.assertEqual(line.split('\t')[-1], '"database"=>"postgres"\n')
+
+
+class TestBackfill(unittest.TestCase):
+    def test_identify(self):
+        from .scripts.backfill import identify
+        self.assertEqual(identify('/csv/h1/interface-eth0/if_octets-'
+                                  '2013-05-01'),
+                         ('h1', 'interface', 'eth0', 'if_octets', ''))
+        self.assertEqual(identify('h1/cpu-0/cpu-idle.xml', 'h2'),
+                         ('h2', 'cpu', '0', 'cpu', 'idle'))
+
+    def test_line(self):
+        from .ingest import line
+        self.assertEqual(line(86400.5, 10, u'h', 'postgresql', 'app',
+                              'pg_numbackends', '', ['value'], ['gauge'],
+                              [1.0, None], {'database': 'a\tb'}),
+                         '1970-01-02 00:00:00+00\t10\th\tpostgresql\tapp\t'
+                         'pg_numbackends\t\t{"value"}\t{"gauge"}\t'
+                         '{1.0,NULL}\t"database"=>"a\\tb"\n')
+
+    def test_read_rrd(self):
+        import numpy
+        from cStringIO import StringIO
+        from .scripts.backfill import read_rrd
+
+        def rows(values):
+            return ''.join(['<row><v>%s</v></row>' % value \
+                            for value in values])
+
+        dump = '<rrd><step>10</step><lastupdate>1005</lastupdate>' \
+               '<ds><name> value </name><type> DERIVE </type></ds>' \
+               '<rra><cf>AVERAGE</cf><pdp_per_row>1</pdp_per_row>' \
+               '<database>%s</database></rra>' \
+               '<rra><cf>AVERAGE</cf><pdp_per_row>10</pdp_per_row>' \
+               '<database>%s</database></rra></rrd>' % (
+                       rows(('NaN', '1.0', '2.0')),
+                       rows(('3.0', '4.0', '5.0')))
+        value_lists = read_rrd(StringIO(dump), ('h', 'cpu', '0', 'cpu',
+                                                'idle'))
+        self.assertEqual([(vl[0], vl[1], vl[9]) for vl in value_lists],
+                         [(800, 100, [300.0]), (900, 100, [700.0]),
+                          (990, 10, [790.0]), (1000, 10, [810.0])])
+        # The rates of both archives come back from the value lists.
+        times = numpy.array([vl[0] for vl in value_lists])
+        values = numpy.array([vl[9][0] for vl in value_lists])
+        self.assertEqual((numpy.diff(values) / numpy.diff(times)).tolist(),
+                         [4.0, 1.0, 2.0])
+
+
+class TestExpire(unittest.TestCase):
+    def test_expired(self):
+        from datetime import date
+        from .scripts.expire import (
+            expired,
+            policy,
+            )
+        days = policy({'yams.retention_days': '7',
+                       'yams.retention_days.cpu': '1',
+                       'yams.retention_days.memory': '0'})
+        self.assertEqual(days, {None: 7, 'cpu': 1, 'memory': 0})
+        tables = ['vl_cpu_20130510', 'vl_cpu_20130508', 'vl_memory_20130101',
+                  'vl_postgresql_20130501_pg_xact', 'vl_disk_20130504',
+                  'rollup_1min']
+        self.assertEqual(expired(tables, days, date(2013, 5, 11),
+                                 date(2013, 5, 10)),
+                         ['vl_postgresql_20130501_pg_xact', 'vl_cpu_20130508'])
+        # Nothing is expired before it is rolled up.
+        self.assertEqual(expired(tables, days, date(2013, 5, 11),
+                                 date(2013, 5, 8)),
+                         ['vl_postgresql_20130501_pg_xact'])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_export(self):
+        from .metrics import Metrics
+        metrics = Metrics()
+        for rows in (5, 500):
+            request = metrics.begin('data_csv', '/data.csv/cpu/a')
+            metrics.fetched(rows, 0.5)
+            metrics.finish(request)
+        self.assertEqual(metrics.current(), None)
+        lines = metrics.export().split('\n')
+        self.assertTrue('yams_request_rows_bucket{route="data_csv",le="10"} 1'
+                        in lines)
+        self.assertTrue('yams_request_rows_bucket{route="data_csv",le="1000"} '
+                        '2' in lines)
+        self.assertTrue('yams_request_rows_sum{route="data_csv"} 505.0'
+                        in lines)
+        self.assertTrue('yams_request_sql_duration_seconds_count'
+                        '{route="data_csv"} 2' in lines)
+
+
+class TestGovernor(unittest.TestCase):
+    def test_timeouts(self):
+        from .governor import (
+            Governor,
+            timeouts,
+            )
+        governor = Governor()
+        governor.timeouts = timeouts({'yams.statement_timeout': '30000',
+                'yams.statement_timeout.data_batch': '60000',
+                'yams.max_streams': '4'})
+        self.assertEqual(governor.timeout('data_batch'), 60000)
+        self.assertEqual(governor.timeout('hosts'), 30000)
+
+    def test_admit(self):
+        from .governor import Governor
+        governor = Governor()
+        self.assertTrue(governor.admit())
+        governor.release()
+        self.assertEqual(governor.busy, 0)
+
+        governor.slots = 1
+        self.assertTrue(governor.admit())
+        self.assertFalse(governor.admit())
+        governor.release()
+        self.assertTrue(governor.admit())
+
+
+class TestSessions(unittest.TestCase):
+    def test_pack(self):
+        from .sessions import (
+            pack,
+            unpack,
+            )
+        session = {'time_range': 24, 'url_list': [
+                'data.csv/cpu/a?type=cpu', 'data.csv/cpu/b?type=cpu',
+                'data.csv/memory/a?type=memory', 'data.csv/cpu/c?type=cpu']}
+        data = pack(session)
+        self.assertEqual(data.count('type=cpu'), 1)
+        self.assertEqual(unpack(data)['url_list'], [
+                'data.csv/cpu/a?type=cpu', 'data.csv/cpu/b?type=cpu',
+                'data.csv/cpu/c?type=cpu', 'data.csv/memory/a?type=memory'])
+
+    def test_server_session(self):
+        from pyramid.response import Response
+        from pyramid.testing import DummyRequest
+        from .sessions import (
+            MemoryStore,
+            ServerSessionFactory,
+            )
+        store = MemoryStore()
+        factory = ServerSessionFactory(store)
+
+        request = DummyRequest()
+        session = factory(request)
+        self.assertTrue(session.new)
+        session['url_list'] = ['data.csv/cpu/a?type=cpu']
+        response = Response()
+        request.response_callbacks[0](request, response)
+        id = response.headers['Set-Cookie'].split(';')[0].split('=')[1]
+        self.assertEqual(len(id), 32)
+
+        # Lists changed in place are saved too, and the cookie stays.
+        request = DummyRequest(cookies={'session': id})
+        session = factory(request)
+        self.assertFalse(session.new)
+        session['url_list'].append('data.csv/cpu/b?type=cpu')
+        response = Response()
+        request.response_callbacks[0](request, response)
+        self.assertFalse('Set-Cookie' in response.headers)
+
+        session = factory(DummyRequest(cookies={'session': id}))
+        self.assertEqual(session['url_list'], ['data.csv/cpu/a?type=cpu',
+                                               'data.csv/cpu/b?type=cpu'])
+        session.invalidate()
+        self.assertEqual(store.load(id), None)
+
+    def test_store_down(self):
+        from pyramid.response import Response
+        from pyramid.testing import DummyRequest
+        from .sessions import ServerSessionFactory
+
+        class DownStore(object):
+            def load(self, id):
+                return None
+
+            def save(self, id, data, timeout):
+                return False
+
+        factory = ServerSessionFactory(DownStore())
+        request = DummyRequest(cookies={'session': 'a' * 32})
+        session = factory(request)
+        self.assertTrue(session.new)
+        session['time_range'] = 24
+        response = Response()
+        request.response_callbacks[0](request, response)
+        # The cookie of the session is kept for when the store is back.
+        self.assertFalse('Set-Cookie' in response.headers)
+
+
+class TestCaching(unittest.TestCase):
+    def test_matching_etag(self):
+        from pyramid.testing import DummyRequest
+        from webob.etag import ETagMatcher
+        from .views import not_modified
+        request = DummyRequest()
+        request.if_none_match = ETagMatcher(['abc'])
+        self.assertTrue(not_modified(request, 'abc'))
+        self.assertEqual(request.response.status_int, 304)
+        self.assertEqual(request.response.etag, 'abc')
+
+        request = DummyRequest()
+        request.if_none_match = ETagMatcher(['abc'])
+        self.assertFalse(not_modified(request, 'def'))
+        self.assertEqual(request.response.status_int, 200)
+
+    def test_window(self):
+        from .rollups import epoch
+        from .series import window
+        start, end = window(1, 60)
+        self.assertEqual(epoch(start) % 60, 0)
+        self.assertTrue(0 <= epoch(end) - 3600 - epoch(start) < 61)
+
+
+class TestTiles(unittest.TestCase):
+    def test_resolution(self):
+        from webob.multidict import MultiDict
+        from .tiles import (
+            bounds,
+            resolution,
+            )
+        self.assertEqual(bounds(MultiDict(start='1000', end='5000')),
+                         (1000, 5000))
+        self.assertEqual(bounds(MultiDict(start='5000', end='1000')), None)
+        self.assertEqual(bounds(MultiDict(start='1000')), None)
+        # A day in 1000 points takes 86.4s buckets, rounded up to 120s.
+        self.assertEqual(resolution(0, 86400000, 1000), 120000)
+        self.assertEqual(resolution(0, 1000, 1000), 1000)
+        self.assertEqual(resolution(0, 1000 * 86400000, 100), 864000000)
+
+    def test_pack(self):
+        import numpy
+        from .tiles import (
+            empty,
+            pack,
+            unpack,
+            )
+        ctimes = numpy.array([0.0, 1000.0])
+        values = numpy.array([[1.0, 2.0], [3.0, numpy.nan]])
+        labels, unpacked_ctimes, unpacked_values = unpack(pack((['a', 'b'],
+                ctimes, values)))
+        self.assertEqual(labels, ['a', 'b'])
+        self.assertEqual(list(unpacked_ctimes), [0.0, 1000.0])
+        self.assertEqual(unpacked_values[0].tolist(), [1.0, 2.0])
+        self.assertTrue(numpy.isnan(unpacked_values[1][1]))
+        labels, ctimes, values = unpack(pack(empty()))
+        self.assertEqual((labels, len(ctimes)), (None, 0))
+
+    def test_cache(self):
+        import time
+        import numpy
+        from .tiles import Cache
+        cache = Cache()
+        cache.configure(1000, delay=300)
+        self.assertTrue(cache.complete((time.time() - 301) * 1000))
+        self.assertFalse(cache.complete((time.time() - 299) * 1000))
+
+        tile = (['a'], numpy.zeros(20), numpy.zeros((20, 1)))
+        cache.put(('cpu', 1), tile)
+        cache.put(('cpu', 2), tile)
+        self.assertTrue(cache.get(('cpu', 1)) is tile)
+        # The least recently used tile makes room for the next one.
+        cache.put(('cpu', 3), tile)
+        self.assertEqual(cache.get(('cpu', 2)), None)
+        self.assertTrue(cache.get(('cpu', 1)) is tile)
+        self.assertTrue(cache.bytes <= 1000)
+
+
+class TestPrewarmer(unittest.TestCase):
+    def test_key_of_saved_urls(self):
+        from .series import (
+            key,
+            specs,
+            )
+        # The urls read back from the dashboard table are unicode.
+        urls = ['data.csv/cpu/h1?type=cpu', 'data.csv/cpu/h2?type=cpu']
+        self.assertEqual(key(specs(urls), 24, True),
+                         key(specs([unicode(url) for url in urls]), 24, True))
+
+    def test_lookup_expires(self):
+        import time
+        from .dashboards import Prewarmer
+        prewarmer = Prewarmer()
+        prewarmer.entries['a'] = (time.time() + 60, 'etag', None,
+                                  'text/csv', 'body')
+        prewarmer.entries['b'] = (time.time() - 1, 'etag', None,
+                                  'text/csv', 'body')
+        self.assertEqual(prewarmer.lookup('a'),
+                         ('etag', None, 'text/csv', 'body'))
+        self.assertEqual(prewarmer.lookup('b'), None)
+        self.assertEqual(prewarmer.lookup('c'), None)
+
+
+class TestSubscriber(unittest.TestCase):
+    def _makeOne(self, query_string):
+        from urlparse import parse_qsl
+        from webob.multidict import MultiDict
+        from .live import Subscriber
+        params = MultiDict(parse_qsl(query_string))
+        return Subscriber([('cpu', ['h1'], params)], None)
+
+    def _value_list(self, value, time, host='h1', type_instance='user'):
+        return {'host': host, 'plugin': 'cpu', 'plugin_instance': '0',
+                'type': 'cpu', 'type_instance': type_instance,
+                'dsnames': ['value'], 'dstypes': ['derive'],
+                'values': [value], 'time': time, 'meta': {}}
+
+    def test_rates(self):
+        subscriber = self._makeOne('type=cpu&type_instance=user')
+        self.assertEqual(subscriber.points(self._value_list(1.0, 10)), None)
+        self.assertEqual(subscriber.points(self._value_list(4.0, 20)),
+                {'ctime_ms': 20000,
+                 'labels': ['h1.cpu.0.cpu.user.value'],
+                 'values': [3.0]})
+
+    def test_match(self):
+        subscriber = self._makeOne('type=cpu&type_instance=user')
+        self.assertTrue(subscriber.wants(self._value_list(1.0, 10)))
+        self.assertFalse(subscriber.wants(self._value_list(1.0, 10, 'h2')))
+        self.assertFalse(subscriber.wants(
+                self._value_list(1.0, 10, type_instance='idle')))
+        subscriber = self._makeOne('type=cpu&percentage=1')
+        self.assertFalse(subscriber.wants(self._value_list(1.0, 10)))
+
+    def test_truncated(self):
+        subscriber = self._makeOne('type=cpu&meta=db&db=postgres')
+        value_list = {'host': 'h1', 'plugin': 'cpu', 'plugin_instance': '0',
+                      'type': 'cpu', 'type_instance': 'user', 'time': 10,
+                      'truncated': True}
+        self.assertEqual(subscriber.points(value_list), {'refresh': True})
+
+
+class TestRanking(unittest.TestCase):
+    def test_groups(self):
+        from webob.multidict import MultiDict
+        from .ranking import groups
+        self.assertEqual(groups(MultiDict()), ['host'])
+        self.assertEqual(groups(MultiDict([
+                ('group', 'type_instance,host'), ('group', 'nope')])),
+                ['host', 'type_instance'])
+
+    def test_source_urls(self):
+        from .views import source_urls
+        self.assertEqual(source_urls('cpu', ['h1', 'h2'], 'cpu',
+                                     type_instance='user', aggregate=True),
+                ['data.csv/cpu/h1?type=cpu&type_instance=user'
+                 '&aggregate=avg,min,max,p95',
+                 'data.csv/cpu/h2?type=cpu&type_instance=user'
+                 '&aggregate=avg,min,max,p95'])
+        self.assertEqual(source_urls('cpu', ['*'], 'cpu', '0',
+                                     percentage=True),
+                ['data.csv/cpu/*?type=cpu&plugin_instance=0&percentage=1'])
+
+
+class DummyEngine(object):
+    def __init__(self, results):
+        self.results = results
+
+    def connect(self):
+        # The statement timeout is set before the query of each slice.
+        return DummyConnection([[], self.results.pop(0)])
+
+
+class TestFanOut(unittest.TestCase):
+    def test_split(self):
+        from datetime import datetime
+        from .fanout import bounded, split
+        from .partitions import utc
+        tables = ['vl_cpu_20140101', 'vl_cpu_20140102', 'vl_cpu_20140103']
+        parts = split(tables, 2)
+        self.assertEqual(parts,
+                [(datetime(2014, 1, 1, tzinfo=utc), ['vl_cpu_20140101']),
+                 (datetime(2014, 1, 2, tzinfo=utc),
+                  ['vl_cpu_20140102', 'vl_cpu_20140103'])])
+        self.assertEqual(split(tables[:1], 4), [])
+        self.assertEqual(split(tables, 1), [])
+        start = datetime(2014, 1, 1, 12, tzinfo=utc)
+        self.assertEqual(bounded(parts, {'time_dt': start}),
+                [{'time_dt': start,
+                  'end_dt': datetime(2014, 1, 2, tzinfo=utc)},
+                 {'time_dt': datetime(2014, 1, 2, tzinfo=utc)}])
+
+    def test_stitched(self):
+        from .fanout import FanOut
+        rows = [[{'host': host, 'ctime_ms': ctime_ms} \
+                 for host, ctime_ms in slice_rows] \
+                for slice_rows in [[('a', 1000), ('a', 2000), ('b', 1000)],
+                                   [('a', 3000), ('c', 3000)]]]
+        fanout = FanOut()
+        fanout.configure(DummyEngine(rows), threads=2)
+        self.assertEqual(fanout.read([('', {})] * 3, 10, '0'), None)
+        stitched = fanout.read([('', {}), ('', {})], 10, '0')
+        fetched = []
+        batch = stitched.fetchmany(2)
+        while batch:
+            fetched += batch
+            batch = stitched.fetchmany(2)
+        self.assertEqual([(row['host'], row['ctime_ms']) for row in fetched],
+                [('a', 1000), ('a', 2000), ('a', 3000), ('b', 1000),
+                 ('c', 3000)])
+        stitched.close()
+        fanout.pool.close()
+        fanout.pool.join()
+        self.assertEqual(fanout.free, 2)
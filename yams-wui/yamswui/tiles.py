@@ -0,0 +1,331 @@
+import json
+import logging
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import md5
+
+import numpy
+
+from webob.multidict import MultiDict
+
+from .catalog import catalog
+from .partitions import utc
+from .series import (
+    CSVStream,
+    aggregates,
+    query,
+    )
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger(__name__)
+
+# Buckets per tile.
+TILE = 256
+
+# The widths of the buckets in seconds.  The width a chart asks for is
+# rounded up to one of these, so that charts zoomed to about the same span
+# share their tiles.
+WIDTHS = [1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200,
+          10800, 21600, 43200, 86400]
+
+# The url parameters that do not change what a tile holds.
+IGNORED = ('start', 'end', 'since', 'format', 'max_points', 'url')
+
+
+def bounds(params):
+    """ Return the start and end of the chart asked for in milliseconds, or
+    None for the last time_range hours.
+    """
+    try:
+        start = int(params['start'])
+        end = int(params['end'])
+    except (KeyError, ValueError):
+        return None
+    if start < 0 or end <= start:
+        return None
+    return start, end
+
+
+def resolution(start, end, max_points):
+    """ Return the width in milliseconds of the buckets of a chart from start
+    to end showing at most max_points points.
+    """
+    width = (end - start) / max(max_points, 1)
+    for seconds in WIDTHS:
+        if seconds * 1000 >= width:
+            return seconds * 1000
+    day = WIDTHS[-1] * 1000
+    return (width + day - 1) // day * day
+
+
+class Cache(object):
+    """ Keep the tiles that are complete, no newer value lists can arrive for
+    them, for ttl seconds.  The most recently used ones are kept in memory up
+    to size bytes, and with a Redis url they are also kept there for the
+    other processes of the WUI to use.  Only the tiles in memory are used
+    while Redis cannot be reached.
+    """
+    def __init__(self):
+        self.size = 0
+        self.ttl = 86400
+        self.delay = 300
+        self.redis = None
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        self.bytes = 0
+
+    def configure(self, size, ttl=86400, delay=300, url=None):
+        self.size = size
+        self.ttl = ttl
+        self.delay = delay
+        if url:
+            if redis is None:
+                raise ValueError('sharing the tiles needs the redis package')
+            self.redis = redis.StrictRedis.from_url(url)
+
+    def complete(self, end):
+        """ Return whether a tile ending at end milliseconds is complete. """
+        return end + self.delay * 1000 <= time.time() * 1000
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.tiles.pop(key, None)
+            if entry is not None:
+                if entry[0] > now:
+                    self.tiles[key] = entry
+                    return entry[1]
+                self.bytes -= entry[2]
+        if self.redis is None:
+            return None
+        try:
+            data = self.redis.get(self.name(key))
+        except redis.RedisError:
+            log.exception('reading a tile from Redis failed')
+            return None
+        if data is None:
+            return None
+        tile = unpack(data)
+        self.remember(key, tile, now)
+        return tile
+
+    def put(self, key, tile):
+        now = time.time()
+        self.remember(key, tile, now)
+        if self.redis is not None:
+            try:
+                self.redis.setex(self.name(key), self.ttl, pack(tile))
+            except redis.RedisError:
+                log.exception('writing a tile to Redis failed')
+
+    def remember(self, key, tile, now):
+        labels, ctimes, values = tile
+        size = ctimes.nbytes + values.nbytes + len(repr(labels)) + \
+                len(repr(key))
+        if size > self.size:
+            return
+        with self.lock:
+            entry = self.tiles.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+            while self.tiles and self.bytes + size > self.size:
+                self.bytes -= self.tiles.popitem(last=False)[1][2]
+            self.tiles[key] = (now + self.ttl, tile, size)
+            self.bytes += size
+
+    def name(self, key):
+        return 'yams:tile:' + md5(repr(key)).hexdigest()
+
+
+def pack(tile):
+    """ Serialize a tile, its labels followed by its timestamps and values
+    as little-endian float64 columns.
+    """
+    labels, ctimes, values = tile
+    header = json.dumps({'labels': labels, 'columns': values.shape[1]})
+    return struct.pack('<II', len(header), len(ctimes)) + header + \
+            numpy.vstack((ctimes, values.T)).astype('<f8').tobytes()
+
+
+def unpack(data):
+    length, rows = struct.unpack('<II', data[:8])
+    header = json.loads(data[8:8 + length])
+    columns = numpy.frombuffer(data[8 + length:], '<f8').reshape(
+            header['columns'] + 1, rows)
+    return header['labels'], columns[0], columns[1:].T
+
+
+class Collector(CSVStream):
+    """ Read the points of a query as arrays per series instead of
+    formatting them, keyed by the labels of the series.
+    """
+    def __init__(self, connection, queries, batch_size):
+        CSVStream.__init__(self, connection, queries, batch_size)
+        self.series = OrderedDict()
+        self.labels = None
+
+    def start(self, labels):
+        self.labels = tuple(labels)
+        self.series[self.labels] = []
+        return ''
+
+    def format(self, ctimes, values):
+        self.series[self.labels].append((ctimes, values))
+        return ''
+
+    def close(self):
+        """ The connection is used for the next tile. """
+        if self.data is not None:
+            self.data.close()
+
+
+def empty():
+    """ Return a tile without points. """
+    return None, numpy.zeros(0), numpy.zeros((0, 0))
+
+
+class Job(object):
+    """ A tile of a series still to be read for some of its hosts. """
+    def __init__(self, query, keys, end):
+        self.query = query
+        self.keys = keys
+        self.end = end
+
+
+def tiled(batch, session, connection, max_points, batch_size):
+    """ Return the iterator over the response of batch, a chart between the
+    start and end of its bounds, put together from aligned tiles of each
+    series.  The tiles in the cache are used as they are, and the others are
+    read on connection, and added to the cache if they are complete.
+    """
+    start, end = batch.bounds
+    # The value lists loaded after the fact change the tiles of their days,
+    # the tiles kept from before are left to expire.
+    backfilled = catalog.backfilled()
+    series = []
+    jobs = []
+    for (plugin, hosts, params), tables in zip(batch.specs, batch.tables):
+        try:
+            points = int(params.get('max_points', max_points))
+        except ValueError:
+            points = 0
+        width = resolution(start, end, points or int(max_points) or 1000)
+        span = width * TILE
+        identity = (backfilled, plugin,
+                    tuple(sorted([item for item in params.items() \
+                                  if item[0] not in IGNORED])), width)
+        # The aggregates of the hosts are a single series of their own.
+        aggregated = bool(aggregates(params))
+        members = hosts
+        if aggregated:
+            members = [tuple(hosts)]
+        tiles = dict([(member, []) for member in members])
+
+        for tile in range(start - start % span, end, span):
+            keys = dict([(member, identity + (member, tile)) \
+                         for member in members])
+            missing = []
+            for member in members:
+                found = None
+                if cache.complete(tile + span):
+                    found = cache.get(keys[member])
+                if found is None:
+                    missing.append(member)
+                tiles[member].append((keys[member], found))
+            if not missing:
+                continue
+
+            # Start from the tile before, only keeping the points from the
+            # start of the tile on, so that the rates of its first points
+            # are calculated from the points before them.
+            time_dt, end_dt = [datetime.fromtimestamp(bound / 1000, utc) \
+                               for bound in (tile - span, tile + span)]
+            tile_params = MultiDict([item for item in params.items() \
+                                     if item[0] not in IGNORED])
+            tile_params['since'] = str(tile)
+            # A tile older than the partitions kept is read from the rollups,
+            # which still need the partitions of the chart for the rows not
+            # rolled up yet.
+            tile_tables = catalog.resolve(plugin, time_dt, end_dt,
+                                          params.get('type')) or tables
+            jobs.append(Job(query(session, plugin,
+                    hosts if aggregated else missing, tile_params,
+                    tile_tables, time_dt, batch.time_range, 0, end_dt,
+                    width if points > 0 else None),
+                    dict([(member, keys[member]) for member in missing]),
+                    tile + span))
+        series.append((members, tiles, width if points > 0 else 1))
+
+    return TileStream(connection, batch.stream_class(connection, [], 0),
+                      series, jobs, start, end, batch_size)
+
+
+class TileStream(object):
+    """ Read the tiles missing from the cache, then iterate over the series
+    put together from their tiles in the format of formatter, a stream of
+    the format asked for.
+    """
+    def __init__(self, connection, formatter, series, jobs, start, end,
+            batch_size):
+        self.connection = connection
+        self.formatter = formatter
+        self.series = series
+        self.jobs = jobs
+        self.start = start
+        self.end = end
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        read = {}
+        for job in self.jobs:
+            found = {}
+            if job.query is not None:
+                collector = Collector(self.connection, [job.query],
+                                      self.batch_size)
+                for chunk in collector:
+                    pass
+                for labels, parts in collector.series.items():
+                    if parts:
+                        found[labels] = (list(labels),
+                                numpy.concatenate([ctimes \
+                                        for ctimes, values in parts]),
+                                numpy.vstack([values \
+                                        for ctimes, values in parts]))
+            for member, key in job.keys.items():
+                tile = empty()
+                if job.query is not None:
+                    tile = found.get(tuple(job.query.labels(member)), tile)
+                read[key] = tile
+                if cache.complete(job.end):
+                    cache.put(key, tile)
+
+        for members, tiles, width in self.series:
+            for member in members:
+                parts = [read[key] if found is None else found \
+                         for key, found in tiles[member]]
+                parts = [part for part in parts if part[0] is not None]
+                if not parts:
+                    continue
+                ctimes = numpy.concatenate([part[1] for part in parts])
+                values = numpy.vstack([part[2] for part in parts])
+                shown = (ctimes >= self.start - self.start % width) & \
+                        (ctimes < self.end)
+                yield self.formatter.start(parts[0][0])
+                if shown.any():
+                    yield self.formatter.format(ctimes[shown], values[shown])
+        self.close()
+
+    def close(self):
+        if not self.connection.closed:
+            self.connection.close()
+
+
+cache = Cache()
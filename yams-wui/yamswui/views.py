@@ -1,11 +1,58 @@
+from datetime import datetime
+from hashlib import md5
+
+from pyramid.httpexceptions import (
+    HTTPFound,
+    HTTPNotFound,
+    HTTPServiceUnavailable,
+    )
 from pyramid.response import Response
 from pyramid.view import view_config
 
+from sqlalchemy import text
 from sqlalchemy.exc import DBAPIError
 
+from zope.sqlalchemy import mark_changed
+
+from .catalog import catalog
+from .dashboards import prewarmer
+from .governor import (
+    Governed,
+    governor,
+    )
+from .live import (
+    EventStream,
+    listener,
+    )
+from .metrics import (
+    metrics,
+    route,
+    )
 from .models import (
     DBSession,
     )
+from .partitions import utc
+from .ranking import (
+    MEASURES,
+    rank,
+    )
+from .rollups import epoch
+from .series import (
+    Batch,
+    key,
+    specs,
+    window as series_window,
+    )
+from .tiles import (
+    bounds,
+    tiled,
+    )
+
+# The aggregates the hosts of a source are plotted as when aggregating them.
+AGGREGATE = 'avg,min,max,p95'
+
+# The series ranked by top unless told otherwise.
+TOP = 10
 
 
 @view_config(route_name='add_source')
@@ -52,9 +99,26 @@ def add_source(request):
     else:
         percentage = False
 
+    aggregate = request.session.get('aggregate', False)
+
     if 'url_list' not in request.session:
         request.session['url_list'] = []
 
+    for url in source_urls(params['plugin'], hosts, params['type'],
+                           plugin_instance, type_instance, dsnames, meta,
+                           percentage, aggregate):
+        if url not in request.session['url_list']:
+            request.session['url_list'].append(url)
+
+    return Response()
+
+
+def source_urls(plugin, hosts, type, plugin_instance='', type_instance='',
+        dsnames=(), meta=None, percentage=False, aggregate=False):
+    """ Return the data.csv urls of a source, one for each of its hosts. """
+    params = {'plugin': plugin, 'type': type}
+    meta = meta or {}
+    urls = []
     for host in hosts:
         params['host'] = host
         url = 'data.csv/%(plugin)s/%(host)s?type=%(type)s' % params
@@ -80,10 +144,14 @@ def add_source(request):
         if percentage:
             url += '&percentage=1'
 
-        if url not in request.session['url_list']:
-            request.session['url_list'].append(url)
+        # The urls of the hosts only differ by host, so the chart reads them
+        # with a single query and plots their aggregates.
+        if aggregate:
+            url += '&aggregate=%s' % AGGREGATE
 
-    return Response()
+        urls.append(url)
+
+    return urls
 
 
 @view_config(route_name='chart', renderer='templates/chart.pt')
@@ -103,7 +171,12 @@ def chart(request):
         ymax = ''
         break
 
-    return {'url_list': url_list, 'ymax': ymax}
+    if 'time_range' not in request.session:
+        request.session['time_range'] = 1
+
+    return {'url_list': url_list, 'ymax': ymax,
+            'live': listener.engine is not None,
+            'time_range': request.session['time_range']}
 
 
 @view_config(route_name='clear_sources')
@@ -113,6 +186,18 @@ def clear_sources(request):
     return Response()
 
 
+@view_config(route_name='dashboards', renderer='templates/dashboards.pt')
+def dashboards(request):
+    dashboards = DBSession.execute(text(
+            "SELECT name " \
+            "FROM dashboard " \
+            "ORDER BY name;")).fetchall()
+    return {'dashboards': [(dashboard['name'],
+                            request.route_url('load_dashboard',
+                                              name=dashboard['name'])) \
+                           for dashboard in dashboards]}
+
+
 @view_config(route_name='home', renderer='templates/home.pt')
 def home(request):
     if 'time_range' not in request.session:
@@ -125,208 +210,169 @@ def hosts(request):
     plugin = request.matchdict['plugin']
     type = request.matchdict['type']
 
-    session = DBSession()
-
-    # For performance reasons, find the most recent table partition for the
-    # plugin and get the hosts from that.
-    if plugin == 'postgresql':
-        table = session.execute(
-                "SELECT tablename " \
-                "FROM pg_tables " \
-                "WHERE tablename LIKE 'vl\\_postgresql\\_%%_%s' " \
-                "ORDER BY tablename DESC " \
-                "LIMIT 1;" % type).fetchone()['tablename']
-    else:
-        table = session.execute(
-                "SELECT tablename " \
-                "FROM pg_tables " \
-                "WHERE tablename LIKE 'vl\\_%s\\_%%' " \
-                "ORDER BY tablename DESC " \
-                "LIMIT 1;" % plugin).fetchone()['tablename']
-
-    # Take advantage of the column index on host by using a recursive query.
-    hosts = session.execute(
-            "WITH RECURSIVE t(n) AS (" \
-            "    SELECT min(host) " \
-            "    FROM %(table)s " \
-            "    UNION ALL " \
-            "    SELECT (SELECT host " \
-            "            FROM %(table)s " \
-            "            WHERE host > n " \
-            "            ORDER BY host " \
-            "            LIMIT 1) " \
-            "    FROM t WHERE n IS NOT NULL " \
-            ") " \
-            "SELECT n AS host " \
-            "FROM t " \
-            "WHERE n <> '';" % {'table': table})
+    hosts = catalog.hosts(plugin, type)
+    if cached(request):
+        return request.response
 
     return {'plugin': plugin, 'type': type, 'hosts': hosts}
 
 
-@view_config(route_name='data_csv')
-def data_csv(request):
-    plugin = request.matchdict['plugin']
-    host = request.matchdict['host']
+@view_config(route_name='data_batch')
+def data_batch(request):
+    """ Return every series of the chart, or of the data.csv urls given as
+    url parameters, in one CSV document.  The hosts of the series that only
+    differ by host are read with a single query.
+    """
+    return stream(request, chart_specs(request))
 
-    if 'time_range' not in request.session:
-        request.session['time_range'] = 1
 
-    sql_params = {'plugin': plugin, 'host': host,
-            'time_range': request.session['time_range']}
-
-    # Not sure if there is a faster way, but always get the entire dataset from
-    # the database, and filter out the values we don't want specified by the
-    # query string.
-    wanted_dsnames = None
-    if 'dsnames' in request.params:
-        wanted_dsnames = request.params.getall('dsnames')
-
-    if 'percentage' in request.params and request.params['percentage'] == '1':
-        percentage = True
+def chart_specs(request):
+    """ Return the series of the chart, or of the data.csv urls given as url
+    parameters.  A since given with them applies to every series.
+    """
+    if 'url' in request.params:
+        chart = specs(request.params.getall('url'))
     else:
-        percentage = False
+        chart = specs(request.session.get('url_list', []))
+    if 'since' not in request.params:
+        return chart
 
-    where_condition = ''
-    per_condition = ''
+    merged = []
+    for plugin, hosts, params in chart:
+        params = params.copy()
+        params['since'] = request.params['since']
+        merged.append((plugin, hosts, params))
+    return merged
 
-    if 'plugin_instance' in request.params:
-        where_condition += ' AND plugin_instance = :plugin_instance'
-        per_condition += ' AND plugin_instance = :plugin_instance'
-        sql_params['plugin_instance'] = request.params['plugin_instance']
 
-    if 'type' in request.params:
-        where_condition += ' AND type = :type'
-        per_condition += ' AND type = :type'
-        sql_params['type'] = request.params['type']
+@view_config(route_name='data_csv')
+def data_csv(request):
+    plugin = request.matchdict['plugin']
+    host = request.matchdict['host']
 
-    if 'type_instance' in request.params:
-        where_condition += ' AND type_instance = :type_instance'
-        sql_params['type_instance'] = request.params['type_instance']
+    return stream(request, [(plugin, [host], request.params)])
 
-    if 'meta' in request.params:
-        keys = request.params.getall('meta')
 
-        for key in keys:
-            where_condition += ' AND meta -> \'%(key)s\' = :%(key)s' % \
-                    {'key': key}
-            sql_params[key] = request.params[key]
+def stream(request, specs):
+    """ Stream the series described by specs, a list of (plugin, hosts,
+    params), in the format asked for, or tell the browser that the copy it
+    already has is still current without reading any of them.  Series kept
+    ready by the prewarmer are served as they are.  With start and end given
+    in milliseconds, the series between them are put together from tiles.
+    """
+    if 'time_range' not in request.session:
+        request.session['time_range'] = 1
+    time_range = request.session['time_range']
+    binary = request.params.get('format') == 'binary'
+
+    settings = request.registry.settings
+    response = request.response
+    response.cache_control = 'private, max-age=%d, must-revalidate' % \
+            int(settings.get('yams.max_age', 0))
+    response.vary = 'Cookie'
+
+    window = bounds(request.params)
+    prewarmed = None
+    if window is None:
+        prewarmed = prewarmer.lookup(key(specs, time_range, binary))
+    if prewarmed is not None:
+        etag, last_modified, content_type, body = prewarmed
+        if not not_modified(request, etag, last_modified):
+            response.content_type = content_type
+            response.body = body
+        return response
 
     session = DBSession()
-
-    # The data source name and type should be the consistent within a plugin.
-    # Grab the first one to get the details.
-    result = session.execute(
-            "SELECT dsnames, dstypes, " \
-            "       plugin || " \
-            "           CASE WHEN plugin_instance <> '' " \
-            "                THEN '.' || plugin_instance ELSE '' END || " \
-            "           '.' || type || " \
-            "           CASE WHEN type_instance <> '' " \
-            "                THEN '.' || type_instance ELSE '' END " \
-            "           AS prefix " \
-            "FROM value_list " \
-            "WHERE plugin = :plugin " \
-            "%s " \
-            "LIMIT 1;""" % where_condition, sql_params).first()
-    if not result:
-        # These query parameters do not return any data.
-        return Response()
-
-    dsnames = result['dsnames']
-    dstypes = result['dstypes']
-    prefix = result['prefix']
-    length = len(dsnames)
-
-    if wanted_dsnames:
-        plot_dsnames = []
-        for dsname in dsnames:
-            if dsname in wanted_dsnames:
-                plot_dsnames.append(dsname)
-    else:
-        plot_dsnames = dsnames
-
-    if len(plot_dsnames) == 0:
-        # No need to continue if there is nothing to plot.
-        return Response()
-
-    # Get a timestamp instead of calculating it on the fly in order to allow
-    # the planner to use constraint exclusions correctly on the time column.
-    time_dt = session.execute(
-            "SELECT CURRENT_TIMESTAMP - INTERVAL ':time_range HOUR' AS str",
-            sql_params).fetchone()['str']
-
-    sql_params['time_dt'] = time_dt
-
-    if percentage:
-        sql = "WITH totals AS (" \
-                "    SELECT time, sum(values) AS values " \
-                "    FROM value_list " \
-                "    WHERE plugin = :plugin " \
-                "      AND time >= :time_dt " \
-                "      %(per_where)s " \
-                "    GROUP BY time " \
-                ") " \
-                "SELECT extract(EPOCH FROM a.time)::BIGINT * 1000 " \
-                "           AS ctime_ms," \
-                "       array_percentage(a.values, b.values) AS values, " \
-                "       array_percentage(array_subtract(a.values, " \
-                "           lag(a.values) OVER (ORDER BY a.time)), " \
-                "           array_subtract(b.values, lag(b.values) OVER " \
-                "           (ORDER BY a.time))) AS rates " \
-                "FROM value_list a, totals b " \
-                "WHERE a.time = b.time " \
-                "  AND plugin = :plugin " \
-                "  AND host = :host " \
-                "  AND a.time >= :time_dt " \
-                "  %(where)s " \
-                "ORDER BY a.time;"
-    else:
-        sql = "SELECT extract(EPOCH FROM time)::BIGINT * 1000 AS ctime_ms, " \
-                "       values, " \
-                "       array_subtract(values, lag(values) " \
-                "           OVER (ORDER BY time)) AS rates " \
-                "FROM value_list " \
-                "WHERE plugin = :plugin " \
-                "  AND host = :host " \
-                "  AND time >= :time_dt " \
-                "  %(where)s " \
-                "ORDER BY time;"
-
-    data = session.execute(sql % \
-            {'where': where_condition, 'per_where': per_condition}, sql_params)
-    if data.rowcount == 0:
-        return Response()
-
-    csv = 'timestamp,%s\n' % \
-            ','.join(['%s.%s.%s' % \
-                     (host.replace('.', '_'), prefix, dsname) \
-                      for dsname in plot_dsnames])
-
-    # TODO: With thousands of data points, this loop seems to be unacceptably
-    # slow. Is there a faster way? Database stored procedure?
-
-    # Throw away the first row because there will be no rates calculated from
-    # the window function.
-    data.fetchone()
-    for row in data:
-        datum = []
-        for i in range(length):
-            if dsnames[i] in plot_dsnames:
-                # TODO: Handle absolute types.
-                if dstypes[i] == 'counter':
-                    # FIXME: Handle wrap around.
-                    val = row['rates'][i]
-                elif dstypes[i] == 'derive':
-                    val = row['rates'][i]
-                elif dstypes[i] == 'gauge':
-                    val = row['values'][i]
-
-                datum.append(str(val))
-
-        csv += '%s,%s\n' % (row['ctime_ms'], ','.join(datum))
-
-    return Response(body=csv, content_type='text/csv')
+    batch = Batch(session, specs, time_range, binary,
+                  int(settings.get('yams.window_step', 60)), window)
+    if not_modified(request, batch.etag, batch.newest):
+        return response
+
+    # Only so many charts read their rows at a time.  Refreshes of charts
+    # following their newest points only read a few rows and are always let
+    # through.
+    admitted = False
+    if [params for plugin, hosts, params in specs if 'since' not in params]:
+        if not governor.admit():
+            raise HTTPServiceUnavailable(
+                    headers={'Retry-After': str(governor.retry_after)})
+        admitted = True
+
+    # Stream the rows on a connection of its own.  The transaction managed by
+    # pyramid_tm is already finished by the time the response body is
+    # iterated, which would close the cursor.  Flotr2 cannot draw more points
+    # than the chart is wide, so by default average the series down to about
+    # that many points on the server.
+    connection = DBSession.bind.connect()
+    try:
+        governor.limit(connection, route(request))
+        if window is None:
+            app_iter = batch.stream(session, connection,
+                    settings.get('yams.max_points', 1000),
+                    int(settings.get('yams.batch_size', 1000)))
+        else:
+            app_iter = tiled(batch, session, connection,
+                    settings.get('yams.max_points', 1000),
+                    int(settings.get('yams.batch_size', 1000)))
+    except:
+        connection.close()
+        if admitted:
+            governor.release()
+        raise
+    response.app_iter = Governed(app_iter, governor, connection,
+            request.environ.get('waitress.client_disconnected'), admitted)
+    response.content_type = batch.stream_class.content_type
+    return response
+
+
+def not_modified(request, etag, last_modified=None):
+    """ Set the validators of the response and return True, after turning it
+    into a 304 Not Modified, if the browser already has this version of it.
+    """
+    response = request.response
+    response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if etag in request.if_none_match:
+        response.status_int = 304
+        return True
+    return False
+
+
+def cached(request):
+    """ Validate a response that only depends on the url and the catalog. """
+    request.response.cache_control = 'public, max-age=%d' % \
+            int(request.registry.settings.get('yams.max_age', 0))
+    return not_modified(request, md5('%s %d' % (request.path_qs,
+            catalog.version)).hexdigest())
+
+
+@view_config(route_name='live')
+def live(request):
+    """ Push the new points of the series of the chart to the browser as
+    Server-Sent Events as yams-etl loads them.
+    """
+    if listener.engine is None:
+        raise HTTPNotFound()
+
+    subscriber = listener.subscribe(chart_specs(request))
+    keepalive = int(request.registry.settings.get('yams.live_keepalive', 15))
+    response = Response(app_iter=EventStream(listener, subscriber, keepalive),
+            content_type='text/event-stream')
+    response.cache_control = 'no-cache'
+    return response
+
+
+@view_config(route_name='metrics')
+def metrics_view(request):
+    """ Export the metrics of the requests served by this process for
+    Prometheus.
+    """
+    if metrics.engine is None:
+        raise HTTPNotFound()
+
+    return Response(metrics.export(),
+            content_type='text/plain; version=0.0.4', charset='utf-8')
 
 
 @view_config(route_name='dsnames', renderer='templates/dsnames.pt')
@@ -334,28 +380,42 @@ def dsnames(request):
     plugin = request.matchdict['plugin']
     type = request.matchdict['type']
 
-    session = DBSession()
-    dsnames = session.execute(
-            "SELECT dsnames " \
-            "FROM value_list " \
-            "WHERE plugin = :plugin " \
-            "  AND type = :type " \
-            "LIMIT 1;", {'plugin': plugin, 'type': type}).fetchone()['dsnames']
+    dsnames = catalog.dsnames(plugin, type)
+    if cached(request):
+        return request.response
 
     return {'plugin': plugin, 'type': type, 'dsnames': dsnames}
 
 
+@view_config(route_name='load_dashboard')
+def load_dashboard(request):
+    """ Chart a saved dashboard, counting the view so that the prewarmer
+    keeps the data of the popular ones ready.
+    """
+    dashboard = DBSession.execute(text(
+            "UPDATE dashboard " \
+            "SET views = views + 1, " \
+            "    last_viewed = CURRENT_TIMESTAMP " \
+            "WHERE name = :name " \
+            "RETURNING url_list, time_range;"),
+            {'name': request.matchdict['name']}).first()
+    if dashboard is None:
+        raise HTTPNotFound()
+    mark_changed(DBSession())
+
+    request.session['url_list'] = list(dashboard['url_list'])
+    request.session['time_range'] = dashboard['time_range']
+
+    return HTTPFound(location=request.route_url('home'))
+
+
 @view_config(route_name='plugins', renderer='templates/plugins.pt')
 def plugins(request):
-    session = DBSession()
-    # Cheat on getting the list of plugins that data exists for by taking
-    # advantage of the table partitioning naming schema.
-    plugins = session.execute(
-            "SELECT DISTINCT substring(tablename, 'vl_(.*?)_') AS plugin " \
-            "FROM pg_tables " \
-            "WHERE schemaname = 'collectd' " \
-            "  AND tablename LIKE 'vl\\_%' " \
-            "ORDER BY plugin;")
+    # The catalog cheats on getting the list of plugins that data exists for
+    # by taking advantage of the table partitioning naming schema.
+    plugins = catalog.plugins()
+    if cached(request):
+        return request.response
     return {'plugins': plugins}
 
 
@@ -382,33 +442,46 @@ def plugin_instances(request):
     if plugin == 'postgresql':
         return Response()
 
-    session = DBSession()
+    plugin_instances = catalog.plugin_instances(plugin)
 
-    # For performance reasons, find the most recent table partition for the
-    # plugin and get the plugin_instances from that.
-    table = session.execute(
-            "SELECT tablename " \
-            "FROM pg_tables " \
-            "WHERE tablename LIKE 'vl\\_%s\\_%%' " \
-            "ORDER BY tablename DESC " \
-            "LIMIT 1;" % plugin).fetchone()['tablename']
-
-    plugin_instances = session.execute(
-            "SELECT DISTINCT plugin_instance " \
-            "FROM %s " \
-            "WHERE plugin_instance <> '' " \
-            "ORDER BY plugin_instance;" % table)
-
-    if plugin_instances.rowcount == 0:
+    if len(plugin_instances) == 0:
         return Response()
 
     return {'plugin': plugin, 'plugin_instances': plugin_instances}
 
 
+@view_config(route_name='save_dashboard')
+def save_dashboard(request):
+    """ Save the chart under a name, replacing any dashboard of that name. """
+    if not request.session.get('url_list'):
+        return Response()
+
+    try:
+        refresh = max(int(request.params.get('refresh', 60)), 1)
+    except ValueError:
+        refresh = 60
+
+    params = {'name': request.matchdict['name'],
+              'url_list': list(request.session['url_list']),
+              'time_range': request.session.get('time_range', 1),
+              'refresh': refresh}
+    if DBSession.execute(text(
+            "UPDATE dashboard " \
+            "SET url_list = :url_list, " \
+            "    time_range = :time_range, " \
+            "    refresh = :refresh " \
+            "WHERE name = :name;"), params).rowcount == 0:
+        DBSession.execute(text(
+                "INSERT INTO dashboard " \
+                "            (name, url_list, time_range, refresh) " \
+                "VALUES (:name, :url_list, :time_range, :refresh);"), params)
+    mark_changed(DBSession())
+
+    return Response()
+
+
 @view_config(route_name='session', renderer='templates/session.pt')
 def session(request):
-    session = DBSession()
-
     if 'plugin' in request.session:
         plugin = request.session['plugin']
     else:
@@ -452,6 +525,11 @@ def session(request):
     else:
         percentage = 'No'
 
+    if request.session.get('aggregate'):
+        aggregate = AGGREGATE
+    else:
+        aggregate = 'No'
+
     if plugin <> '' and type <> '' and len(hosts) > 0:
         add_source = True
     else:
@@ -464,21 +542,7 @@ def session(request):
 
     # Create input form for meta data only for the postgresql plugin.
     if plugin == 'postgresql':
-        # Because of potentially high volumes of postgres metrics, take
-        # advantage of the special partitioning schema used for the
-        # postgresql plugin.
-        tablename = session.execute(
-                "SELECT tablename " \
-                "FROM pg_tables " \
-                "WHERE schemaname = 'collectd' " \
-                "  AND substring(tablename, " \
-                "      'vl_postgresql_\d\d\d\d\d\d\d\d_%s') IS NOT NULL " \
-                "ORDER BY tablename;" % type).fetchone()['tablename']
-
-        meta_keys = session.execute(
-                "SELECT akeys(meta) AS keys " \
-                "FROM %s " \
-                "LIMIT 1;" % tablename).fetchone()['keys']
+        meta_keys = catalog.meta_keys(plugin, type)
     else:
         meta_keys = []
 
@@ -487,7 +551,13 @@ def session(request):
             'add_source': add_source, 'show_clear': show_clear,
             'meta_keys': meta_keys, 'meta': meta,
             'plugin_instance': plugin_instance, 'type_instance': type_instance,
-            'percentage': percentage}
+            'percentage': percentage, 'aggregate': aggregate}
+
+
+@view_config(route_name='toggle_aggregate')
+def toggle_aggregate(request):
+    request.session['aggregate'] = not request.session.get('aggregate', False)
+    return Response()
 
 
 @view_config(route_name='toggle_dsname')
@@ -580,38 +650,69 @@ def toggle_type_instance(request):
     return Response()
 
 
+@view_config(route_name='top', renderer='json')
+def top(request):
+    """ Rank the series of a type by the average, maximum or rate of a data
+    source over the time range of the chart, or between start and end, and
+    return the top n.  With add=1 they are also added to the chart, as
+    add_source would add them.
+    """
+    plugin = request.matchdict['plugin']
+    type = request.matchdict['type']
+
+    by = request.params.get('by', 'avg')
+    if by not in MEASURES:
+        by = 'avg'
+    try:
+        n = max(int(request.params.get('n', TOP)), 1)
+    except ValueError:
+        n = TOP
+
+    window = bounds(request.params)
+    if window is not None:
+        time_dt, end_dt = [datetime.fromtimestamp(bound / 1000, utc) \
+                           for bound in window]
+    else:
+        time_dt, end_dt = series_window(request.session.get('time_range', 1),
+                int(request.registry.settings.get('yams.window_step', 60)))
+    tables = catalog.resolve(plugin, time_dt, end_dt, type)
+    ranked = rank(DBSession, plugin, type, request.params, tables, time_dt,
+                  end_dt, n, by)
+
+    if request.params.get('add') == '1':
+        if 'url_list' not in request.session:
+            request.session['url_list'] = []
+        for row in ranked:
+            # The series of a group of every host are charted for each host,
+            # or for the hosts asked for.
+            if 'host' in row:
+                hosts = [row['host']]
+            else:
+                hosts = request.params.getall('host') or ['*']
+            for url in source_urls(plugin, hosts, type,
+                    row.get('plugin_instance',
+                            request.params.get('plugin_instance', '')),
+                    row.get('type_instance',
+                            request.params.get('type_instance', '')),
+                    request.session.get('dsnames', []),
+                    request.session.get('meta', {}),
+                    request.session.get('percentage', False),
+                    request.session.get('aggregate', False)):
+                if url not in request.session['url_list']:
+                    request.session['url_list'].append(url)
+
+    return {'plugin': plugin, 'type': type, 'by': by,
+            'start': epoch(time_dt) * 1000, 'end': epoch(end_dt) * 1000,
+            'top': ranked}
+
+
 @view_config(route_name='types', renderer='templates/types.pt')
 def types(request):
     plugin = request.matchdict['plugin']
 
-    session = DBSession()
-
-    if plugin == 'postgresql':
-        # Because of potentially high volumes of postgres metrics, take
-        # advantage of the special partitioning schema used for the postgresql
-        # plugin.
-        types = session.execute(
-                "SELECT DISTINCT substring(tablename, " \
-                "       'vl_postgresql_\d\d\d\d\d\d\d\d_(.*)') AS type " \
-                "FROM pg_tables " \
-                "WHERE schemaname = 'collectd' " \
-                "  AND substring(tablename, " \
-                "      'vl_postgresql_\d\d\d\d\d\d\d\d_(.*)') IS NOT NULL " \
-                "ORDER BY type;")
-    else:
-        # For performance reasons, find the most recent table partition for the
-        # plugin and get the types from that.
-        table = session.execute(
-                "SELECT tablename " \
-                "FROM pg_tables " \
-                "WHERE tablename LIKE 'vl\\_%s\\_%%' " \
-                "ORDER BY tablename DESC " \
-                "LIMIT 1;" % plugin).fetchone()['tablename']
-
-        types = session.execute(
-                "SELECT DISTINCT type " \
-                "FROM %s " \
-                "ORDER BY type;" % table)
+    types = catalog.types(plugin)
+    if cached(request):
+        return request.response
 
     return {'plugin': plugin, 'types': types}
 
@@ -629,24 +730,9 @@ def type_instances(request):
     if plugin == 'postgresql':
         return Response()
 
-    session = DBSession()
+    type_instances = catalog.type_instances(plugin, type)
 
-    # For performance reasons, find the most recent table partition for the
-    # plugin and get the plugin_instances from that.
-    table = session.execute(
-            "SELECT tablename " \
-            "FROM pg_tables " \
-            "WHERE tablename LIKE 'vl\\_%s\\_%%' " \
-            "ORDER BY tablename DESC " \
-            "LIMIT 1;" % plugin).fetchone()['tablename']
-
-    type_instances = session.execute(
-            "SELECT DISTINCT type_instance " \
-            "FROM %s " \
-            "WHERE type_instance <> '' " \
-            "ORDER BY type_instance;" % table)
-
-    if type_instances.rowcount == 0:
+    if len(type_instances) == 0:
         return Response()
 
     return {'plugin': plugin, 'type': type, 'type_instances': type_instances}